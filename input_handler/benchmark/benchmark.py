@@ -0,0 +1,380 @@
+"""
+Benchmark.
+
+    Measures the throughput and latency of the handler against a local SQLite
+    database, with a pass-through Decrypter, under the load of a synthetic
+    fleet of stores. Every store is initialized first and then sends constant
+    messages in rounds, where a few products sell, some get restocked and now
+    and then a new product shows up.
+
+    The results are printed, or written to --output, as JSON:
+        python benchmark.py --stores 100 --products 40 --rounds 20 --target app
+
+Classes:
+    FleetGenerator
+
+Functions:
+    summarize(latencies, messages, seconds, statements) -> dict
+
+    run_benchmark(options) -> dict
+
+    main() -> None
+
+"""
+#_________________________________Libraries____________________________________
+import argparse
+import datetime
+import functools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+# the stubs go first so the real keys and Decrypter are never picked up
+sys.path[:0] = [os.path.join(BENCHMARK_DIR, "stubs"), os.path.join(BENCHMARK_DIR, "..", "src")]
+
+import handler_keys
+import local_db
+
+#__________________________________Classes_____________________________________
+class FleetGenerator():
+    """
+    Fleet generator.
+
+        Generates the messages of a fleet of stores that share one product
+        catalog.
+
+    Attributes
+    ----------
+    eans : list
+        Eans of the catalog.
+
+    stores : dict
+        Store id to the current stock of every product of the store.
+
+    Methods
+    -------
+    initialization_message(index):
+        Get the initialization message of a new store.
+
+    register_store(store_id, message):
+        Start tracking a store that was initialized.
+
+    constant_message(store_id):
+        Get the next constant message of a store.
+
+    """
+
+    def __init__(self, products=40, catalog_size=None, churn=0.1, restock=0.02, new_product=0.01, seed=0) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        products : int, optional
+            Products of every store when it is initialized. The default is 40.
+
+        catalog_size : int, optional
+            Products of the catalog. The default is twice ``products``.
+
+        churn : float, optional
+            Chance that a product sells in a message. The default is 0.1.
+
+        restock : float, optional
+            Chance that a product is restocked in a message. The default is
+            0.02.
+
+        new_product : float, optional
+            Chance that a store starts selling a new product in a message.
+            The default is 0.01.
+
+        seed : int, optional
+            Seed of the generator. The default is 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.products = products
+        self.eans = ["75{i:011d}".format(i=i) for i in range(catalog_size or 2 * products)]
+        self.churn = churn
+        self.restock = restock
+        self.new_product = new_product
+        self.stores = {}
+        self._maximums = {}
+        self._random = random.Random(seed)
+        self._clock = datetime.datetime(2022, 1, 1)
+
+    def _timestamp(self):
+        self._clock += datetime.timedelta(seconds=1)
+        return self._clock.strftime("%Y-%m-%d %H:%M:%S")
+
+    def initialization_message(self, index):
+        """
+        Get the initialization message of a new store.
+
+        Parameters
+        ----------
+        index : int
+            Number of the store.
+
+        Returns
+        -------
+        dict
+            Initialization message.
+
+        """
+        eans = self._random.sample(self.eans, min(self.products, len(self.eans)))
+        maximums = {ean: self._random.randint(10, 50) for ean in eans}
+        return {
+            "device_key": "benchmark-device-{i}".format(i=index),
+            "store_name": "benchmark store {i}".format(i=index),
+            "store_latitude": round(self._random.uniform(14, 32), 6),
+            "store_longitude": round(self._random.uniform(-117, -86), 6),
+            "store_state": "state",
+            "store_municipality": "municipality",
+            "store_zip_code": "{z:05d}".format(z=index),
+            "store_address": "street {i}".format(i=index),
+            "store_curr_stock": {ean: self._random.randint(maximums[ean] // 2, maximums[ean]) for ean in eans},
+            "store_min_stocks": {ean: 0 for ean in eans},
+            "store_max_stocks": maximums,
+        }
+
+    def register_store(self, store_id, message):
+        """
+        Start tracking a store that was initialized.
+
+        Parameters
+        ----------
+        store_id : int
+            Id the handler gave the store.
+
+        message : dict
+            Initialization message of the store.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.stores[store_id] = dict(message["store_curr_stock"])
+        self._maximums[store_id] = dict(message["store_max_stocks"])
+
+    def constant_message(self, store_id):
+        """
+        Get the next constant message of a store.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+
+        Returns
+        -------
+        dict
+            Constant message with the count of every product of the store.
+
+        """
+        stocks = self.stores[store_id]
+        maximums = self._maximums[store_id]
+        for ean in stocks:
+            draw = self._random.random()
+            if draw < self.churn:
+                stocks[ean] = max(stocks[ean] - self._random.randint(1, 3), 0)
+            elif draw < self.churn + self.restock:
+                stocks[ean] = maximums[ean]
+        if self._random.random() < self.new_product:
+            missing = [ean for ean in self.eans if ean not in stocks]
+            if missing:
+                ean = self._random.choice(missing)
+                maximums[ean] = self._random.randint(10, 50)
+                stocks[ean] = maximums[ean]
+        content_count = dict(stocks)
+        # devices report empty spaces on the shelf as product "0"
+        content_count["0"] = 0
+        return {"store_id": store_id, "content_count": content_count, "timestamp": self._timestamp()}
+
+#_________________________________Functions____________________________________
+def summarize(latencies, messages, seconds, statements):
+    """
+    Summarize one phase of the benchmark.
+
+    Parameters
+    ----------
+    latencies : list
+        Seconds taken by every request.
+
+    messages : int
+        Messages handled.
+
+    seconds : float
+        Wall time of the phase.
+
+    statements : int
+        Statements run on the database, None if they were not counted.
+
+    Returns
+    -------
+    dict
+        Throughput, latency percentiles in milliseconds and statements per
+        message.
+
+    """
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "messages": messages,
+        "requests": len(latencies),
+        "seconds": round(seconds, 4),
+        "messages_per_second": round(messages / seconds, 2) if seconds > 0 else None,
+        "latency_ms": {
+            "p50": round(float(np.percentile(latencies_ms, 50)), 4),
+            "p99": round(float(np.percentile(latencies_ms, 99)), 4),
+            "mean": round(float(latencies_ms.mean()), 4),
+            "max": round(float(latencies_ms.max()), 4),
+        },
+        "statements_per_message": round(statements / messages, 3) if messages > 0 and statements is not None else None,
+    }
+
+def run_benchmark(options):
+    """
+    Run the benchmark.
+
+    Parameters
+    ----------
+    options : argparse.Namespace
+        Parsed command line options.
+
+    Returns
+    -------
+    dict
+        Configuration and results of every phase.
+
+    """
+    generator = FleetGenerator(products=options.products, catalog_size=options.catalog_size,
+                               churn=options.churn, restock=options.restock,
+                               new_product=options.new_product, seed=options.seed)
+    local_db.create_database(options.database, generator.eans)
+
+    handler_keys.DB_CONNECTION_FACTORY = functools.partial(local_db.connect, options.database)
+    handler_keys.INGEST_MODE = options.ingest_mode
+    handler_keys.INGEST_WORKERS = options.ingest_workers
+    handler_keys.SHARD_WORKERS = options.ingest_workers
+    handler_keys.LOG_LEVEL = options.log_level
+    handler_keys.SPOOL_DIR = options.database + ".spool"
+    import hardware_coms
+    client = hardware_coms.app.test_client()
+
+    def initialize(message):
+        if options.target == "uploader":
+            return hardware_coms.uploader.handle_initialization_message(message)
+        return client.post("/initaialization_messages", json=message).get_json()["store_id"]
+
+    def send(messages):
+        if options.target == "uploader":
+            for message in messages:
+                hardware_coms.uploader.handle_constant_message(message)
+        elif options.target == "batch":
+            response = client.post("/batch_constant_messages", json=messages)
+            assert response.status_code in (200, 202), response.status_code
+        else:
+            for message in messages:
+                response = client.post("/constant_messages", json=message)
+                assert response.status_code in (200, 202), response.status_code
+
+    latencies = []
+    statements = local_db.statement_count()
+    start = time.perf_counter()
+    for i in range(options.stores):
+        message = generator.initialization_message(i)
+        sent = time.perf_counter()
+        store_id = initialize(message)
+        latencies.append(time.perf_counter() - sent)
+        generator.register_store(store_id, message)
+    initialization = summarize(latencies, options.stores, time.perf_counter() - start,
+                               local_db.statement_count() - statements)
+
+    requests = []
+    for _ in range(options.rounds):
+        round_messages = [generator.constant_message(store_id) for store_id in generator.stores]
+        if options.target == "batch":
+            requests.extend(round_messages[i:i + options.batch_size]
+                            for i in range(0, len(round_messages), options.batch_size))
+        else:
+            requests.extend([message] for message in round_messages)
+
+    latencies = []
+    statements = local_db.statement_count()
+    start = time.perf_counter()
+    for messages in requests:
+        sent = time.perf_counter()
+        send(messages)
+        latencies.append(time.perf_counter() - sent)
+    if hardware_coms.ingest_queue is not None:
+        # queued messages only count once the workers wrote them
+        hardware_coms.ingest_queue.stop()
+    if hardware_coms.spool_replayer is not None:
+        # and spooled ones once the replayer applied them
+        hardware_coms.spool_replayer.run(lambda replay_uploader: None)
+        hardware_coms.spool_replayer.stop()
+    if hardware_coms.store_shards is not None:
+        # shards answer once they applied a message, but count their
+        # statements in their own processes
+        hardware_coms.store_shards.stop()
+        statements = None
+    constant = summarize(latencies, sum(len(messages) for messages in requests), time.perf_counter() - start,
+                         None if statements is None else local_db.statement_count() - statements)
+
+    return {
+        "config": {key: value for key, value in vars(options).items() if key not in ("output", "database")},
+        "initialization": initialization,
+        "constant": constant,
+    }
+
+def main():
+    """
+    Run the benchmark from the command line.
+
+    Returns
+    -------
+    None.
+
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the handler against a local database.")
+    parser.add_argument("--stores", type=int, default=50, help="stores of the fleet (default 50)")
+    parser.add_argument("--products", type=int, default=40, help="products of every store (default 40)")
+    parser.add_argument("--catalog-size", type=int, default=None, help="products of the catalog (default twice --products)")
+    parser.add_argument("--rounds", type=int, default=20, help="constant messages sent by every store (default 20)")
+    parser.add_argument("--churn", type=float, default=0.1, help="chance that a product sells in a message (default 0.1)")
+    parser.add_argument("--restock", type=float, default=0.02, help="chance that a product is restocked in a message (default 0.02)")
+    parser.add_argument("--new-product", type=float, default=0.01, help="chance that a store adds a product in a message (default 0.01)")
+    parser.add_argument("--target", choices=("uploader", "app", "batch"), default="app",
+                        help="call DbUploader directly, POST every message to the app or POST them in batches (default app)")
+    parser.add_argument("--batch-size", type=int, default=50, help="messages per request with --target batch (default 50)")
+    parser.add_argument("--ingest-mode", choices=("sync", "queue", "spool", "shards"), default="sync", help="INGEST_MODE of the handler (default sync)")
+    parser.add_argument("--ingest-workers", type=int, default=4, help="INGEST_WORKERS, or SHARD_WORKERS in shards mode, of the handler (default 4)")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL of the handler (default WARNING)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the load generator (default 0)")
+    parser.add_argument("--database", default=None, help="SQLite file to use (default a temporary file)")
+    parser.add_argument("--output", default=None, help="file the JSON results are written to (default stdout)")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if options.database is None:
+            options.database = os.path.join(directory, "benchmark.db")
+        results = run_benchmark(options)
+    text = json.dumps(results, indent=2)
+    if options.output is None:
+        print(text)
+    else:
+        with open(options.output, "w") as output:
+            output.write(text + "\n")
+
+#____________________________________Main______________________________________
+if __name__ == '__main__':
+    main()
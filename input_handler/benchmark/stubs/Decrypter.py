@@ -0,0 +1,40 @@
+"""
+Decrypter.
+
+    Pass-through stand-in of the provider's Decrypter, so benchmarks measure
+    the handler without the cost of decryption.
+
+Classes:
+    Decrypter
+
+"""
+#__________________________________Classes_____________________________________
+class Decrypter():
+    """
+    Decrypter.
+
+        Returns messages unchanged.
+
+    Methods
+    -------
+    decrypt(message):
+        Get the message.
+
+    """
+
+    def decrypt(self, message):
+        """
+        Get the message.
+
+        Parameters
+        ----------
+        message : dict
+            Message, sent in clear by the load generator.
+
+        Returns
+        -------
+        dict
+            Same message.
+
+        """
+        return message
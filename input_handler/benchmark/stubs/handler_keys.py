@@ -0,0 +1,14 @@
+"""
+Handler keys.
+
+    Stand-in keys for benchmarks. The benchmark points DB_CONNECTION_FACTORY
+    at a local database before the handler is imported, so the MySQL keys
+    are never used.
+
+"""
+#__________________________________Variables___________________________________
+DB_HOST = "localhost"
+DB_USER = "benchmark"
+DB_PASSWORD = ""
+DB_NAME = "benchmark"
+FLASK_APP_KEY = "benchmark"
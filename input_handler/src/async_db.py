@@ -0,0 +1,508 @@
+"""
+Async database.
+
+    Async interface to the database for the asyncio server. Connections of
+    every driver take the statements of the STATEMENTS registry, with %s
+    placeholders, and offer the same calls:
+        execute(sql, params) -> int, id of the last inserted row
+        fetchall(sql, params) -> list of rows
+        start_transaction(), commit(), rollback(), ping(), close()
+
+    MySQL is reached through aiomysql, which is only imported when a MySQL
+    connection is opened. The local SQLite stand-in runs every connection on
+    its own thread, so the event loop never blocks on it.
+
+Classes:
+    AsyncLocalConnection
+
+    AsyncMySqlConnection
+
+    AsyncDbPool
+
+Functions:
+    connect_local(path) -> AsyncLocalConnection
+
+    connect_mysql(host, user, password, database) -> AsyncMySqlConnection
+
+"""
+#_________________________________Libraries____________________________________
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import logging
+import time
+
+import local_db
+
+#__________________________________Variables___________________________________
+logger = logging.getLogger(__name__)
+
+#_________________________________Functions____________________________________
+async def connect_local(path):
+    """
+    Open an async connection to a local database.
+
+    Parameters
+    ----------
+    path : string
+        File of the database, created with local_db.create_database.
+
+    Returns
+    -------
+    AsyncLocalConnection
+        Connection.
+
+    """
+    connection = AsyncLocalConnection(path)
+    await connection.open()
+    return connection
+
+async def connect_mysql(host, user, password, database):
+    """
+    Open an async connection to MySQL in autocommit mode.
+
+    Parameters
+    ----------
+    host : string
+        Host of the server.
+
+    user : string
+        User.
+
+    password : string
+        Password.
+
+    database : string
+        Database.
+
+    Raises
+    ------
+    ImportError
+        If aiomysql is not installed.
+
+    Returns
+    -------
+    AsyncMySqlConnection
+        Connection.
+
+    """
+    import aiomysql
+    connection = await aiomysql.connect(host=host, user=user, password=password, db=database, autocommit=True)
+    return AsyncMySqlConnection(connection)
+
+#__________________________________Classes_____________________________________
+class AsyncLocalConnection():
+    """
+    Async local connection.
+
+        LocalConnection whose calls run on a thread of its own.
+
+    Attributes
+    ----------
+    path : string
+        File of the database.
+
+    Methods
+    -------
+    open():
+        Open the connection.
+
+    run(function):
+        Run a function on the thread of the connection.
+
+    execute(sql, params):
+        Run a statement.
+
+    insert(sql, params):
+        Run an insert and get the id of its row.
+
+    fetchall(sql, params):
+        Run a query and get every row.
+
+    start_transaction():
+        Begin a transaction.
+
+    commit():
+        Commit the transaction.
+
+    rollback():
+        Roll the transaction back.
+
+    ping():
+        Check the connection.
+
+    close():
+        Close the connection.
+
+    """
+
+    def __init__(self, path) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        path : string
+            File of the database.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.path = path
+        self._connection = None
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-db")
+
+    async def open(self):
+        """
+        Open the connection.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._connection = await self.run(lambda: local_db.connect(self.path))
+
+    async def run(self, function):
+        """
+        Run a function on the thread of the connection.
+
+        Parameters
+        ----------
+        function : callable
+            Function without arguments.
+
+        Returns
+        -------
+        object
+            Value returned by the function.
+
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._thread, function)
+
+    def _execute(self, sql, params, result):
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            return result(cursor)
+        finally:
+            cursor.close()
+
+    async def execute(self, sql, params=()):
+        """
+        Run a statement.
+
+        Parameters
+        ----------
+        sql : string
+            Statement with %s placeholders.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        int
+            Rows changed.
+
+        """
+        return await self.run(lambda: self._execute(sql, params, lambda cursor: cursor.rowcount))
+
+    async def insert(self, sql, params=()):
+        """
+        Run an insert and get the id of its row.
+
+        Parameters
+        ----------
+        sql : string
+            Statement with %s placeholders.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        int
+            Id of the last inserted row.
+
+        """
+        return await self.run(lambda: self._execute(sql, params, lambda cursor: cursor.lastrowid))
+
+    async def fetchall(self, sql, params=()):
+        """
+        Run a query and get every row.
+
+        Parameters
+        ----------
+        sql : string
+            Query with %s placeholders.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        list
+            Rows.
+
+        """
+        return await self.run(lambda: self._execute(sql, params, lambda cursor: cursor.fetchall()))
+
+    async def start_transaction(self):
+        await self.run(self._connection.start_transaction)
+
+    async def commit(self):
+        await self.run(self._connection.commit)
+
+    async def rollback(self):
+        await self.run(self._connection.rollback)
+
+    async def ping(self):
+        await self.run(self._connection.ping)
+
+    async def close(self):
+        await self.run(self._connection.close)
+        self._thread.shutdown(wait=False)
+
+class AsyncMySqlConnection():
+    """
+    Async MySQL connection.
+
+        aiomysql connection with the calls of the async interface.
+
+    Methods
+    -------
+    execute(sql, params):
+        Run a statement.
+
+    insert(sql, params):
+        Run an insert and get the id of its row.
+
+    fetchall(sql, params):
+        Run a query and get every row.
+
+    start_transaction():
+        Begin a transaction.
+
+    commit():
+        Commit the transaction.
+
+    rollback():
+        Roll the transaction back.
+
+    ping():
+        Check the connection.
+
+    close():
+        Close the connection.
+
+    """
+
+    def __init__(self, connection) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        connection : aiomysql Connection
+            Connection in autocommit mode.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._connection = connection
+
+    async def execute(self, sql, params=()):
+        """
+        Run a statement.
+
+        Parameters
+        ----------
+        sql : string
+            Statement with %s placeholders.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        int
+            Rows changed.
+
+        """
+        async with self._connection.cursor() as cursor:
+            return await cursor.execute(sql, tuple(params))
+
+    async def insert(self, sql, params=()):
+        """
+        Run an insert and get the id of its row.
+
+        Parameters
+        ----------
+        sql : string
+            Statement with %s placeholders.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        int
+            Id of the last inserted row.
+
+        """
+        async with self._connection.cursor() as cursor:
+            await cursor.execute(sql, tuple(params))
+            return cursor.lastrowid
+
+    async def fetchall(self, sql, params=()):
+        """
+        Run a query and get every row.
+
+        Parameters
+        ----------
+        sql : string
+            Query with %s placeholders.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        list
+            Rows.
+
+        """
+        async with self._connection.cursor() as cursor:
+            await cursor.execute(sql, tuple(params))
+            return await cursor.fetchall()
+
+    async def start_transaction(self):
+        await self._connection.begin()
+
+    async def commit(self):
+        await self._connection.commit()
+
+    async def rollback(self):
+        await self._connection.rollback()
+
+    async def ping(self):
+        await self._connection.ping(reconnect=False)
+
+    async def close(self):
+        self._connection.close()
+
+class AsyncDbPool():
+    """
+    Async connection pool.
+
+        Async counterpart of DbConnectionPool: at most ``size`` connections
+        are open, the most recently used idle one is handed out first, and
+        connections that were idle for too long or returned after an error
+        are pinged before they are reused.
+
+    Attributes
+    ----------
+    connection_factory : callable
+        Coroutine function that opens a new connection.
+
+    size : int
+        Maximum number of open connections.
+
+    health_check_interval : float
+        Idle seconds after which a connection is pinged before reuse.
+
+    Methods
+    -------
+    connection():
+        Hold a connection for the enclosed block.
+
+    close_all():
+        Close every idle connection.
+
+    """
+
+    def __init__(self, connection_factory, size=5, health_check_interval=30) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        connection_factory : callable
+            Coroutine function that opens a new connection.
+
+        size : int, optional
+            Maximum number of open connections. The default is 5.
+
+        health_check_interval : float, optional
+            Idle seconds before a ping on checkout. The default is 30.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.connection_factory = connection_factory
+        self.size = size
+        self.health_check_interval = health_check_interval
+        # (connection, healthy, last used) of every idle connection
+        self._idle = []
+        self._slots = None
+
+    async def _checkout(self):
+        while self._idle:
+            connection, healthy, last_used = self._idle.pop()
+            if healthy and time.monotonic() - last_used < self.health_check_interval:
+                return connection
+            try:
+                await connection.ping()
+                return connection
+            except Exception:
+                try:
+                    await connection.close()
+                except Exception:
+                    pass
+        return await self.connection_factory()
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Hold a connection for the enclosed block.
+
+        Yields
+        ------
+        connection
+            Async connection reserved for the block.
+
+        """
+        if self._slots is None:
+            # created here so it belongs to the running event loop
+            self._slots = asyncio.Semaphore(self.size)
+        async with self._slots:
+            connection = await self._checkout()
+            try:
+                yield connection
+            except BaseException:
+                self._idle.append((connection, False, time.monotonic()))
+                raise
+            self._idle.append((connection, True, time.monotonic()))
+
+    async def close_all(self):
+        """
+        Close every idle connection.
+
+        Returns
+        -------
+        None.
+
+        """
+        while self._idle:
+            connection = self._idle.pop()[0]
+            try:
+                await connection.close()
+            except Exception:
+                logger.warning("could not close database connection", exc_info=True)
@@ -0,0 +1,868 @@
+"""
+Async server.
+
+    asyncio entry point of the handler, an alternative to the Flask server of
+    hardware_coms.py. It serves /constant_messages and
+    /initaialization_messages with the same bodies and answers, plus
+    /metrics, over a small HTTP/1.1 server with keep-alive. Every device
+    connection is a coroutine instead of a thread, so one process holds
+    thousands of idle connections; decryption runs on a thread pool and the
+    database is reached through the async interface of async_db, with at most
+    ASYNC_DB_POOL_SIZE connections.
+
+    Constant messages are always handled inside the request, INGEST_MODE only
+    applies to the Flask server.
+
+    Run it against MySQL, which needs aiomysql, or against a local SQLite
+    database, created if missing:
+        python async_server.py [--host 0.0.0.0] [--port 7000] [--database local.db]
+
+Classes:
+    AsyncDbUploader
+
+    AsyncServer
+
+Functions:
+    main() -> None
+
+"""
+#_________________________________Libraries____________________________________
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import contextvars
+import functools
+from http import HTTPStatus
+import json
+import logging
+import time
+import zlib
+
+import handler_keys
+
+import async_db
+import local_db
+from db_uploader import (DB_COMMITS, DB_POOL_HEALTH_CHECK_INTERVAL, DB_QUERIES, DB_ROLLBACKS,
+                         DECRYPT_WORKERS, LOG_LEVEL, LOG_PAYLOADS, LOG_SAMPLE_EVERY, MESSAGE_SECONDS,
+                         PHASE_SECONDS, PRODUCT_CATALOG_TTL, STALE_INVENTORIES, STALE_INVENTORY_RETRIES,
+                         DbUploader)
+from inventory_state import StaleInventoryError, StoreInventory
+from metrics import METRICS
+from product_catalog import ProductCatalog
+from statements import STATEMENTS
+from structured_log import log_message, setup_logging
+from write_batch import WriteBatch
+
+#__________________________________Settings____________________________________
+ASYNC_DB_POOL_SIZE = getattr(handler_keys, "ASYNC_DB_POOL_SIZE", 20)
+ASYNC_MAX_BODY_SIZE = getattr(handler_keys, "ASYNC_MAX_BODY_SIZE", 1024 * 1024)
+ASYNC_IDLE_TIMEOUT = getattr(handler_keys, "ASYNC_IDLE_TIMEOUT", 75)
+
+#__________________________________Variables___________________________________
+logger = logging.getLogger(__name__)
+
+STORE_LOCK_STRIPES = 256
+MAX_HEADERS = 100
+
+# statements and rows written by the task of the current connection
+_QUERIES = contextvars.ContextVar("queries", default=0)
+_ROWS_WRITTEN = contextvars.ContextVar("rows_written", default=0)
+
+#__________________________________Classes_____________________________________
+class AsyncDbUploader(DbUploader):
+    """
+    Async uploader.
+
+        DbUploader whose handlers run on the event loop. Messages are diffed
+        and staged by the same code as the sync handlers, but everything the
+        staging reads from the database (the cached inventory of the store
+        and the catalog entries of its products) is loaded beforehand through
+        an async connection, and the write batch is flushed through it too.
+        Messages of the same store are handled one at a time. Statements and
+        rows written are counted per task instead of per thread, since every
+        connection is served by a task of its own on the same thread.
+
+    Attributes
+    ----------
+    async_db_pool : AsyncDbPool
+        Pool of async connections.
+
+    decrypt_executor : ThreadPoolExecutor
+        Threads that decypher messages off the event loop.
+
+    catalog_loaded_at : float
+        Monotonic time of the last full load of the catalog.
+
+    Methods
+    -------
+    decypher_async(message):
+        Decypher a message on the decryption threads.
+
+    transaction_async():
+        Run the enclosed block in one transaction on a pooled connection.
+
+    execute_async(connection, statement, params, count):
+        Run a registered statement.
+
+    insert_async(connection, statement, params):
+        Run a registered insert and get the id of its row.
+
+    fetchall_async(connection, statement, params, count):
+        Run a registered query and get every row.
+
+    store_lock(store_id):
+        Get the lock of a store.
+
+    load_store_inventory_async(connection, store_id):
+        Get inventory of store from cache or database.
+
+    prepare_catalog_async(connection, eans):
+        Make sure the catalog knows some eans.
+
+    flush_writes_async(connection, batch):
+        Write every pending change of a batch.
+
+    fetch_device_store_async(device_key):
+        Get the store registered by a device.
+
+    handle_constant_message_async(message):
+        Handle a constant message.
+
+    handle_initialization_message_async(message):
+        Handle an initialization message.
+
+    close_async():
+        Close the connections and decryption threads.
+
+    """
+
+    db_queries = property(lambda self: _QUERIES.get(), lambda self, value: _QUERIES.set(value))
+    db_rows_written = property(lambda self: _ROWS_WRITTEN.get(), lambda self, value: _ROWS_WRITTEN.set(value))
+
+    def __init__(self, connection_factory, pool_size=ASYNC_DB_POOL_SIZE, decrypt_workers=DECRYPT_WORKERS) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        connection_factory : callable
+            Coroutine function that opens a new async connection.
+
+        pool_size : int, optional
+            Maximum number of open connections. The default is
+            ASYNC_DB_POOL_SIZE.
+
+        decrypt_workers : int, optional
+            Number of decryption threads. The default is DECRYPT_WORKERS.
+
+        Returns
+        -------
+        None.
+
+        """
+        # reloaded by prepare_catalog_async, so lookups never reach the sync
+        # loaders
+        super().__init__(catalog=ProductCatalog(self._load_catalog, lambda eans: {}, ttl=float("inf")), sync_pool=False)
+        self.async_db_pool = async_db.AsyncDbPool(connection_factory, size=pool_size,
+                                                  health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL)
+        self.decrypt_executor = ThreadPoolExecutor(max_workers=decrypt_workers, thread_name_prefix="decrypt")
+        self.catalog_loaded_at = None
+        self._store_locks = None
+
+    def _load_catalog(self):
+        raise RuntimeError("the catalog of the async uploader is loaded by prepare_catalog_async")
+
+    def touch_store(self, store_id):
+        """
+        Keep the cached inventory of a store consistent with a write.
+
+            The async handlers drop the cached inventory of their store
+            themselves when they fail.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        None.
+
+        """
+
+    def lookup_products(self, eans):
+        """
+        Get the product ids of some eans from the catalog.
+
+            prepare_catalog_async loads them before the message is staged, so
+            the catalog never reads the database here.
+
+        Parameters
+        ----------
+        eans : list
+            Eans of products.
+
+        Returns
+        -------
+        dict
+            Ean to product id, for every ean found.
+
+        """
+        return self.catalog.lookup(eans)
+
+    def load_store_inventory(self, store_id):
+        """
+        Get inventory of store from cache.
+
+            load_store_inventory_async puts it there before the message is
+            staged.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        inventory : StoreInventory
+            Inventory of store.
+
+        """
+        return self.inventory_cache.get(store_id)
+
+    async def decypher_async(self, message):
+        """
+        Decypher a message on the decryption threads.
+
+        Parameters
+        ----------
+        message : dict
+            Encrypted message.
+
+        Returns
+        -------
+        dict
+            Decyphered message.
+
+        """
+        with PHASE_SECONDS.time(phase="decrypt"):
+            return await asyncio.get_running_loop().run_in_executor(self.decrypt_executor, self.decryption.decrypt, message)
+
+    @asynccontextmanager
+    async def transaction_async(self):
+        """
+        Run the enclosed block in one transaction on a pooled connection.
+
+        Yields
+        ------
+        connection
+            Async connection of the transaction.
+
+        """
+        async with self.async_db_pool.connection() as connection:
+            await connection.start_transaction()
+            try:
+                yield connection
+            except BaseException:
+                await connection.rollback()
+                DB_ROLLBACKS.inc()
+                raise
+            with PHASE_SECONDS.time(phase="commit"):
+                await connection.commit()
+            DB_COMMITS.inc()
+
+    async def execute_async(self, connection, statement, params=(), count=1):
+        """
+        Run a registered statement.
+
+        Parameters
+        ----------
+        connection : async connection
+            Connection to run it on.
+
+        statement : string
+            Name of the statement in STATEMENTS.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        count : int, optional
+            Number of values of statements with repeated groups.
+
+        Returns
+        -------
+        int
+            Rows changed, by every chunk of the statement.
+
+        """
+        changed = 0
+        for sql, chunk_params in STATEMENTS[statement].chunks(params, count):
+            self.db_queries += 1
+            DB_QUERIES.inc()
+            changed += await connection.execute(sql, chunk_params)
+        return changed
+
+    async def insert_async(self, connection, statement, params=()):
+        """
+        Run a registered insert and get the id of its row.
+
+        Parameters
+        ----------
+        connection : async connection
+            Connection to run it on.
+
+        statement : string
+            Name of the statement in STATEMENTS.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        int
+            Id of the last inserted row.
+
+        """
+        self.db_queries += 1
+        DB_QUERIES.inc()
+        return await connection.insert(STATEMENTS[statement].render(), tuple(params))
+
+    async def fetchall_async(self, connection, statement, params=(), count=1):
+        """
+        Run a registered query and get every row.
+
+        Parameters
+        ----------
+        connection : async connection
+            Connection to run it on.
+
+        statement : string
+            Name of the statement in STATEMENTS.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        count : int, optional
+            Number of values of statements with repeated groups.
+
+        Returns
+        -------
+        list
+            Rows of every chunk of the statement.
+
+        """
+        rows = []
+        for sql, chunk_params in STATEMENTS[statement].chunks(params, count):
+            self.db_queries += 1
+            DB_QUERIES.inc()
+            rows.extend(await connection.fetchall(sql, chunk_params))
+        return rows
+
+    def store_lock(self, store_id):
+        """
+        Get the lock of a store.
+
+            Stores are spread over STORE_LOCK_STRIPES locks, created on the
+            running event loop.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        asyncio.Lock
+            Lock held while a message of the store is handled.
+
+        """
+        if self._store_locks is None:
+            self._store_locks = [asyncio.Lock() for _ in range(STORE_LOCK_STRIPES)]
+        return self._store_locks[zlib.crc32(str(store_id).encode()) % STORE_LOCK_STRIPES]
+
+    async def load_store_inventory_async(self, connection, store_id):
+        """
+        Get inventory of store from cache or database.
+
+        Parameters
+        ----------
+        connection : async connection
+            Connection to read it with.
+
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        inventory : StoreInventory
+            Inventory of store.
+
+        """
+        inventory = self.inventory_cache.get(store_id)
+        if inventory is None:
+            with PHASE_SECONDS.time(phase="fetch"):
+                rows = await self.fetchall_async(connection, "fetch_inventory_snapshot", (store_id,))
+                state_rows = await self.fetchall_async(connection, "fetch_store_state", (store_id,))
+            inventory = StoreInventory(store_id)
+            for ean, product_id, stock, min_stock, max_stock in rows:
+                inventory.add_item(ean, product_id, stock, min_stock, max_stock)
+            # a default status for stores without one
+            inventory.status, inventory.revision, notified_status = state_rows[0][1:] if state_rows else (2, None, None)
+            inventory.notified_status = inventory.status if notified_status is None else notified_status
+            self.inventory_cache.put(inventory)
+        return inventory
+
+    async def prepare_catalog_async(self, connection, eans):
+        """
+        Make sure the catalog knows some eans.
+
+            The whole catalog is reloaded every PRODUCT_CATALOG_TTL seconds
+            and eans it does not know are looked up, so staging the message
+            afterwards finds every product id in memory.
+
+        Parameters
+        ----------
+        connection : async connection
+            Connection to read it with.
+
+        eans : list
+            Eans of products.
+
+        Returns
+        -------
+        None.
+
+        """
+        with PHASE_SECONDS.time(phase="lookup"):
+            if self.catalog_loaded_at is None or time.monotonic() - self.catalog_loaded_at > PRODUCT_CATALOG_TTL:
+                rows = await self.fetchall_async(connection, "fetch_all_product_ids")
+                self.catalog.load(rows)
+                self.catalog_loaded_at = time.monotonic()
+            missing = self.catalog.missing(eans)
+            if missing:
+                rows = await self.fetchall_async(connection, "fetch_product_ids", missing, count=len(missing))
+                self.catalog.add(rows)
+
+    async def flush_writes_async(self, connection, batch):
+        """
+        Write every pending change of a batch.
+
+        Parameters
+        ----------
+        connection : async connection
+            Connection of the transaction.
+
+        batch : WriteBatch
+            Pending writes.
+
+        Raises
+        ------
+        StaleInventoryError
+            If another process wrote a guarded store since it was read.
+
+        Returns
+        -------
+        None.
+
+        """
+        guard = batch.revision_guard()
+        if batch.is_empty():
+            if guard is not None:
+                params, count = guard
+                if len(await self.fetchall_async(connection, "check_store_revisions", params, count=count)) != count:
+                    raise StaleInventoryError(list(batch.revisions))
+            return
+        with PHASE_SECONDS.time(phase="write"):
+            if guard is not None:
+                params, count = guard
+                if await self.execute_async(connection, "guard_store_revisions", params, count=count) != count:
+                    raise StaleInventoryError(list(batch.revisions))
+                for inventory, revision in batch.guarded_inventories():
+                    inventory.revision = revision + 1
+                self.count_rows_written("Store", count)
+            for statement, params, count, table in batch.statements():
+                await self.execute_async(connection, statement, params, count=count)
+                self.count_rows_written(table, count)
+
+    async def fetch_device_store_async(self, device_key):
+        """
+        Get the store registered by a device.
+
+        Parameters
+        ----------
+        device_key : string
+            Stable key of the device.
+
+        Returns
+        -------
+        int
+            Id of store, None if the device never registered one.
+
+        """
+        async with self.async_db_pool.connection() as connection:
+            rows = await self.fetchall_async(connection, "fetch_device_store", (device_key,))
+        return rows[0][1] if rows else None
+
+    async def handle_constant_message_async(self, message):
+        """
+        Handle a constant message.
+
+        Parameters
+        ----------
+        message : dict
+            Encrypted message.
+
+        Returns
+        -------
+        None.
+
+        """
+        queries, rows = self.db_queries, self.db_rows_written
+        with MESSAGE_SECONDS.time(message="constant"):
+            message = await self.decypher_async(message)
+            self.validate_constant_message(message)
+            log_message(logger, "constant message", message, payloads=LOG_PAYLOADS)
+            store_id = message["store_id"]
+            async with self.store_lock(store_id):
+                for attempt in range(STALE_INVENTORY_RETRIES + 1):
+                    try:
+                        async with self.transaction_async() as connection:
+                            inventory = await self.load_store_inventory_async(connection, store_id)
+                            await self.prepare_catalog_async(connection, [ean for ean in message["content_count"]
+                                                                          if ean != "0" and ean not in inventory])
+                            # other stores may have pushed it out of the cache
+                            # while the catalog was read
+                            self.inventory_cache.put(inventory)
+                            batch = WriteBatch()
+                            self.stage_store_messages([message], batch)
+                            await self.flush_writes_async(connection, batch)
+                        break
+                    except StaleInventoryError:
+                        # another process wrote the store, read it again
+                        self.inventory_cache.evict(store_id)
+                        if attempt == STALE_INVENTORY_RETRIES:
+                            raise
+                        STALE_INVENTORIES.inc()
+                    except BaseException:
+                        # the cached inventory was changed by the staging
+                        self.inventory_cache.evict(store_id)
+                        raise
+        self.observe_message("constant", queries, rows)
+
+    async def handle_initialization_message_async(self, message):
+        """
+        Handle an initialization message.
+
+            Like handle_initialization_message, a device that retries its
+            initialization with the same device_key gets back its store.
+
+        Parameters
+        ----------
+        message : dict
+            Encrypted message.
+
+        Returns
+        -------
+        store_id : int
+            Id of store.
+
+        """
+        queries, rows = self.db_queries, self.db_rows_written
+        with MESSAGE_SECONDS.time(message="initialization"):
+            store_id = await self._apply_initialization_message_async(await self.decypher_async(message))
+        self.observe_message("initialization", queries, rows)
+        return store_id
+
+    async def _apply_initialization_message_async(self, message):
+        log_message(logger, "initialization message", message, payloads=LOG_PAYLOADS)
+        device_key = message.get("device_key")
+        if device_key is not None:
+            store_id = self.store_devices.get(device_key)
+            if store_id is None:
+                store_id = await self.fetch_device_store_async(device_key)
+            if store_id is not None:
+                self.store_devices.put(device_key, store_id)
+                return store_id
+        try:
+            store_id = await self._register_initialization_message_async(message)
+        except Exception:
+            # a concurrent retry of the same device may have registered it
+            store_id = await self.fetch_device_store_async(device_key) if device_key is not None else None
+            if store_id is None:
+                raise
+        if device_key is not None:
+            self.store_devices.put(device_key, store_id)
+        return store_id
+
+    async def _register_initialization_message_async(self, message):
+        async with self.transaction_async() as connection:
+            with PHASE_SECONDS.time(phase="register"):
+                store_id = await self.insert_async(connection, "register_new_store",
+                                                   (message["store_name"], 1, message["store_latitude"],
+                                                    message["store_longitude"], message["store_state"],
+                                                    message["store_municipality"], message["store_zip_code"],
+                                                    message["store_address"]))
+                self.count_rows_written("Store", 1)
+                if message.get("device_key") is not None:
+                    await self.execute_async(connection, "register_store_device", (message["device_key"], store_id))
+                    self.count_rows_written("StoreDevice", 1)
+            await self.prepare_catalog_async(connection, list(message["store_curr_stock"]))
+            batch = WriteBatch()
+            inventory = self.stage_new_store(store_id, message, batch)
+            await self.flush_writes_async(connection, batch)
+        self.inventory_cache.put(inventory)
+        return store_id
+
+    async def close_async(self):
+        """
+        Close the connections and decryption threads.
+
+        Returns
+        -------
+        None.
+
+        """
+        await self.async_db_pool.close_all()
+        self.decrypt_executor.shutdown(wait=False)
+
+class AsyncServer():
+    """
+    Async HTTP server.
+
+        Minimal HTTP/1.1 server for the routes of the devices. Requests need
+        a Content-Length, connections are kept alive unless the client asks
+        otherwise and closed after ASYNC_IDLE_TIMEOUT idle seconds.
+
+    Attributes
+    ----------
+    uploader : AsyncDbUploader
+        Uploader that handles the messages.
+
+    max_body_size : int
+        Largest accepted body in bytes.
+
+    idle_timeout : float
+        Seconds a connection may wait for its next request.
+
+    routes : dict
+        Path to (allowed methods, coroutine function) of every route.
+
+    Methods
+    -------
+    handle_connection(reader, writer):
+        Serve the requests of one connection.
+
+    serve(host, port):
+        Serve until cancelled.
+
+    """
+
+    def __init__(self, uploader, max_body_size=ASYNC_MAX_BODY_SIZE, idle_timeout=ASYNC_IDLE_TIMEOUT) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        uploader : AsyncDbUploader
+            Uploader that handles the messages.
+
+        max_body_size : int, optional
+            Largest accepted body in bytes. The default is
+            ASYNC_MAX_BODY_SIZE.
+
+        idle_timeout : float, optional
+            Seconds a connection may wait for its next request. The default
+            is ASYNC_IDLE_TIMEOUT.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.uploader = uploader
+        self.max_body_size = max_body_size
+        self.idle_timeout = idle_timeout
+        self.routes = {
+            "/constant_messages": (("GET", "POST"), self.constant_messages),
+            "/initaialization_messages": (("GET", "POST"), self.initialization_messages),
+            "/metrics": (("GET",), self.metrics),
+        }
+
+    async def constant_messages(self, body):
+        await self.uploader.handle_constant_message_async(json.loads(body))
+        return HTTPStatus.OK, {}
+
+    async def initialization_messages(self, body):
+        store_id = await self.uploader.handle_initialization_message_async(json.loads(body))
+        return HTTPStatus.OK, {"store_id": store_id}
+
+    async def metrics(self, body):
+        return HTTPStatus.OK, METRICS.render()
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+            body = payload.encode()
+        else:
+            content_type = "application/json"
+            body = json.dumps(payload).encode()
+        head = ("HTTP/1.1 {c} {p}\r\n"
+                "Content-Type: {t}\r\n"
+                "Content-Length: {l}\r\n"
+                "Connection: {k}\r\n\r\n").format(c=status.value, p=status.phrase, t=content_type,
+                                                  l=len(body), k="keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _read_head(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise ValueError("malformed request line")
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise ValueError("too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return parts[0], parts[1].split("?", 1)[0], parts[2], headers
+
+    async def _handle_request(self, method, path, body):
+        route = self.routes.get(path)
+        if route is None:
+            return HTTPStatus.NOT_FOUND, {"error": "not found"}
+        methods, handler = route
+        if method not in methods:
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "method not allowed"}
+        try:
+            return await handler(body)
+        except ValueError as error:
+            return HTTPStatus.BAD_REQUEST, {"error": str(error)}
+        except Exception:
+            logger.exception("could not handle request", extra={"path": path})
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "internal server error"}
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the requests of one connection.
+
+        Parameters
+        ----------
+        reader : asyncio.StreamReader
+            Incoming side of the connection.
+
+        writer : asyncio.StreamWriter
+            Outgoing side of the connection.
+
+        Returns
+        -------
+        None.
+
+        """
+        try:
+            while True:
+                try:
+                    head = await self._read_head(reader)
+                except ValueError as error:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {"error": str(error)}, False)
+                    return
+                if head is None:
+                    return
+                method, path, version, headers = head
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                if "chunked" in headers.get("transfer-encoding", "").lower():
+                    await self._respond(writer, HTTPStatus.LENGTH_REQUIRED, {"error": "chunked bodies are not supported"}, False)
+                    return
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {"error": "malformed content length"}, False)
+                    return
+                if length > self.max_body_size or length < 0:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "body is too large"}, False)
+                    return
+                if headers.get("expect", "").lower() == "100-continue":
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                body = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout)
+                status, payload = await self._handle_request(method, path, body)
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """
+        Serve until cancelled.
+
+        Parameters
+        ----------
+        host : string
+            Address to listen on.
+
+        port : int
+            Port to listen on.
+
+        Returns
+        -------
+        None.
+
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=4096)
+        logger.info("async server listening", extra={"host": host, "port": port})
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.uploader.close_async()
+
+#_________________________________Functions____________________________________
+def main():
+    """
+    Run the async server from the command line.
+
+    Returns
+    -------
+    None.
+
+    """
+    parser = argparse.ArgumentParser(description="Serve device messages on asyncio.")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=7000, help="port to listen on (default 7000)")
+    parser.add_argument("--database", default=None,
+                        help="local SQLite database to use instead of MySQL, created if missing")
+    args = parser.parse_args()
+
+    pool_size = ASYNC_DB_POOL_SIZE
+    if args.database is not None:
+        local_db.create_database(args.database)
+        connection_factory = functools.partial(async_db.connect_local, args.database)
+        # SQLite takes one writer at a time
+        pool_size = 1
+    else:
+        # fail before serving rather than on the first message
+        try:
+            import aiomysql
+        except ImportError:
+            parser.error("aiomysql is needed to reach MySQL, install it or pass --database")
+        connection_factory = functools.partial(async_db.connect_mysql, handler_keys.DB_HOST, handler_keys.DB_USER,
+                                               handler_keys.DB_PASSWORD, handler_keys.DB_NAME)
+    setup_logging(level=LOG_LEVEL, sample_every=LOG_SAMPLE_EVERY)
+    server = AsyncServer(AsyncDbUploader(connection_factory, pool_size=pool_size))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+#____________________________________Main______________________________________
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Database pool.
+
+    Bounded pool of warm database connections shared by the handler.
+
+Classes:
+    PooledConnection
+
+    DbConnectionPool
+
+"""
+#_________________________________Libraries____________________________________
+import queue
+import threading
+import time
+
+#__________________________________Classes_____________________________________
+class PooledConnection():
+    """
+    Pooled connection.
+
+        Wraps a database connection with the bookkeeping the pool needs.
+
+    Attributes
+    ----------
+    connection : DB-API Connection
+        Underlying connection.
+
+    last_used : float
+        Monotonic time at which the connection was last returned.
+
+    healthy : bool
+        False when the connection must be checked before being reused.
+
+    statements : StatementCache
+        Prepared statements of the connection, attached by the first user
+        that needs them.
+
+    """
+
+    def __init__(self, connection) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        connection : DB-API Connection
+            Connection to wrap.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.connection = connection
+        self.last_used = time.monotonic()
+        self.healthy = True
+        self.statements = None
+
+class DbConnectionPool():
+    """
+    Pool.
+
+        Hands out at most ``size`` connections at a time. Connections are
+        checked out for the duration of a request and checked back in when it
+        ends, so one request reuses one warm connection instead of opening a
+        new one per query.
+
+    Attributes
+    ----------
+    connection_factory : callable
+        Returns a new DB-API connection.
+
+    size : int
+        Maximum number of open connections.
+
+    health_check_interval : float
+        Seconds a connection may sit idle before it is pinged on checkout.
+
+    checkout_timeout : float
+        Seconds to wait for a free connection before giving up.
+
+    Methods
+    -------
+    checkout():
+        Get a connection from the pool.
+
+    checkin(pooled, healthy):
+        Return a connection to the pool.
+
+    close_all():
+        Close every idle connection.
+
+    """
+
+    def __init__(self, connection_factory, size=5, health_check_interval=30, checkout_timeout=10) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        connection_factory : callable
+            Returns a new DB-API connection.
+
+        size : int, optional
+            Maximum number of open connections. The default is 5.
+
+        health_check_interval : float, optional
+            Idle seconds before a ping on checkout. The default is 30.
+
+        checkout_timeout : float, optional
+            Seconds to wait for a free connection. The default is 10.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.connection_factory = connection_factory
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _is_alive(self, pooled):
+        """
+        Check that a connection still answers.
+
+        Parameters
+        ----------
+        pooled : PooledConnection
+            Connection to check.
+
+        Returns
+        -------
+        bool
+            True if the connection can be reused.
+
+        """
+        try:
+            pooled.connection.ping()
+        except Exception:
+            return False
+        return True
+
+    def _discard(self, pooled):
+        """
+        Close a connection without returning it to the pool.
+
+        Parameters
+        ----------
+        pooled : PooledConnection
+            Connection to close.
+
+        Returns
+        -------
+        None.
+
+        """
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        """
+        Get a connection from the pool.
+
+            The most recently used idle connection is preferred. Connections
+            that were idle for too long or that were returned after an error
+            are pinged first and replaced if they no longer answer.
+
+        Raises
+        ------
+        TimeoutError
+            If every connection stays busy for ``checkout_timeout`` seconds.
+
+        Returns
+        -------
+        PooledConnection
+            Connection reserved for the caller.
+
+        """
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise TimeoutError("no database connection available after {t}s".format(t=self.checkout_timeout))
+        try:
+            while True:
+                try:
+                    pooled = self._idle.get_nowait()
+                except queue.Empty:
+                    return PooledConnection(self.connection_factory())
+                idle_time = time.monotonic() - pooled.last_used
+                if pooled.healthy and idle_time < self.health_check_interval:
+                    return pooled
+                if self._is_alive(pooled):
+                    pooled.healthy = True
+                    return pooled
+                self._discard(pooled)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def checkin(self, pooled, healthy=True):
+        """
+        Return a connection to the pool.
+
+        Parameters
+        ----------
+        pooled : PooledConnection
+            Connection obtained from checkout.
+
+        healthy : bool, optional
+            False if the caller hit an error while using the connection, so
+            it gets checked before its next use. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        pooled.last_used = time.monotonic()
+        pooled.healthy = healthy
+        self._idle.put(pooled)
+        self._slots.release()
+
+    def close_all(self):
+        """
+        Close every idle connection.
+
+        Returns
+        -------
+        None.
+
+        """
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(pooled)
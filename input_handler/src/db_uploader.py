@@ -0,0 +1,1830 @@
+"""
+Database uploader.
+
+    Uploader of device messages to the database, with the settings and
+    metrics it uses. Importing it has no side effects: no connection,
+    thread or process is started, so the async server and the command line
+    tools use it without starting the Flask server of hardware_coms.py.
+    
+Classes:
+    DbSession
+    
+    DbUploader
+    
+Functions:
+    connect_to_db() -> mysql Connection
+    
+    parse_store_id(store_id) -> int
+    
+"""
+#_________________________________Libraries____________________________________
+from contextlib import contextmanager
+import logging
+import sqlite3
+import threading
+import time
+
+import mysql.connector
+import handler_keys
+
+from decrypt_stage import DecryptionStage
+from db_pool import DbConnectionPool
+from row_decoder import decode_columns, decode_mapping, iter_rows
+from inventory_state import DeviceCache, InventoryCache, StaleInventoryError, StoreInventory, StoreLocks
+from product_catalog import ProductCatalog
+from write_batch import WriteBatch, sale_buckets
+from statements import STATEMENTS, StatementCache
+from structured_log import log_message
+from metrics import COUNT_BUCKETS, METRICS
+from status_engine import EMPTY_THRESHOLD, FULL_THRESHOLD, HYSTERESIS_BAND, status_with_hysteresis
+
+#__________________________________Settings____________________________________
+DB_POOL_SIZE = getattr(handler_keys, "DB_POOL_SIZE", 5)
+DB_POOL_HEALTH_CHECK_INTERVAL = getattr(handler_keys, "DB_POOL_HEALTH_CHECK_INTERVAL", 30)
+DB_POOL_CHECKOUT_TIMEOUT = getattr(handler_keys, "DB_POOL_CHECKOUT_TIMEOUT", 10)
+PRODUCT_CATALOG_TTL = getattr(handler_keys, "PRODUCT_CATALOG_TTL", 3600)
+INVENTORY_CACHE_SIZE = getattr(handler_keys, "INVENTORY_CACHE_SIZE", 1024)
+DEVICE_CACHE_SIZE = getattr(handler_keys, "DEVICE_CACHE_SIZE", 4096)
+STATEMENT_CACHE_SIZE = getattr(handler_keys, "STATEMENT_CACHE_SIZE", 64)
+DECRYPT_MODE = getattr(handler_keys, "DECRYPT_MODE", "inline")
+DECRYPT_WORKERS = getattr(handler_keys, "DECRYPT_WORKERS", None)
+DECRYPT_CHUNK_SIZE = getattr(handler_keys, "DECRYPT_CHUNK_SIZE", 16)
+STATUS_FULL_THRESHOLD = getattr(handler_keys, "STATUS_FULL_THRESHOLD", FULL_THRESHOLD)
+STATUS_EMPTY_THRESHOLD = getattr(handler_keys, "STATUS_EMPTY_THRESHOLD", EMPTY_THRESHOLD)
+STATUS_HYSTERESIS = getattr(handler_keys, "STATUS_HYSTERESIS", HYSTERESIS_BAND)
+STATUS_MIN_DWELL = getattr(handler_keys, "STATUS_MIN_DWELL", 0)
+NOTIFICATION_DEBOUNCE = getattr(handler_keys, "NOTIFICATION_DEBOUNCE", 0)
+LOG_LEVEL = getattr(handler_keys, "LOG_LEVEL", "INFO")
+LOG_SAMPLE_EVERY = getattr(handler_keys, "LOG_SAMPLE_EVERY", 1)
+LOG_PAYLOADS = getattr(handler_keys, "LOG_PAYLOADS", False)
+DB_CONNECTION_FACTORY = getattr(handler_keys, "DB_CONNECTION_FACTORY", None)
+
+#__________________________________Variables___________________________________
+logger = logging.getLogger(__name__)
+
+MESSAGE_SECONDS = METRICS.histogram("handler_message_seconds", "Seconds spent handling messages, by kind.")
+PHASE_SECONDS = METRICS.histogram("handler_phase_seconds", "Seconds spent in each phase of message handling.")
+MESSAGE_QUERIES = METRICS.histogram("handler_message_db_queries", "Statements sent to the database per message.", COUNT_BUCKETS)
+MESSAGE_ROWS = METRICS.histogram("handler_message_rows_written", "Rows written to the database per message.", COUNT_BUCKETS)
+DB_QUERIES = METRICS.counter("handler_db_queries_total", "Statements sent to the database.")
+DB_COMMITS = METRICS.counter("handler_db_commits_total", "Transactions committed.")
+DB_ROLLBACKS = METRICS.counter("handler_db_rollbacks_total", "Transactions rolled back.")
+DB_ROWS_WRITTEN = METRICS.counter("handler_db_rows_written_total", "Rows written to the database, by table.")
+STALE_INVENTORIES = METRICS.counter("handler_stale_inventories_total", "Units of work retried because a cached inventory was stale.")
+STALE_INVENTORY_RETRIES = 3
+
+# raised by a message that can never be applied, like one of an unknown
+# store, and not by the database
+MESSAGE_ERRORS = (ValueError, KeyError, TypeError, mysql.connector.IntegrityError, mysql.connector.DataError,
+                  sqlite3.IntegrityError)
+
+#_________________________________Functions____________________________________
+def connect_to_db():
+    """
+    Open a new connection to the database.
+    
+        DB_CONNECTION_FACTORY, when set, opens it instead of MySQL.
+
+    Returns
+    -------
+    mysql Connection
+        Connection.
+
+    """
+    if DB_CONNECTION_FACTORY is not None:
+        return DB_CONNECTION_FACTORY()
+    return mysql.connector.connect(host=handler_keys.DB_HOST, user=handler_keys.DB_USER, passwd=handler_keys.DB_PASSWORD, database=handler_keys.DB_NAME, autocommit=True)
+
+def parse_store_id(store_id):
+    """
+    Get the id of a store as an int.
+    
+        Devices send it as a number or as a string of digits, it is parsed
+        once so every cache and lock sees the same key.
+
+    Parameters
+    ----------
+    store_id : int or string
+        Id of store, as sent.
+
+    Raises
+    ------
+    ValueError
+        If it is not an integer.
+
+    Returns
+    -------
+    int
+        Id of store.
+
+    """
+    if isinstance(store_id, bool):
+        raise ValueError("store_id is not an integer")
+    if isinstance(store_id, int):
+        return store_id
+    if isinstance(store_id, str) and store_id.strip().isdigit():
+        return int(store_id)
+    raise ValueError("store_id is not an integer")
+
+def _session_attribute(name):
+    """
+    Get a property that reads and writes an attribute of the DbSession of
+    the current thread.
+
+    Parameters
+    ----------
+    name : string
+        Attribute of DbSession.
+
+    Returns
+    -------
+    property
+        Property.
+
+    """
+    return property(lambda self: getattr(self.db_session_state, name),
+                    lambda self, value: setattr(self.db_session_state, name, value))
+
+#__________________________________Classes_____________________________________
+class DbSession(threading.local):
+    """
+    Database session.
+
+        Connection and transaction state of one thread. Every thread
+        that uses a DbUploader sees its own, so concurrent requests never
+        share a connection.
+
+    """
+
+    def __init__(self) -> None:
+        """
+        Construct attributes of the class, once per thread.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.pooled_connection = None
+        self.connection = None
+        self.depth = 0
+        self.in_transaction = False
+        self.touched_stores = set()
+        self.queries = 0
+        self.rows_written = 0
+
+class DbUploader():
+    """
+    Handler.
+    
+        Handles information recieved from frontend and uploads information to 
+        database.
+        
+        One uploader can be used from many threads. Connection and
+        transaction state belong to the calling thread, the caches are
+        shared, and messages of the same store are handled by one thread at
+        a time.
+        
+    Attributes
+    ----------
+    db_pool : DbConnectionPool
+        Pool the connections are checked out from, None if the uploader was
+        created without one.
+        
+    db_session_state : DbSession
+        Database state of every thread.
+    
+    db_connection : mysql Connection
+        Connection checked out by the current thread.
+    
+    decryption : DecryptionStage
+        Decryption of messages, inline or on a pool.
+        
+    db_queries : int
+        Statements sent to the database by this uploader on the current
+        thread.
+        
+    db_rows_written : int
+        Rows written to the database by this uploader on the current thread.
+        
+    catalog : ProductCatalog
+        Cache of product ids by ean, shared by the uploaders of a process.
+        
+    inventory_cache : InventoryCache
+        Last known inventory and status of recently seen stores.
+        
+    store_devices : DeviceCache
+        Id of the store registered by recently seen devices.
+        
+    store_locks : StoreLocks
+        Locks held while a store is handled.
+        
+    Methods
+    -------
+    close_db_connection(healthy):
+        Return connection to the pool.
+        
+    open_db_connection():
+        Check out connection from the pool.
+        
+    db_session():
+        Hold one pooled connection for the enclosed block.
+        
+    lookup_products(eans):
+        Get the product ids of some eans from the catalog.
+        
+    invalidate_catalog():
+        Force a reload of the product catalog on the next lookup.
+        
+    transaction():
+        Run the enclosed block as a single unit of work.
+        
+    evict_touched_stores():
+        Drop the cached inventories of the stores written in the transaction
+        that failed.
+        
+    touch_store(store_id):
+        Keep the cached inventory of a store consistent with a write.
+        
+    load_store_inventory(store_id):
+        Get inventory of store from cache or database.
+        
+    guard_store(inventory, batch):
+        Make a batch conditional on the cached revision of a store.
+        
+    retry_stale(work):
+        Run a unit of work again while a cached inventory it used was stale.
+        
+    execute(statement, params, count):
+        Run a registered statement as a prepared statement.
+        
+    execute_chunks(statement, params, count):
+        Run a registered statement chunk by chunk.
+        
+    count_rows_written(table, rows):
+        Count rows written to a table.
+        
+    observe_message(kind, queries, rows, messages):
+        Record the statements and rows written of handled messages.
+        
+    decypher(message):
+        Decypher given message.
+        
+    decypher_many(messages):
+        Decypher given messages.
+        
+    fetch_all_product_ids():
+        Get id of every product from database.
+        
+    fetch_product_ids(products:list):
+        Get id of product from database.
+    
+    fetch_inventory_snapshot(store_id):
+        Get stock, minimum and maximum stock of store from database.
+        
+    fetch_device_store(device_key):
+        Get the store registered by a device.
+        
+    fetch_spool_offset(spool_name):
+        Get the id of the last message applied from a spool.
+        
+    fetch_store_state(store_id):
+        Get status, revision and last notified status of store from database.
+        
+    fetch_store_statuses():
+        Get status of every store from database.
+        
+    fetch_fleet_inventory():
+        Get stock, minimum and maximum stock of every store as columns.
+    
+    register_new_store(store_name, store_status, store_latitude, store_longitude, store_state, store_municipality, store_zip_code, store_address)
+        Register new store with the given information.
+        
+    register_store_device(device_key, store_id):
+        Register the device of a store.
+    
+    create_notifications(notifications):
+        Register notifications with the given information.
+        
+    update_store_statuses(statuses):
+        Update status of several stores.
+        
+    evict_stores(store_ids):
+        Drop the cached inventories of several stores.
+        
+    set_spool_offset(spool_name, record_id):
+        Store the id of the last message applied from a spool.
+        
+    flush_writes(batch):
+        Write pending changes.
+    
+    handle_change_on_status(store_id, inventory, batch):
+        Change status if necessary.
+    
+    handle_cahanges_on_store_products(inventory, curr:dict, id_store:str, batch):
+        Change store products if necessary.
+        
+    handle_changes_on_store_stock(inventory, curr, id_store:str, timestamp:str, batch):
+        Change store stock if necessary.
+        
+    handle_constant_message(message):
+        Recieve and handle constant messages.
+        
+    validate_constant_message(message):
+        Check decyphered constant message.
+        
+    apply_constant_messages(messages):
+        Handle batch of decyphered constant messages.
+        
+    apply_constant_message(message):
+        Handle decyphered constant message.
+        
+    apply_store_messages(messages):
+        Handle consecutive decyphered constant messages of one store.
+        
+    stage_store_messages(messages, batch):
+        Diff consecutive constant messages of one store into a write batch.
+        
+    apply_spooled_messages(messages, spool_name, record_id):
+        Handle spooled constant messages and advance the spool offset.
+        
+    skip_spooled_message(spool_name, record_id):
+        Advance the spool offset past a message that can not be applied.
+        
+    validate_delta_message(message):
+        Check decyphered delta message.
+        
+    apply_delta_message(message):
+        Handle decyphered delta message.
+        
+    handle_initialization_message(message):
+        Recieve and handle initialization messages.
+        
+    stage_new_store(store_id, message, batch):
+        Stage the inventory of a store that was just registered.
+    
+    """
+    
+    db_pooled_connection = _session_attribute("pooled_connection")
+    db_connection = _session_attribute("connection")
+    db_session_depth = _session_attribute("depth")
+    db_in_transaction = _session_attribute("in_transaction")
+    db_touched_stores = _session_attribute("touched_stores")
+    db_queries = _session_attribute("queries")
+    db_rows_written = _session_attribute("rows_written")
+    
+    def __init__(self, db_pool=None, decryption=None, catalog=None, sync_pool=True) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        db_pool : DbConnectionPool, optional
+            Pool to check connections out from. By default a pool of
+            DB_POOL_SIZE MySQL connections is created.
+            
+        decryption : DecryptionStage, optional
+            Stage to decypher messages with. By default one is created with
+            DECRYPT_MODE and DECRYPT_WORKERS.
+            
+        catalog : ProductCatalog, optional
+            Catalog shared with other uploaders of the process, so one
+            invalidation reaches all of them. By default one is created.
+            
+        sync_pool : bool, optional
+            Create the default pool when none is given. Uploaders that reach
+            the database some other way, like the async one, pass False and
+            have no pool. The default is True.
+
+        Returns
+        -------
+        None
+            DESCRIPTION.
+
+        """
+        if db_pool is None and sync_pool:
+            db_pool = DbConnectionPool(connect_to_db,
+                                       size=DB_POOL_SIZE,
+                                       health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+                                       checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT)
+        self.db_pool = db_pool
+        self.db_session_state = DbSession()
+        if decryption is None:
+            decryption = DecryptionStage(mode=DECRYPT_MODE, workers=DECRYPT_WORKERS, chunk_size=DECRYPT_CHUNK_SIZE)
+        self.decryption = decryption
+        if catalog is None:
+            catalog = ProductCatalog(self.fetch_all_product_ids, self.fetch_product_ids, ttl=PRODUCT_CATALOG_TTL)
+        self.catalog = catalog
+        self.inventory_cache = InventoryCache(max_stores=INVENTORY_CACHE_SIZE)
+        self.store_devices = DeviceCache(max_devices=DEVICE_CACHE_SIZE)
+        self.store_locks = StoreLocks()
+        
+    def close_db_connection(self, healthy=True):
+        """
+        Return db connection to the pool.
+
+        Parameters
+        ----------
+        healthy : bool, optional
+            False if the connection failed while in use. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.db_session_depth -= 1
+        if self.db_session_depth > 0:
+            return
+        self.db_pool.checkin(self.db_pooled_connection, healthy=healthy)
+        self.db_pooled_connection = None
+        self.db_connection = None
+
+    def open_db_connection(self):
+        """
+        Check out db connection from the pool.
+        
+            Nested calls reuse the connection that is already checked out, so
+            a whole message is handled over a single connection.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.db_session_depth == 0:
+            self.db_pooled_connection = self.db_pool.checkout()
+            self.db_connection = self.db_pooled_connection.connection
+            if self.db_pooled_connection.statements is None:
+                self.db_pooled_connection.statements = StatementCache(self.db_connection, max_statements=STATEMENT_CACHE_SIZE)
+        self.db_session_depth += 1
+
+    @contextmanager
+    def db_session(self):
+        """
+        Hold one pooled connection for the enclosed block.
+
+        Yields
+        ------
+        mysql Connection
+            Checked out connection.
+
+        """
+        self.open_db_connection()
+        try:
+            yield self.db_connection
+        except BaseException:
+            self.close_db_connection(healthy=False)
+            raise
+        self.close_db_connection()
+
+    def lookup_products(self, eans):
+        """
+        Get the product ids of some eans from the catalog.
+        
+            Whatever the catalog has to read is read on the connection of
+            this uploader, also when the catalog is shared.
+
+        Parameters
+        ----------
+        eans : list
+            Eans of products.
+
+        Returns
+        -------
+        dict
+            Ean to product id, for every ean found.
+
+        """
+        return self.catalog.lookup(eans, self.fetch_all_product_ids, self.fetch_product_ids)
+
+    def invalidate_catalog(self):
+        """
+        Force a reload of the product catalog on the next lookup.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.catalog.invalidate()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed block as a single unit of work.
+        
+            Connections are in autocommit mode, so statements issued outside
+            of a transaction are committed on their own. Inside this block
+            every write goes into one transaction that is committed once when
+            the block ends and rolled back if it raises. Nested calls join the
+            transaction that is already open. Cached inventories of the stores
+            written in a transaction that is rolled back or fails to commit
+            are dropped.
+
+        Yields
+        ------
+        mysql Connection
+            Checked out connection.
+
+        """
+        with self.db_session():
+            if self.db_in_transaction:
+                yield self.db_connection
+                return
+            self.db_connection.start_transaction()
+            self.db_in_transaction = True
+            try:
+                yield self.db_connection
+            except BaseException:
+                self.db_in_transaction = False
+                self.evict_touched_stores()
+                self.db_connection.rollback()
+                DB_ROLLBACKS.inc()
+                raise
+            self.db_in_transaction = False
+            try:
+                with PHASE_SECONDS.time(phase="commit"):
+                    self.db_connection.commit()
+            except BaseException:
+                self.evict_touched_stores()
+                raise
+            self.db_touched_stores.clear()
+            DB_COMMITS.inc()
+
+    def evict_touched_stores(self):
+        """
+        Drop the cached inventories of the stores written in the transaction
+        that failed.
+
+        Returns
+        -------
+        None.
+
+        """
+        for store_id in self.db_touched_stores:
+            self.inventory_cache.evict(store_id)
+        self.db_touched_stores.clear()
+
+    def touch_store(self, store_id):
+        """
+        Keep the cached inventory of a store consistent with a write.
+        
+            Inside a transaction the handlers update the cached inventory
+            together with the database, and it is dropped if the transaction
+            rolls back. Writes outside of a transaction drop it right away.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.db_in_transaction:
+            self.db_touched_stores.add(store_id)
+        else:
+            self.inventory_cache.evict(store_id)
+
+    def load_store_inventory(self, store_id):
+        """
+        Get inventory of store from cache or database.
+        
+            On a cache miss the inventory, status and revision of the store
+            are read from the database and cached.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        inventory : StoreInventory
+            Inventory of store.
+
+        """
+        inventory = self.inventory_cache.get(store_id)
+        if inventory is None:
+            with PHASE_SECONDS.time(phase="fetch"), self.db_session():
+                inventory = self.fetch_inventory_snapshot(store_id)
+                inventory.status, inventory.revision, notified_status = self.fetch_store_state(store_id)
+                # without a notified status the stored status was notified when it was set
+                inventory.notified_status = inventory.status if notified_status is None else notified_status
+            self.inventory_cache.put(inventory)
+        return inventory
+
+    def guard_store(self, inventory, batch):
+        """
+        Make a batch conditional on the cached revision of a store.
+        
+            Other processes write the same database without seeing this
+            cache, so the batch is only written if the store still has the
+            revision it had when its inventory was read. flush_writes advances
+            the cached revision once the guard passed, and it is dropped with
+            the inventory if the transaction rolls back.
+
+        Parameters
+        ----------
+        inventory : StoreInventory
+            Cached inventory the batch was diffed against.
+            
+        batch : WriteBatch
+            Pending writes.
+
+        Returns
+        -------
+        None.
+
+        """
+        if inventory.revision is not None:
+            batch.guard_revision(inventory)
+
+    def retry_stale(self, work):
+        """
+        Run a unit of work again while a cached inventory it used was stale.
+        
+            The rolled back transaction already dropped the inventories it
+            touched, so every retry diffs against the database. Inside an
+            enclosing transaction the error is left to its owner.
+
+        Parameters
+        ----------
+        work : callable
+            Unit of work, runs its own transaction.
+
+        Returns
+        -------
+        object
+            Result of the unit of work.
+
+        """
+        if self.db_in_transaction:
+            return work()
+        for attempt in range(STALE_INVENTORY_RETRIES):
+            try:
+                return work()
+            except StaleInventoryError as error:
+                STALE_INVENTORIES.inc()
+                logger.info("cached inventory was stale, reloading", extra={"stores": len(error.store_ids)})
+        return work()
+
+    def execute(self, statement, params=(), count=1):
+        """
+        Run a registered statement as a prepared statement.
+        
+            The statement is prepared once per pooled connection and reused
+            afterwards, values are always sent as bound parameters. Must be
+            called inside db_session.
+
+        Parameters
+        ----------
+        statement : string
+            Name of the statement in STATEMENTS.
+            
+        params : sequence, optional
+            Values bound to the placeholders.
+            
+        count : int, optional
+            Number of values of statements with repeated groups.
+
+        Returns
+        -------
+        cursor : DB-API Cursor
+            Prepared cursor holding the result, of the last chunk if the
+            statement ran in several, see execute_chunks.
+
+        """
+        for cursor in self.execute_chunks(statement, params, count):
+            pass
+        return cursor
+
+    def execute_chunks(self, statement, params=(), count=1):
+        """
+        Run a registered statement chunk by chunk.
+        
+            Statements with repeated groups run in chunks of a few fixed
+            sizes, see Statement.chunks. The result of each chunk has to be
+            read before the next one runs. Must be called inside db_session.
+
+        Parameters
+        ----------
+        statement : string
+            Name of the statement in STATEMENTS.
+            
+        params : sequence, optional
+            Values bound to the placeholders.
+            
+        count : int, optional
+            Number of values of statements with repeated groups.
+
+        Yields
+        ------
+        cursor : DB-API Cursor
+            Prepared cursor holding the result of a chunk.
+
+        """
+        for sql, chunk_params in STATEMENTS[statement].chunks(params, count):
+            cursor = self.db_pooled_connection.statements.cursor(sql)
+            cursor.execute(sql, chunk_params)
+            self.db_queries += 1
+            DB_QUERIES.inc()
+            yield cursor
+
+    def count_rows_written(self, table, rows):
+        """
+        Count rows written to a table.
+
+        Parameters
+        ----------
+        table : string
+            Table written.
+            
+        rows : int
+            Number of rows.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.db_rows_written += rows
+        DB_ROWS_WRITTEN.inc(rows, table=table)
+
+    def observe_message(self, kind, queries, rows, messages=1):
+        """
+        Record the statements and rows written of handled messages.
+
+        Parameters
+        ----------
+        kind : string
+            Kind of message.
+            
+        queries : int
+            Value of db_queries before the messages were handled.
+            
+        rows : int
+            Value of db_rows_written before the messages were handled.
+            
+        messages : int, optional
+            Number of messages handled together. The default is 1.
+
+        Returns
+        -------
+        None.
+
+        """
+        MESSAGE_QUERIES.observe((self.db_queries - queries) / messages, message=kind)
+        MESSAGE_ROWS.observe((self.db_rows_written - rows) / messages, message=kind)
+
+    # =============================== HELPERS ===============================
+    
+    def decypher(self, message):
+        """
+        Decyoher message.
+
+        Parameters
+        ----------
+        message : dict
+            Message to decypher.
+
+        Returns
+        -------
+        dict
+            Message dechyphered.
+
+        """
+        with PHASE_SECONDS.time(phase="decrypt"):
+            return self.decryption.decrypt(message)
+    
+    def decypher_many(self, messages):
+        """
+        Decypher messages, in parallel when the decryption stage has a pool.
+
+        Parameters
+        ----------
+        messages : list
+            Messages to decypher.
+
+        Returns
+        -------
+        list
+            Message dechyphered, or the exception raised while decyphering
+            it, for every message in the same order.
+
+        """
+        with PHASE_SECONDS.time(phase="decrypt"):
+            return self.decryption.decrypt_many(messages)
+    
+    # =============================== FETCH DATA FROM DB ===============================
+
+    def fetch_all_product_ids(self)->dict:
+        """
+        Get the id of every product from database.
+
+        Returns
+        -------
+        dict
+            Products to ids dictionary.
+
+        """
+        with self.db_session():
+            cursor = self.execute("fetch_all_product_ids")
+            product_ids_result = decode_mapping(cursor)
+        return product_ids_result
+
+    def fetch_product_ids(self, products:list)->dict:
+        """
+        Get products ids from database.
+
+        Parameters
+        ----------
+        products : list
+            Products to get id from.
+
+        Returns
+        -------
+        dict
+            Products to ids dictionary.
+
+        """
+        if len(products) == 0:
+            return {}
+        with self.db_session():
+            product_ids_result = {}
+            for cursor in self.execute_chunks("fetch_product_ids", products, count=len(products)):
+                product_ids_result.update(decode_mapping(cursor))
+        return product_ids_result
+
+    def fetch_inventory_snapshot(self, store_id):
+        """
+        Get inventory of store from database.
+        
+            Ean, product id, stock, minimum and maximum stock of every product
+            of the store are read with a single query.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        inventory : StoreInventory
+            Inventory of store.
+
+        """
+        inventory = StoreInventory(store_id)
+        with self.db_session():
+            cursor = self.execute("fetch_inventory_snapshot", (store_id,))
+            for ean, product_id, stock, min_stock, max_stock in iter_rows(cursor):
+                inventory.add_item(ean, product_id, stock, min_stock, max_stock)
+        return inventory
+
+    def fetch_device_store(self, device_key):
+        """
+        Get the store registered by a device.
+
+        Parameters
+        ----------
+        device_key : string
+            Stable key of the device.
+
+        Returns
+        -------
+        int
+            Id of store, None if the device never registered one.
+
+        """
+        with self.db_session():
+            cursor = self.execute("fetch_device_store", (device_key,))
+            device_store_result = decode_mapping(cursor)
+        return device_store_result.get(device_key)
+
+    def fetch_spool_offset(self, spool_name):
+        """
+        Get the id of the last message applied from a spool.
+
+        Parameters
+        ----------
+        spool_name : string
+            Name of the spool.
+
+        Returns
+        -------
+        int
+            Id of the record, 0 if nothing was applied yet.
+
+        """
+        with self.db_session():
+            cursor = self.execute("fetch_spool_offset", (spool_name,))
+            spool_offset_result = decode_mapping(cursor)
+        return spool_offset_result.get(spool_name, 0)
+    
+    def fetch_store_state(self, store_id):
+        """
+        Get status, revision and last notified status of store.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        tuple
+            (status, revision, notified_status), (2, None, None) if the store
+            does not exist. notified_status is None if the status was notified
+            when it was set.
+
+        """
+        with self.db_session():
+            cursor = self.execute("fetch_store_state", (store_id,))
+            store_state_result = decode_mapping(cursor)
+        try:
+            return tuple(list(store_state_result.values())[0])
+        except IndexError:
+            # return a default status
+            return 2, None, None
+
+    def fetch_store_statuses(self):
+        """
+        Get status of every store.
+
+        Returns
+        -------
+        dict
+            Store id to status.
+
+        """
+        with self.db_session():
+            cursor = self.execute("fetch_store_statuses")
+            store_statuses_result = decode_mapping(cursor)
+        return store_statuses_result
+
+    def fetch_fleet_inventory(self):
+        """
+        Get every Inventory row as NumPy columns.
+
+        Returns
+        -------
+        dict
+            "store_id", "stock", "min_stock" and "max_stock" arrays.
+
+        """
+        with self.db_session():
+            cursor = self.execute("fetch_fleet_inventory")
+            inventory_result = decode_columns(cursor, ["store_id", "stock", "min_stock", "max_stock"],
+                                              {"stock": "float64", "min_stock": "float64", "max_stock": "float64"})
+        return inventory_result
+        
+        
+    # =============================== GENERATE NEW REGISTERS ON DB ===============================
+
+    def register_new_store(self, store_name, store_status, store_latitude, store_longitude, store_state, store_municipality, store_zip_code, store_address):        
+        """
+        Register new store on database.
+
+        Parameters
+        ----------
+        store_name : string
+            Name of store.
+            
+        store_status : string
+            Status of store.
+            
+        store_latitude : string
+            Latitude of store.
+            
+        store_longitude : string
+            Longitude of store.
+            
+        store_state : string
+            State of store.
+            
+        store_municipality : string
+            Municipality of store.
+            
+        store_zip_code : string
+            Zip code of store.
+            
+        store_address : string
+            Address of store.
+
+        Returns
+        -------
+        int
+            Id the database generated for the store.
+
+        """
+        with self.db_session():
+            cursor = self.execute("register_new_store", (store_name, store_status, store_latitude,
+                                                         store_longitude, store_state, store_municipality,
+                                                         store_zip_code, store_address))
+            store_id = cursor.lastrowid
+        self.count_rows_written("Store", 1)
+        return store_id
+
+    def register_store_device(self, device_key, store_id):
+        """
+        Register the device of a store.
+
+        Parameters
+        ----------
+        device_key : string
+            Stable key of the device.
+            
+        store_id : int
+            Id of store.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.db_session():
+            self.execute("register_store_device", (device_key, store_id))
+        self.count_rows_written("StoreDevice", 1)
+
+    def create_notifications(self, notifications):
+        """
+        Register notifications with a single multi-row insert.
+        
+            The notified status of every store is stored with them.
+
+        Parameters
+        ----------
+        notifications : list
+            (id_store, new_status) rows.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(notifications) == 0:
+            return
+        notified = dict(notifications)
+        params = [value for item in notified.items() for value in item]
+        params.extend(notified.keys())
+        with self.db_session():
+            self.execute("create_notifications", [value for row in notifications for value in row], count=len(notifications))
+            self.execute("set_notified_statuses", params, count=len(notified))
+        self.count_rows_written("Notification", len(notifications))
+        self.count_rows_written("Store", len(notified))
+    
+    # =============================== UPDATE REGISTERS ON DB ===============================
+
+    def update_store_statuses(self, statuses):
+        """
+        Update the status of several stores with one statement.
+        
+            Outside of a write batch the revision of every store is
+            incremented here, so inventories other processes cached are read
+            again.
+
+        Parameters
+        ----------
+        statuses : dict
+            Store id to new status.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(statuses) == 0:
+            return
+        params = [value for item in statuses.items() for value in item]
+        params.extend(statuses.keys())
+        for store_id in statuses:
+            self.touch_store(store_id)
+        with self.db_session():
+            self.execute("set_store_statuses", params, count=len(statuses))
+        self.count_rows_written("Store", len(statuses))
+
+    def evict_stores(self, store_ids):
+        """
+        Drop the cached inventories of several stores.
+        
+            They are read again, with their new status and revision, the next
+            time they are handled.
+
+        Parameters
+        ----------
+        store_ids : iterable
+            Ids of stores.
+
+        Returns
+        -------
+        None.
+
+        """
+        for store_id in store_ids:
+            self.inventory_cache.evict(store_id)
+
+    def set_spool_offset(self, spool_name, record_id):
+        """
+        Store the id of the last message applied from a spool.
+
+        Parameters
+        ----------
+        spool_name : string
+            Name of the spool.
+            
+        record_id : int
+            Id of the record.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.db_session():
+            self.execute("set_spool_offset", (spool_name, record_id))
+        self.count_rows_written("SpoolOffset", 1)
+    
+    def flush_writes(self, batch):
+        """
+        Write every pending change of a batch.
+        
+            Each table is written with a single statement, except stock
+            updates which take one per store. The revision guard runs first,
+            and nothing else is written if a guarded store is stale. A batch
+            with nothing to write only reads the revisions of its guarded
+            stores, so an unchanged message bumps nothing.
+
+        Parameters
+        ----------
+        batch : WriteBatch
+            Pending writes.
+
+        Raises
+        ------
+        StaleInventoryError
+            If another process wrote a guarded store since it was read.
+
+        Returns
+        -------
+        None.
+
+        """
+        guard = batch.revision_guard()
+        if batch.is_empty():
+            if guard is not None:
+                params, count = guard
+                with self.db_session():
+                    if sum(len(cursor.fetchall()) for cursor in self.execute_chunks("check_store_revisions", params, count=count)) != count:
+                        raise StaleInventoryError(list(batch.revisions))
+            return
+        for store_id in batch.stores():
+            self.touch_store(store_id)
+        with PHASE_SECONDS.time(phase="write"), self.db_session():
+            if guard is not None:
+                params, count = guard
+                if sum(cursor.rowcount for cursor in self.execute_chunks("guard_store_revisions", params, count=count)) != count:
+                    raise StaleInventoryError(list(batch.revisions))
+                for inventory, revision in batch.guarded_inventories():
+                    inventory.revision = revision + 1
+                self.count_rows_written("Store", count)
+            for statement, params, count, table in batch.statements():
+                self.execute(statement, params, count=count)
+                self.count_rows_written(table, count)
+    
+    # =============================== MAIN HANDLERS ===============================
+    
+    def handle_change_on_status(self, store_id, inventory, batch):
+        """
+        Handle any change on status.
+        
+            The inventory keeps the mean fill of the store up to date as
+            stocks change, so no product is visited here. A store only
+            changes status once its fill is past a threshold by the
+            STATUS_HYSTERESIS band, and only after STATUS_MIN_DWELL seconds
+            in its status unless it jumps straight between full and empty.
+            Notifications are created at most once per NOTIFICATION_DEBOUNCE
+            seconds per store, for the status the store has by then, so a
+            store that flips back within the window is not notified again.
+
+        Parameters
+        ----------
+        store_id : string
+            If of store.
+            
+        inventory : StoreInventory
+            Inventory of store, with the current stocks and status.
+            
+        batch : WriteBatch
+            Pending writes of the message.
+
+        Returns
+        -------
+        None.
+
+        """
+        curr_store_status = inventory.status
+        now = time.monotonic()
+        
+        new_status = status_with_hysteresis(inventory.mean_fill(), curr_store_status,
+                                            STATUS_FULL_THRESHOLD, STATUS_EMPTY_THRESHOLD, STATUS_HYSTERESIS)
+        if (curr_store_status is not None and abs(new_status - curr_store_status) == 1
+                and inventory.status_since is not None and now - inventory.status_since < STATUS_MIN_DWELL):
+            new_status = curr_store_status
+        
+        if curr_store_status != new_status:
+            batch.set_status(store_id, new_status)
+            inventory.status = new_status
+            inventory.status_since = now
+        
+        if inventory.status != inventory.notified_status and (
+                inventory.notified_at is None or now - inventory.notified_at >= NOTIFICATION_DEBOUNCE):
+            batch.add_notification(store_id, inventory.status)
+            inventory.notified_status = inventory.status
+            inventory.notified_at = now
+        
+    def handle_cahanges_on_store_products(self, inventory, curr:dict, id_store:str, batch):
+        """
+        Handle any changes on store products.
+        
+            Products registered here are added to the inventory snapshot.
+
+        Parameters
+        ----------
+        inventory : StoreInventory
+            Previous inventory of store.
+            
+        curr : dict
+            Current stocks.
+            
+        id_store : str
+            Id of store.
+            
+        batch : WriteBatch
+            Pending writes of the message.
+
+        Returns
+        -------
+        None.
+
+        """
+        # check if new products exist on the new input and if
+        # they do we create a new inventory table for each with defaul max stock 
+        # and min stock values
+        products_only_in_curr = [ product for product in curr.keys() if product not in inventory ]
+        products_only_in_curr = [i for i in products_only_in_curr if i not in ["0"]] # we delete empty spaces from curent products
+        if len(products_only_in_curr) == 0:
+            return
+        # if there are products in current stock that are not in prev stock we fetch the product ids for each        
+        with PHASE_SECONDS.time(phase="lookup"):
+            product_ids_result = self.lookup_products(products_only_in_curr)
+
+        # Once we fetch the product ids of products only in current stock we create a new inventary for each of this products
+
+        for product in products_only_in_curr:
+            logger.debug("creating new inventory register", extra={"store_id": id_store, "product": product})
+            batch.add_inventory(product_ids_result[product], id_store, curr[product], 0, 0) 
+            inventory.add_item(product, product_ids_result[product], curr[product], 0, 0)
+            # TODO: change the min max stock args to non existing product flag       
+    
+    def handle_changes_on_store_stock(self, inventory, curr, id_store:str, timestamp:str, batch):
+        """
+        Handle any change on store stock
+        
+            The inventory snapshot is updated with the current stocks.
+
+        Parameters
+        ----------
+        inventory : StoreInventory
+            Previous inventory of store.
+            
+        curr : dict
+            Current stocks.
+            
+        id_store : str
+            Id of store.
+            
+        timestamp : str
+            Timestamp.
+            
+        batch : WriteBatch
+            Pending writes of the message.
+
+        Returns
+        -------
+        None.
+
+        """
+        current_products = list(curr.keys())
+        current_products = [i for i in current_products if i not in ["0"]] # we delete empty spaces from curent products 
+        
+        for product in current_products:
+            prev_vs_curr_stock = inventory[product].stock - curr[product]
+            product_id = inventory[product].product_id
+            product_stock = curr[product]
+            
+            
+            if prev_vs_curr_stock > 0:
+                # update inventory
+                logger.debug("updating inventory", extra={"store_id": id_store, "product": product})
+                batch.set_stock(id_store, product_id, product_stock)
+                #register sale
+                logger.debug("registering a sale", extra={"store_id": id_store, "product": product})
+                batch.add_sale(product_id, id_store, timestamp, prev_vs_curr_stock)
+            elif prev_vs_curr_stock < 0:
+                # update inventory                
+                logger.debug("updating inventory", extra={"store_id": id_store, "product": product})
+                batch.set_stock(id_store, product_id, product_stock) 
+            inventory.set_stock(product, product_stock)
+        
+
+    def handle_constant_message(self, message): 
+        """
+        Handle any constant messages.
+
+        Parameters
+        ----------
+        message : dict
+            Message.
+
+        Raises
+        ------
+        ValueError
+            If the decyphered message can not be handled, see
+            validate_constant_message.
+
+        Returns
+        -------
+        None.
+
+        """
+        queries, rows = self.db_queries, self.db_rows_written
+        with MESSAGE_SECONDS.time(message="constant"):
+            message = self.decypher(message)
+            self.validate_constant_message(message)
+            log_message(logger, "constant message", message, payloads=LOG_PAYLOADS)
+            self.apply_constant_message(message)
+        self.observe_message("constant", queries, rows)
+        
+    def validate_constant_message(self, message):
+        """
+        Check that a decyphered constant message can be handled.
+        
+            Its store_id is replaced by the int it stands for.
+
+        Parameters
+        ----------
+        message : dict
+            Decyphered message.
+
+        Raises
+        ------
+        ValueError
+            If a field is missing or has the wrong type.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not isinstance(message, dict):
+            raise ValueError("message is not an object")
+        for field in ("store_id", "content_count", "timestamp"):
+            if field not in message:
+                raise ValueError("message has no {f}".format(f=field))
+        message["store_id"] = parse_store_id(message["store_id"])
+        if not isinstance(message["content_count"], dict):
+            raise ValueError("content_count is not an object")
+        try:
+            sale_buckets(message["timestamp"])
+        except (TypeError, ValueError):
+            raise ValueError("timestamp is not a date")
+        
+    def apply_constant_messages(self, messages):
+        """
+        Handle a batch of decyphered constant messages.
+        
+            Messages of the same store are coalesced and the whole batch is
+            applied in one transaction over one pooled connection, with one
+            flush of bulk writes. If that fails every store is retried in its
+            own transaction, and the messages of a store that still fails are
+            retried one by one, so a bad message only fails itself.
+
+        Parameters
+        ----------
+        messages : list
+            Decyphered messages, in the order they were recieved.
+
+        Returns
+        -------
+        errors : list
+            None for every message that was applied, otherwise the error.
+
+        """
+        queries, rows = self.db_queries, self.db_rows_written
+        try:
+            with MESSAGE_SECONDS.time(message="batch"):
+                return self._apply_constant_messages(messages)
+        finally:
+            self.observe_message("constant", queries, rows, messages=max(len(messages), 1))
+
+    def _apply_constant_messages(self, messages):
+        """
+        Handle a batch of decyphered constant messages, see apply_constant_messages.
+
+        Parameters
+        ----------
+        messages : list
+            Decyphered messages, in the order they were recieved.
+
+        Returns
+        -------
+        errors : list
+            None for every message that was applied, otherwise the error.
+
+        """
+        store_messages = {}
+        for i, message in enumerate(messages):
+            store_messages.setdefault(message["store_id"], []).append(i)
+        errors = [None] * len(messages)
+        with self.store_locks.hold(store_messages), self.db_session():
+            def apply_batch():
+                batch = WriteBatch()
+                with self.transaction():
+                    for indices in store_messages.values():
+                        self.stage_store_messages([messages[i] for i in indices], batch)
+                    self.flush_writes(batch)
+            try:
+                self.retry_stale(apply_batch)
+                return errors
+            except Exception:
+                if len(messages) > 1:
+                    logger.warning("could not handle batch of constant messages, retrying by store",
+                                   extra={"messages": len(messages)}, exc_info=True)
+            for store_id, indices in store_messages.items():
+                if len(store_messages) > 1:
+                    try:
+                        self.apply_store_messages([messages[i] for i in indices])
+                        continue
+                    except Exception:
+                        pass
+                for i in indices:
+                    try:
+                        self.apply_store_messages([messages[i]])
+                    except Exception as error:
+                        logger.exception("could not handle constant message", extra={"store_id": store_id})
+                        errors[i] = "{t}: {e}".format(t=type(error).__name__, e=error)
+        return errors
+        
+    def apply_constant_message(self, message):
+        """
+        Handle a decyphered constant message.
+
+        Parameters
+        ----------
+        message : dict
+            Decyphered message.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.apply_store_messages([message])
+        
+    def apply_store_messages(self, messages):
+        """
+        Handle consecutive decyphered constant messages of one store.
+
+        Parameters
+        ----------
+        messages : list
+            Decyphered messages of the same store, oldest first.
+
+        Returns
+        -------
+        None.
+
+        """
+        def apply():
+            batch = WriteBatch()
+            with self.transaction():
+                self.stage_store_messages(messages, batch)
+                self.flush_writes(batch)
+        with self.store_locks.hold([messages[0]["store_id"]]):
+            self.retry_stale(apply)
+        
+    def stage_store_messages(self, messages, batch):
+        """
+        Diff consecutive constant messages of one store into a write batch.
+        
+            The messages are diffed one after the other against the inventory
+            in memory, so every decrement still registers its own sale with
+            the timestamp of its message, but only the final stock of each
+            product and the final status of the store are written. Must be
+            called holding the lock of the store, inside a transaction that
+            flushes the batch.
+
+        Parameters
+        ----------
+        messages : list
+            Decyphered messages of the same store, oldest first.
+            
+        batch : WriteBatch
+            Pending writes.
+
+        Returns
+        -------
+        None.
+
+        """
+        store_id = messages[0]["store_id"]
+        inventory = self.load_store_inventory(store_id=store_id)
+        # the cached inventory is changed before the batch is flushed, so
+        # it has to be dropped too if anything below fails
+        self.touch_store(store_id)
+        self.guard_store(inventory, batch)
+        with PHASE_SECONDS.time(phase="diff"):
+            for message in messages:
+                self.handle_cahanges_on_store_products(inventory, message['content_count'], store_id, batch)
+                self.handle_changes_on_store_stock(inventory, message['content_count'], store_id, message['timestamp'], batch)
+            self.handle_change_on_status(store_id = store_id, inventory = inventory, batch = batch)
+        
+    def apply_spooled_messages(self, messages, spool_name, record_id):
+        """
+        Handle spooled constant messages and advance the spool offset.
+        
+            The messages are coalesced by store and written with the new
+            offset in one transaction, so after a crash they are either
+            applied and skipped by the replay, or not applied at all.
+
+        Parameters
+        ----------
+        messages : list
+            Decyphered messages, in the order they were spooled.
+            
+        spool_name : string
+            Name of the spool.
+            
+        record_id : int
+            Id of the record of the last message.
+
+        Returns
+        -------
+        None.
+
+        """
+        store_messages = {}
+        for message in messages:
+            store_messages.setdefault(message["store_id"], []).append(message)
+        queries, rows = self.db_queries, self.db_rows_written
+        try:
+            def apply():
+                batch = WriteBatch()
+                with self.transaction():
+                    for messages_of_store in store_messages.values():
+                        self.stage_store_messages(messages_of_store, batch)
+                    self.flush_writes(batch)
+                    self.set_spool_offset(spool_name, record_id)
+            with MESSAGE_SECONDS.time(message="spooled"), self.store_locks.hold(store_messages):
+                self.retry_stale(apply)
+        finally:
+            self.observe_message("constant", queries, rows, messages=max(len(messages), 1))
+        
+    def skip_spooled_message(self, spool_name, record_id):
+        """
+        Advance the spool offset past a message that can not be applied.
+
+        Parameters
+        ----------
+        spool_name : string
+            Name of the spool.
+            
+        record_id : int
+            Id of the record of the message.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.transaction():
+            self.set_spool_offset(spool_name, record_id)
+        
+    def validate_delta_message(self, message):
+        """
+        Check that a decyphered delta message can be handled.
+        
+            Delta messages carry either the changed counts since the version
+            the device last got back, in ``changes`` with ``base_version``, or
+            a full resync in ``content_count``. Its store_id is replaced by the
+            int it stands for.
+
+        Parameters
+        ----------
+        message : dict
+            Decyphered message.
+
+        Raises
+        ------
+        ValueError
+            If a field is missing or has the wrong type.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not isinstance(message, dict):
+            raise ValueError("message is not an object")
+        for field in ("store_id", "timestamp", "sequence"):
+            if field not in message:
+                raise ValueError("message has no {f}".format(f=field))
+        message["store_id"] = parse_store_id(message["store_id"])
+        if isinstance(message["sequence"], bool) or not isinstance(message["sequence"], int):
+            raise ValueError("sequence is not an integer")
+        if "content_count" in message:
+            counts = message["content_count"]
+        elif "changes" in message and "base_version" in message:
+            counts = message["changes"]
+        else:
+            raise ValueError("message has neither content_count nor changes and base_version")
+        if not isinstance(counts, dict):
+            raise ValueError("counts are not an object")
+        try:
+            sale_buckets(message["timestamp"])
+        except (TypeError, ValueError):
+            raise ValueError("timestamp is not a date")
+        
+    def apply_delta_message(self, message):
+        """
+        Handle a decyphered delta message.
+        
+            Changes are only applied on top of the version the device started
+            from and right after the previous sequence number. A sequence
+            number that was already applied is a retry and is acknowledged
+            without writing anything. A full resync is always applied.
+
+        Parameters
+        ----------
+        message : dict
+            Decyphered message.
+
+        Returns
+        -------
+        string
+            Version of the store after the message, None if the device has to
+            send a full resync.
+
+        """
+        store_id = message["store_id"]
+        sequence = message["sequence"]
+        full = "content_count" in message
+        counts = message["content_count"] if full else message["changes"]
+        def apply():
+            batch = WriteBatch()
+            with self.transaction():
+                inventory = self.load_store_inventory(store_id=store_id)
+                if not full:
+                    if inventory.sequence is not None and sequence <= inventory.sequence:
+                        return inventory.version()
+                    if message["base_version"] != inventory.version():
+                        return None
+                    if inventory.sequence is not None and sequence != inventory.sequence + 1:
+                        return None
+                self.touch_store(store_id)
+                self.guard_store(inventory, batch)
+                self.handle_cahanges_on_store_products(inventory, counts, store_id, batch)
+                self.handle_changes_on_store_stock(inventory, counts, store_id, message["timestamp"], batch)
+                self.handle_change_on_status(store_id = store_id, inventory = inventory, batch = batch)
+                self.flush_writes(batch)
+                inventory.sequence = sequence
+            return inventory.version()
+        queries, rows = self.db_queries, self.db_rows_written
+        try:
+            with MESSAGE_SECONDS.time(message="delta"), self.store_locks.hold([store_id]):
+                return self.retry_stale(apply)
+        finally:
+            self.observe_message("delta", queries, rows)
+        
+    def handle_initialization_message(self, message):
+        """
+        Handle initialization message.
+        
+            Messages that carry a device_key are idempotent: a device that
+            retries its initialization gets back the store it registered
+            before, and no new store is created.
+
+        Parameters
+        ----------
+        message : dict
+            Message.
+
+        Returns
+        -------
+        store_id : string
+            Id of store.
+
+        """
+        queries, rows = self.db_queries, self.db_rows_written
+        with MESSAGE_SECONDS.time(message="initialization"):
+            store_id = self._apply_initialization_message(self.decypher(message))
+        self.observe_message("initialization", queries, rows)
+        return store_id
+
+    def _apply_initialization_message(self, message):
+        """
+        Register the store and inventory of a decyphered initialization message.
+
+        Parameters
+        ----------
+        message : dict
+            Decyphered message.
+
+        Returns
+        -------
+        store_id : string
+            Id of store.
+
+        """
+        log_message(logger, "initialization message", message, payloads=LOG_PAYLOADS)
+        device_key = message.get("device_key")
+        if device_key is not None:
+            store_id = self.store_devices.get(device_key)
+            if store_id is None:
+                store_id = self.fetch_device_store(device_key)
+            if store_id is not None:
+                self.store_devices.put(device_key, store_id)
+                return store_id
+        try:
+            store_id = self._register_initialization_message(message)
+        except Exception:
+            # a concurrent retry of the same device may have registered it
+            store_id = self.fetch_device_store(device_key) if device_key is not None else None
+            if store_id is None:
+                raise
+        if device_key is not None:
+            self.store_devices.put(device_key, store_id)
+        return store_id
+
+    def _register_initialization_message(self, message):
+        """
+        Register a new store and its inventory in one transaction.
+
+        Parameters
+        ----------
+        message : dict
+            Decyphered message.
+
+        Returns
+        -------
+        store_id : int
+            Id of store.
+
+        """
+        with self.transaction():
+            with PHASE_SECONDS.time(phase="register"):
+                store_id = self.register_new_store(message["store_name"], 1, message["store_latitude"], message["store_longitude"], message["store_state"], message["store_municipality"], message["store_zip_code"], message["store_address"])
+                if message.get("device_key") is not None:
+                    self.register_store_device(message["device_key"], store_id)
+            batch = WriteBatch()
+            inventory = self.stage_new_store(store_id, message, batch)
+            self.flush_writes(batch)
+            self.inventory_cache.put(inventory)
+        return store_id
+
+    def stage_new_store(self, store_id, message, batch):
+        """
+        Stage the inventory of a store that was just registered.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+            
+        message : dict
+            Decyphered initialization message.
+            
+        batch : WriteBatch
+            Pending writes.
+
+        Returns
+        -------
+        inventory : StoreInventory
+            Inventory of the new store, to cache once the batch is committed
+            so its first constant message does not have to read it back.
+
+        """
+        store_products = list(message["store_curr_stock"].keys())
+        with PHASE_SECONDS.time(phase="lookup"):
+            store_products_ids = self.lookup_products(store_products)
+        logger.debug("registered store", extra={"store_id": store_id, "products": len(store_products_ids)})
+        inventory = StoreInventory(store_id)
+        inventory.status = inventory.notified_status = 1
+        inventory.revision = 0
+        for product in store_products:
+            batch.add_inventory(store_products_ids[product], store_id, message["store_curr_stock"][product], message["store_min_stocks"][product], message["store_max_stocks"][product])
+            inventory.add_item(product, store_products_ids[product], message["store_curr_stock"][product], message["store_min_stocks"][product], message["store_max_stocks"][product])
+        return inventory
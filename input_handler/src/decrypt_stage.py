@@ -0,0 +1,278 @@
+"""
+Decryption stage.
+
+    Runs the decryption of device messages inline, on a thread pool or on a
+    process pool, so CPU-bound decryption can use more than one core.
+
+Classes:
+    DecryptionStage
+
+Functions:
+    decrypt_chunk(messages) -> list
+
+"""
+#_________________________________Libraries____________________________________
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import threading
+
+from Decrypter import Decrypter
+
+#__________________________________Variables___________________________________
+# decrypter of the current pool worker, created by its initializer, or of
+# the current thread in inline mode
+_local = threading.local()
+
+logger = logging.getLogger(__name__)
+
+#_________________________________Functions____________________________________
+def _init_worker():
+    """
+    Create the decrypter of a pool worker.
+
+    Returns
+    -------
+    None.
+
+    """
+    _local.decrypter = Decrypter()
+
+def decrypt_chunk(messages):
+    """
+    Decrypt a chunk of messages on a pool worker.
+
+    Parameters
+    ----------
+    messages : list
+        Encrypted messages.
+
+    Returns
+    -------
+    list
+        (True, message) for every decrypted message, (False, error) for every
+        message that failed.
+
+    """
+    results = []
+    for message in messages:
+        try:
+            results.append((True, _local.decrypter.decrypt(message)))
+        except Exception as error:
+            results.append((False, error))
+    return results
+
+#__________________________________Classes_____________________________________
+class DecryptionStage():
+    """
+    Decryption stage.
+
+        In "inline" mode messages are decrypted on the calling thread. In
+        "process" mode they are sent to a pool of processes, which scales
+        with cores regardless of the GIL. "thread" mode uses a thread pool
+        and only helps if the decrypter releases the GIL. Every pool worker
+        has its own Decrypter. The pool is created on first use, and if it
+        breaks the stage falls back to inline mode.
+
+    Attributes
+    ----------
+    mode : string
+        "inline", "thread" or "process".
+
+    workers : int
+        Number of pool workers, None for the executor default.
+
+    chunk_size : int
+        Messages sent to a pool worker at once by decrypt_many.
+
+    Methods
+    -------
+    decrypt(message):
+        Decrypt one message.
+
+    decrypt_many(messages):
+        Decrypt a list of messages.
+
+    close():
+        Shut the pool down.
+
+    """
+
+    def __init__(self, mode="inline", workers=None, chunk_size=16) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        mode : string, optional
+            "inline", "thread" or "process". The default is "inline".
+
+        workers : int, optional
+            Number of pool workers. The default is the executor default.
+
+        chunk_size : int, optional
+            Messages sent to a pool worker at once. The default is 16.
+
+        Raises
+        ------
+        ValueError
+            If the mode is unknown.
+
+        Returns
+        -------
+        None.
+
+        """
+        if mode not in ("inline", "thread", "process"):
+            raise ValueError("unknown decryption mode {m}".format(m=mode))
+        self.mode = mode
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """
+        Get the pool, creating it on first use.
+
+        Returns
+        -------
+        Executor
+            Pool, None in inline mode.
+
+        """
+        if self.mode == "inline":
+            return None
+        with self._lock:
+            if self._executor is None:
+                if self.mode == "process":
+                    # spawned, not forked, so no worker starts with a lock
+                    # another thread of the server held at the fork
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                        thread_name_prefix="decrypt")
+            return self._executor
+
+    def _fall_back_to_inline(self):
+        """
+        Stop using the pool after it broke.
+
+        Returns
+        -------
+        None.
+
+        """
+        logger.exception("decryption pool is broken, decrypting inline from now on")
+        with self._lock:
+            executor = self._executor
+            self.mode = "inline"
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _decrypt_inline(self, messages):
+        """
+        Decrypt messages on the calling thread, with its own decrypter.
+
+        Parameters
+        ----------
+        messages : list
+            Encrypted messages.
+
+        Returns
+        -------
+        list
+            (ok, message or error) per message.
+
+        """
+        if getattr(_local, "decrypter", None) is None:
+            _init_worker()
+        results = []
+        for message in messages:
+            try:
+                results.append((True, _local.decrypter.decrypt(message)))
+            except Exception as error:
+                results.append((False, error))
+        return results
+
+    def _decrypt_chunks(self, messages):
+        """
+        Decrypt messages in chunks on the pool, or inline without one.
+
+        Parameters
+        ----------
+        messages : list
+            Encrypted messages.
+
+        Returns
+        -------
+        list
+            (ok, message or error) per message.
+
+        """
+        executor = self._get_executor()
+        if executor is None:
+            return self._decrypt_inline(messages)
+        try:
+            futures = [executor.submit(decrypt_chunk, messages[i:i + self.chunk_size])
+                       for i in range(0, len(messages), self.chunk_size)]
+            return [result for future in futures for result in future.result()]
+        except (BrokenProcessPool, RuntimeError):
+            self._fall_back_to_inline()
+            return self._decrypt_inline(messages)
+
+    def decrypt(self, message):
+        """
+        Decrypt one message.
+
+        Parameters
+        ----------
+        message : dict
+            Encrypted message.
+
+        Returns
+        -------
+        dict
+            Decrypted message.
+
+        """
+        ok, result = self._decrypt_chunks([message])[0]
+        if not ok:
+            raise result
+        return result
+
+    def decrypt_many(self, messages):
+        """
+        Decrypt a list of messages.
+
+        Parameters
+        ----------
+        messages : list
+            Encrypted messages.
+
+        Returns
+        -------
+        list
+            Decrypted message, or the exception raised by its decryption, for
+            every message in the same order.
+
+        """
+        return [result for ok, result in self._decrypt_chunks(list(messages))]
+
+    def close(self):
+        """
+        Shut the pool down.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
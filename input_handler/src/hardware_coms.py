@@ -1,16 +1,34 @@
 """
 Handler.
 
-    Cloud handler of frontend communications.
-    
-Classes:
-    DbUploader
+    Cloud handler of frontend communications. Importing it sets up the
+    server and its uploader, the first request of every process starts the
+    queue, spool or shards of INGEST_MODE. The uploader itself is in
+    db_uploader.py.
     
 Functions:
+    shard_uploader() -> DbUploader
+    
+    start_ingest() -> None
+    
     home() -> Rendered Template
     
+    invalidate_product_catalog() -> dict
+    
     constant_messages() -> dict
     
+    batch_constant_messages() -> dict
+    
+    delta_messages() -> dict
+    
+    ingest_status() -> dict
+    
+    ingest_shards() -> dict
+    
+    metrics() -> string
+    
+    recompute_statuses() -> dict
+    
     initialization_messages() -> dict
     
 Author:
@@ -18,837 +36,135 @@ Author:
     
 """
 #_________________________________Libraries____________________________________
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
 from flask import Flask, render_template, request, jsonify
 import mysql.connector
 import handler_keys
-import pandas as pd
 
-from Decrypter import Decrypter
+from db_uploader import (LOG_LEVEL, LOG_PAYLOADS, LOG_SAMPLE_EVERY, MESSAGE_ERRORS, STATUS_EMPTY_THRESHOLD,
+                         STATUS_FULL_THRESHOLD, STATUS_HYSTERESIS, DbUploader)
+from ingest_queue import IngestQueue
+from spool import Spool, SpoolReplayer
+from store_shards import StoreShards
+from structured_log import log_message, setup_logging
+from metrics import METRICS
+from status_engine import recompute_fleet_statuses
+
+#__________________________________Settings____________________________________
+INGEST_MODE = getattr(handler_keys, "INGEST_MODE", "sync")
+INGEST_WORKERS = getattr(handler_keys, "INGEST_WORKERS", 4)
+INGEST_BATCH_SIZE = getattr(handler_keys, "INGEST_BATCH_SIZE", 32)
+INGEST_QUEUE_SIZE = getattr(handler_keys, "INGEST_QUEUE_SIZE", 10000)
+INGEST_COALESCE_WINDOW = getattr(handler_keys, "INGEST_COALESCE_WINDOW", 0.1)
+INGEST_TIMEOUT = getattr(handler_keys, "INGEST_TIMEOUT", 30)
+BATCH_MAX_MESSAGES = getattr(handler_keys, "BATCH_MAX_MESSAGES", 1000)
+SPOOL_DIR = getattr(handler_keys, "SPOOL_DIR", "spool")
+SPOOL_NAME = getattr(handler_keys, "SPOOL_NAME", "spool")
+SPOOL_SEGMENT_SIZE = getattr(handler_keys, "SPOOL_SEGMENT_SIZE", 64 * 1024 * 1024)
+SPOOL_FSYNC_INTERVAL = getattr(handler_keys, "SPOOL_FSYNC_INTERVAL", 0)
+SPOOL_REPLAY_BATCH = getattr(handler_keys, "SPOOL_REPLAY_BATCH", 500)
+SHARD_WORKERS = getattr(handler_keys, "SHARD_WORKERS", os.cpu_count())
+
+logger = logging.getLogger(__name__)
 
-#__________________________________Classes_____________________________________
-class DbUploader():
-    """
-    Handler.
-    
-        Handles information recieved from frontend and uploads information to 
-        database.
-        
-    Attributes
-    ----------
-    db_connection : mysql Connection
-        Connection.
-    
-    db_cursor : mysql Cursor
-        Cursor.
-    
-    decrypter : Decrypter
-        Decrypter.
-        
-    Methods
-    -------
-    close_db_connection():
-        Close connection to database.
-        
-    open_db_connection():
-        Open connection to database.
-        
-    decypher(message):
-        Decypher given message.
-        
-    parse_query_result(result_columns):
-        Format into dataframe.
-    
-    two_cols_df_to_dict(df, key_column_name, value_column_name):
-        Transform dataframe to dictionary.
-    
-    create_field_equals_or_chain_query(field:str, values_to_equal:list):
-        Chain queries with ORs.
-        
-    fetch_product_ids(products:list):
-        Get id of product from database.
-    
-    fetch_prev_stock(store_id):
-        Get stock of id from database.
-        
-    fetch_min_stock(store_id):
-        Get minimum stock of id from database.
-        
-    fetch_max_stock(store_id):
-        Get maximum stock of id from database.
-        
-    fetch_store_id(store_name, store_status, store_latitude, store_longitude, store_state, store_municipality, store_zip_code, store_address)
-        Get store id given de store information.
-        
-    fetch_store_status(store_id):
-        Get status of id from database.
-    
-    register_new_store(store_name, store_status, store_latitude, store_longitude, store_state, store_municipality, store_zip_code, store_address)
-        Register new store with the given information.
-    
-    register_new_inventory(product_id, store_id, stock, min_stock, max_stock):
-        Register new inventory with the given data.
-        
-    register_new_sale(product_id, store_id, timestamp):
-        Register new sale with the given information.
-        
-    create_notification(id_store, new_status):
-        Register notification with the given information.
-        
-    update_inventory(store_id, product_id, new_stock):
-        Update inventory of store.
-        
-    update_store_status(store_id, status):
-        Update status of store.
-    
-    handle_change_on_status(store_id, mins_stock, maxs_stock, stocks):
-        Change status if necessary.
-    
-    handle_cahanges_on_store_products(prev:dict, curr:dict, id_store:str):
-        Change store products if necessary.
-        
-    handle_changes_on_store_stock(prev, curr, id_store:str, timestamp:str):
-        Change store stock if necessary.
-        
-    handle_constant_message(message):
-        Recieve and handle constant messages.
-        
-    handle_initialization_message(message):
-        Recieve and handle initialization messages.
-    
+#_________________________________Functions____________________________________
+def shard_uploader():
     """
+    Get the uploader of a shard process.
     
-    def __init__(self) -> None:
-        """
-        Construct attributes of the class.
-
-        Returns
-        -------
-        None
-            DESCRIPTION.
-
-        """
-        self.db_connection = None
-        self.db_cursor = None
-        self.decrypter = Decrypter()
-        
-    def close_db_connection(self):
-        """
-        Close db connection.
-
-        Returns
-        -------
-        None.
-
-        """
-        self.db_cursor.close()
-        self.db_connection.close()
-
-    def open_db_connection(self):
-        """
-        Open db connection.
-
-        Returns
-        -------
-        None.
-
-        """
-        self.db_connection = mysql.connector.connect(host=handler_keys.DB_HOST, user=handler_keys.DB_USER, passwd=handler_keys.DB_PASSWORD, database=handler_keys.DB_NAME)
-        self.db_cursor = self.db_connection.cursor()
-
-    # =============================== HELPERS ===============================
-    
-    def decypher(self, message):
-        """
-        Decyoher message.
-
-        Parameters
-        ----------
-        message : dict
-            Message to decypher.
-
-        Returns
-        -------
-        dict
-            Message dechyphered.
-
-        """
-        return self.decrypter.decrypt(message)
-    
-    def parse_query_result(self, result_columns):
-        """
-        Buil dataframe.
-
-        Parameters
-        ----------
-        result_columns : list
-            Columns expected.
-
-        Returns
-        -------
-        df : pandas dataframe
-            Dataframe.
-
-        """
-        df= pd.DataFrame(columns = result_columns)
-        for register in self.db_cursor:
-            data = {}
-            for i in range(len(result_columns)):
-                data[result_columns[i]] = register[i]
-            new_row = pd.DataFrame(data, index=[0])
-            df = pd.concat([df, new_row]).reset_index(drop=True)
-        return df
-
-    def two_cols_df_to_dict(self, df, key_column_name, value_column_name):
-        """
-        Return dataframe as dictionary.
-
-        Parameters
-        ----------
-        df : pandas Dataframe
-            Dataframe.
-            
-        key_column_name : string
-            Name of key.
-            
-        value_column_name : string
-            Value.
-
-        Returns
-        -------
-        new_dict : dict
-            Dictionary.
-
-        """
-        new_dict = {}
-        for i in df.index:
-            new_dict[df[key_column_name][i]] = df[value_column_name][i]        
-        return new_dict
-
-    def create_field_equals_or_chain_query(self, field:str, values_to_equal:list):
-        """
-        Build query.
-        
-            This method generates a chain of ORs to query a field with several 
-            values, i.e. 'Inventory.id_product = val1 OR Inventory.id_product = 
-            val2 OR Inventory.id_product = val3' 
-
-        Parameters
-        ----------
-        field : str
-            Field to fill.
-            
-        values_to_equal : list
-            Values to fill with.
-
-        Returns
-        -------
-        result : string
-            Query.
-
-        """
-        result = ""
-        values_len = len(values_to_equal)
-        for i in range(values_len):
-            result += field + "=" + "'{v}'".format(v=values_to_equal[i])
-            if i < values_len-1:
-                result += " OR "
-        return result
-
-    # =============================== FETCH DATA FROM DB ===============================
-
-    def fetch_product_ids(self, products:list)->dict:
-        """
-        Get products ids from database.
-
-        Parameters
-        ----------
-        products : list
-            Products to get id from.
-
-        Returns
-        -------
-        dict
-            Products to ids dictionary.
-
-        """
-        products_query = self.create_field_equals_or_chain_query("Product.ean", products)
-        product_ids_query = "SELECT Product.ean, Product.id_product FROM Product WHERE {q}".format(q = products_query)
-
-        self.open_db_connection()
-        self.db_cursor.execute(product_ids_query)
-        product_ids_result = self.parse_query_result(result_columns=["product_ean", "product_id"])
-        product_ids_result = self.two_cols_df_to_dict(product_ids_result, "product_ean", "product_id")
-        self.close_db_connection()
-        return product_ids_result
-
-    def fetch_prev_stock(self, store_id):
-        """
-        Get previous stock of store from database.
-
-        Parameters
-        ----------
-        store_id : string
-            Id of store.
-
-        Returns
-        -------
-        result : dict
-            Previous stock.
-
-        """
-        self.open_db_connection()
-        fetch_stock_query = """SELECT Product.ean, Inventory.stock
-        FROM Inventory 
-        INNER JOIN Product ON Inventory.id_product=Product.id_product 
-        WHERE Inventory.id_store = '{store_id}'
-        """.format(store_id = store_id)
-        self.db_cursor.execute(fetch_stock_query)
-        result = self.parse_query_result(result_columns=["product_ean", "product_stock"])
-        result = self.two_cols_df_to_dict(result, "product_ean", "product_stock")
-        self.close_db_connection()
-        return result
-    
-    def fetch_min_stock(self, store_id):
-        """
-        Get minimum stock of store.
-
-        Parameters
-        ----------
-        store_id : string
-            Id of store.
-
-        Returns
-        -------
-        result : dict
-            Minimum stock of store.
-
-        """
-        self.open_db_connection()
-        fetch_min_stock_query = """SELECT Product.ean, Inventory.min_stock
-        FROM Inventory
-        INNER JOIN Product ON Inventory.id_product = Product.id_product
-        WHERE Inventory.id_store = '{store_id}'
-        """.format(store_id = store_id)
-        self.db_cursor.execute(fetch_min_stock_query)
-        result = self.parse_query_result(result_columns=["product_ean", "product_min_stock"])
-        result = self.two_cols_df_to_dict(result, "product_ean", "product_min_stock")
-        self.close_db_connection()
-        return result
-        
-    def fetch_max_stock(self, store_id):
-        """
-        Get maximum stock of store.
-
-        Parameters
-        ----------
-        store_id : string
-            Id of store.
-
-        Returns
-        -------
-        result : dict
-            Maximum stock of store.
-
-        """
-        self.open_db_connection()
-        fetch_max_stock_query = """SELECT Product.ean, Inventory.max_stock
-        FROM Inventory
-        INNER JOIN Product ON Inventory.id_product = Product.id_product
-        WHERE Inventory.id_store = '{store_id}'
-        """.format(store_id = store_id)
-        self.db_cursor.execute(fetch_max_stock_query)
-        result = self.parse_query_result(result_columns=["product_ean", "product_min_stock"])
-        result = self.two_cols_df_to_dict(result, "product_ean", "product_min_stock")
-        self.close_db_connection()
-        return result
-        
-    
-    def fetch_store_id(self, store_name, store_status, store_latitude, store_longitude, store_state, store_municipality, store_zip_code, store_address):        
-        """
-        Get id of store given the information of the store.
-
-        Parameters
-        ----------
-        store_name : string
-            Name of store.
-            
-        store_status : string
-            Status of store.
-            
-        store_latitude : string
-            Latitude of store.
-            
-        store_longitude : string
-            Longitude of store.
-            
-        store_state : string
-            State of store.
-            
-        store_municipality : string
-            Municipality of store.
-            
-        store_zip_code : string
-            Zip code of store.
-            
-        store_address : string
-            Address of store.
-
-        Returns
-        -------
-        store_ids_result : string
-            Id of store.
-
-        """
-        store_id_query = """SELECT Store.name, Store.id_store 
-            FROM Store 
-            WHERE (Store.name='{store_name}' AND
-            Store.status={store_status} AND
-            Store.latitude >= {store_latitude}-0.0001 AND Store.latitude <= {store_latitude}+0.0001 AND
-            Store.longitude >= {store_longitude}-0.0001 AND Store.longitude <= {store_longitude}+0.0001 AND
-            Store.state='{store_state}' AND
-            Store.municipality='{store_municipality}' AND
-            Store.zip_code={store_zip_code} AND
-            Store.address='{store_address}')
-            """.format(
-                store_name=store_name,
-                store_status=store_status,
-                store_latitude=store_latitude,
-                store_longitude=store_longitude,
-                store_state=store_state,
-                store_municipality=store_municipality,
-                store_zip_code=store_zip_code,
-                store_address=store_address)
-        self.open_db_connection()
-        self.db_cursor.execute(store_id_query)
-        store_ids_result = self.parse_query_result(result_columns=["store_name", "store_id"])
-        print("store id query is:")
-        print(store_id_query)
-        store_ids_result = self.two_cols_df_to_dict(store_ids_result, "store_name", "store_id")
-        self.close_db_connection()
-        return store_ids_result
-    
-    def fetch_store_status(self, store_id):
-        """
-        Get store status from store.
-
-        Parameters
-        ----------
-        store_id : string
-            Id of store.
-
-        Returns
-        -------
-        int
-            Status.
-
-        """
-        store_status_query = """SELECT Store.name, Store.status FROM Store 
-                                WHERE Store.id_store = {store_id}""".format(
-                                store_id = store_id)
-        self.open_db_connection()
-        self.db_cursor.execute(store_status_query)
-        store_status = self.parse_query_result(result_columns = ["store_name", 
-                                                                 "store_status"])
-        store_status_result = self.two_cols_df_to_dict(store_status, 
-                                                       "store_name", "store_status")
-        self.close_db_connection()
-        try:
-            return list(store_status_result.values())[0]
-        except IndexError:
-            # return a default status
-            return 2
-        
-        
-    # =============================== GENERATE NEW REGISTERS ON DB ===============================
-
-    def register_new_store(self, store_name, store_status, store_latitude, store_longitude, store_state, store_municipality, store_zip_code, store_address):        
-        """
-        Register new store on database.
-
-        Parameters
-        ----------
-        store_name : string
-            Name of store.
-            
-        store_status : string
-            Status of store.
-            
-        store_latitude : string
-            Latitude of store.
-            
-        store_longitude : string
-            Longitude of store.
-            
-        store_state : string
-            State of store.
-            
-        store_municipality : string
-            Municipality of store.
-            
-        store_zip_code : string
-            Zip code of store.
-            
-        store_address : string
-            Address of store.
-
-        Returns
-        -------
-        None.
-
-        """
-        register_store_query = """INSERT INTO Store(name, status, latitude, longitude, state, municipality, zip_code, address)
-            VALUES ('{store_name}', {store_status}, {store_latitude}, {store_longitude}, '{store_state}', '{store_municipality}', {store_zip_code}, '{store_address}')
-            """.format(
-            store_name=store_name,
-            store_status=store_status,
-            store_latitude=store_latitude,
-            store_longitude=store_longitude,
-            store_state=store_state,
-            store_municipality=store_municipality,
-            store_zip_code=store_zip_code,
-            store_address=store_address)
-        self.open_db_connection()
-        self.db_cursor.execute(register_store_query)
-        self.db_connection.commit()
-        self.close_db_connection()
-
-    def register_new_inventory(self, product_id, store_id, stock, min_stock, max_stock):
-        """
-        Register new inventory of store.
-
-        Parameters
-        ----------
-        product_id : string
-            Id of product.
-            
-        store_id : string
-            Id of store.
-            
-        stock : int
-            Actual stock of product.
-            
-        min_stock : int
-            Minimum stock of product.
-            
-        max_stock : int
-            Maximum stock of product.
-
-        Returns
-        -------
-        None.
-
-        """
-        inventary_creation_query = """INSERT INTO Inventory(id_product, id_store, stock, min_stock, max_stock)
-            VALUES ({product_id}, {store_id}, {stock}, {min_stock}, {max_stock})""".format(
-            product_id=product_id,
-            store_id=store_id,
-            stock=stock,
-            min_stock=min_stock,
-            max_stock=max_stock)        
-        self.open_db_connection()
-        self.db_cursor.execute(inventary_creation_query)
-        self.db_connection.commit()
-        self.close_db_connection()
-
-    def register_new_sale(self, product_id, store_id, timestamp):
-        """
-        Register new sale of product in store.
-
-        Parameters
-        ----------
-        product_id : string
-            Id of product.
-            
-        store_id : string
-            Id of store.
-            
-        timestamp : long
-            Timestamp.
-
-        Returns
-        -------
-        None.
-
-        """
-        register_sale_query = "INSERT INTO Sale(id_product, id_store, timestamp) VALUES ({product_id}, {store_id}, {t})".format(product_id=product_id, store_id=store_id, t=timestamp)
-        self.open_db_connection()
-        self.db_cursor.execute(register_sale_query)
-        self.db_connection.commit()
-        self.close_db_connection()
-    
-    def create_notification(self, id_store, new_status):
-        """
-        Register notification in database.
-
-        Parameters
-        ----------
-        id_store : string
-            Id of store.
-            
-        new_status : int
-            New status.
-
-        Returns
-        -------
-        None.
-
-        """
-        notification_creation_query = """INSERT INTO Notification(id_store, new_status)
-                                         VALUES({id_store}, {new_status})""".format(
-                                             id_store = id_store, 
-                                             new_status = new_status)
-        self.open_db_connection()
-        self.db_cursor.execute(notification_creation_query)
-        self.db_connection.commit()
-        self.close_db_connection()
-    
-    # =============================== UPDATE REGISTERS ON DB ===============================
-
-    def update_inventory(self, store_id, product_id, new_stock):
-        """
-        Update inventory of store in database.
-
-        Parameters
-        ----------
-        store_id : string
-            Id of store.
-            
-        product_id : string
-            Id of product.
-            
-        new_stock : int
-            New stock.
-
-        Returns
-        -------
-        None.
-
-        """
-        inventory_update_query = "UPDATE Inventory SET Inventory.stock={new_stock} WHERE Inventory.id_store={store_id} AND Inventory.id_product={product_id}".format(new_stock=new_stock, store_id=store_id, product_id=product_id)
-        self.open_db_connection()
-        self.db_cursor.execute(inventory_update_query)
-        self.db_connection.commit()
-        self.close_db_connection()
-
-    def update_store_status(self, store_id, status):
-        """
-        Update store status.
-
-        Parameters
-        ----------
-        store_id : string
-            Id of store.
-            
-        status : int
-            New status.
-
-        Returns
-        -------
-        None.
-
-        """
-        status_update_query = "UPDATE Store SET Store.status = {status} WHERE Store.id_store = {store_id}".format(status = status, store_id = store_id)
-        self.open_db_connection()
-        self.db_cursor.execute(status_update_query)
-        self.db_connection.commit()
-        self.close_db_connection()
-    
-    # =============================== MAIN HANDLERS ===============================
-    
-    def handle_change_on_status(self, store_id, mins_stock, maxs_stock, stocks):
-        """
-        Handle any change on status.
-
-        Parameters
-        ----------
-        store_id : string
-            If of store.
-            
-        mins_stock : list
-            Minimum stocks.
-            
-        maxs_stock : list
-            Maximum stocks.
-            
-        stocks : list
-            Stocks.
-
-        Returns
-        -------
-        None.
-
-        """
-        curr_store_status = self.fetch_store_status(store_id)
-        
-        norm = []
-        
-        current_products = list(stocks.keys())
-        current_products = [i for i in current_products if i not in ["0"]] # we delete empty spaces from curent products
-        for label in current_products:
-            if not (maxs_stock[label] - mins_stock[label]) == 0:
-                norm.append((stocks[label] - mins_stock[label])/(maxs_stock[label] - mins_stock[label]))
-        
-        if len(norm) > 0:
-            mean = sum(norm) / len(norm)
-        else:
-            mean = 0
-        
-        if mean > 0.75:
-            new_status = 1
-        elif mean > 0.25:
-            new_status = 2
-        else:
-            new_status = 3
-        
-        if curr_store_status != new_status:
-            self.update_store_status(store_id = store_id, status = new_status)
-            self.create_notification(id_store = store_id,
-                                     new_status = new_status)
-        
-    def handle_cahanges_on_store_products(self, prev:dict, curr:dict, id_store:str):
-        """
-        Handle any changes on store products.
-
-        Parameters
-        ----------
-        prev : dict
-            Previous stocks.
-            
-        curr : dict
-            Current stocks.
-            
-        id_store : str
-            Id of store.
-
-        Returns
-        -------
-        None.
-
-        """
-        # check if new products exist on the new input and if
-        # they do we create a new inventory table for each with defaul max stock 
-        # and min stock values
-        products_only_in_curr = [ product for product in curr.keys() if product not in prev.keys() ]
-        products_only_in_curr = [i for i in products_only_in_curr if i not in ["0"]] # we delete empty spaces from curent products
-        if len(products_only_in_curr) == 0:
-            return
-        # if there are products in current stock that are not in prev stock we fetch the product ids for each        
-        product_ids_result = self.fetch_product_ids(products_only_in_curr)
+        Every shard process imports this module on its own, and handles the
+        messages of its stores with the uploader of its copy.
 
-        # Once we fetch the product ids of products only in current stock we create a new inventary for each of this products
+    Returns
+    -------
+    DbUploader
+        Uploader of this process.
 
-        for product in products_only_in_curr:
-            print("creating new inventary register for {p}".format(p=product))
-            self.register_new_inventory(product_ids_result[product], id_store, curr[product], 0, 0) 
-            # TODO: change the min max stock args to non existing product flag       
-    
-    def handle_changes_on_store_stock(self, prev, curr, id_store:str, timestamp:str):
-        """
-        Handle any change on store stock
-
-        Parameters
-        ----------
-        prev : dict
-            Previous stocks.
-            
-        curr : dict
-            Current stocks.
-            
-        id_store : str
-            Id of store.
-            
-        timestamp : str
-            Timestamp.
-
-        Returns
-        -------
-        None.
-
-        """
-        current_products = list(curr.keys())
-        current_products = [i for i in current_products if i not in ["0"]] # we delete empty spaces from curent products 
-        product_ids = self.fetch_product_ids(current_products)
-        
-        for product in current_products:
-            prev_vs_curr_stock = prev[product] - curr[product]
-            product_id = product_ids[product]
-            product_stock = curr[product]
-            
-            
-            if prev_vs_curr_stock > 0:
-                # update inventory
-                print("updating inventory for {p}".format(p=product))
-                self.update_inventory(store_id=id_store, product_id=product_id, new_stock=product_stock)
-                #register sale
-                print("registering a sell for {p}".format(p=product))
-                self.register_new_sale(product_id=product_id, store_id=id_store, timestamp=timestamp)
-            elif prev_vs_curr_stock < 0:
-                # update inventory                
-                print("updating inventory for {p}".format(p=product))
-                self.update_inventory(store_id=id_store, product_id=product_id, new_stock=product_stock) 
-        
-
-    def handle_constant_message(self, message): 
-        """
-        Handle any constant messages.
-
-        Parameters
-        ----------
-        message : dict
-            Message.
-
-        Returns
-        -------
-        None.
-
-        """
-        message = self.decypher(message)
-        print(message)
-        prev_stock = self.fetch_prev_stock(store_id=message['store_id'])
-        self.handle_cahanges_on_store_products(prev_stock, message['content_count'], message['store_id'])
-        prev_stock = self.fetch_prev_stock(store_id=message['store_id'])
-        self.handle_changes_on_store_stock(prev_stock, message['content_count'], message['store_id'], message['timestamp'])
-        mins = self.fetch_min_stock(store_id = message["store_id"])
-        maxs = self.fetch_max_stock(store_id = message["store_id"])
-        self.handle_change_on_status(store_id = message["store_id"], mins_stock = mins, maxs_stock = maxs, stocks = message["content_count"])
-        
-    def handle_initialization_message(self, message):
-        """
-        Handle initialization message.
-
-        Parameters
-        ----------
-        message : dict
-            Message.
-
-        Returns
-        -------
-        store_id : string
-            Id of store.
-
-        """
-        message = self.decypher(message)
-        print(message)
-        self.register_new_store(message["store_name"], 1, message["store_latitude"], message["store_longitude"], message["store_state"], message["store_municipality"], message["store_zip_code"], message["store_address"])
-        store_products = list(message["store_curr_stock"].keys())
-        store_products_ids = self.fetch_product_ids(store_products)
-        store_id = self.fetch_store_id(message["store_name"], 1, message["store_latitude"], message["store_longitude"], message["store_state"], message["store_municipality"], message["store_zip_code"], message["store_address"])
-        store_id = store_id[message["store_name"]]
-        print("fetch store_id result is:")
-        print(store_products_ids)
-        print("fetch store id result is:")
-        print(store_id)
-        for product in store_products:
-            self.register_new_inventory(store_products_ids[product], store_id, message["store_curr_stock"][product], message["store_min_stocks"][product], message["store_max_stocks"][product])
-        return store_id
+    """
+    return uploader
 
 #_________________________________Variables____________________________________
+setup_logging(level=LOG_LEVEL, sample_every=LOG_SAMPLE_EVERY)
+
 app = Flask(__name__)
 app.secret_key = handler_keys.FLASK_APP_KEY
 
 uploader = DbUploader()
 
+# started by start_ingest in the process serving the requests
+ingest_queue = None
+spool = None
+spool_replayer = None
+store_shards = None
+_started_pid = None
+_start_lock = threading.Lock()
+
 #_________________________________Functions____________________________________
+@app.before_request
+def start_ingest():
+    """
+    Start the ingest of this process before its first request.
+    
+        Servers like uWSGI or gunicorn import the app once and fork their
+        workers from that process. A forked worker has none of the threads
+        of its parent and must not share its database connections, so
+        nothing is started on import. The first request of every process
+        preloads the product catalog and starts the queue, spool or shards of
+        INGEST_MODE. Shard processes never serve requests, so they start
+        nothing. The spool directory is locked by one process, the
+        requests of any other are answered with 503 until it is free.
+
+    Returns
+    -------
+    None, or a 503 response if another process uses the spool.
+
+    """
+    global ingest_queue, spool, spool_replayer, store_shards, _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        try:
+            uploader.catalog.refresh()
+        except mysql.connector.Error as error:
+            # the catalog is loaded on the first lookup instead
+            logger.warning("could not preload product catalog: {e}".format(e=error))
+        if INGEST_MODE == "queue":
+            # every worker owns an uploader, and with it the cached
+            # inventories of the stores routed to it, but they share the
+            # connection pool and catalog
+            ingest_queue = IngestQueue([DbUploader(db_pool=uploader.db_pool, decryption=uploader.decryption, catalog=uploader.catalog)
+                                        for _ in range(INGEST_WORKERS)],
+                                       batch_size=INGEST_BATCH_SIZE,
+                                       max_depth=INGEST_QUEUE_SIZE,
+                                       coalesce_window=INGEST_COALESCE_WINDOW)
+            ingest_queue.start()
+        elif INGEST_MODE == "spool":
+            # the replayer owns the cached inventories, like a queue worker
+            try:
+                spool = Spool(SPOOL_DIR, segment_size=SPOOL_SEGMENT_SIZE, fsync_interval=SPOOL_FSYNC_INTERVAL)
+            except RuntimeError as error:
+                logger.error("spool mode takes a single server process: {e}".format(e=error))
+                return jsonify({"error": "spool is used by another process"}), 503
+            spool_replayer = SpoolReplayer(spool, DbUploader(db_pool=uploader.db_pool, decryption=uploader.decryption, catalog=uploader.catalog),
+                                           name=SPOOL_NAME, batch_size=SPOOL_REPLAY_BATCH, skip_errors=MESSAGE_ERRORS)
+            spool_replayer.start()
+        elif INGEST_MODE == "shards":
+            store_shards = StoreShards(shard_uploader, SHARD_WORKERS,
+                                       settings={name: getattr(handler_keys, name) for name in dir(handler_keys) if name.isupper()},
+                                       batch_size=INGEST_BATCH_SIZE,
+                                       max_depth=INGEST_QUEUE_SIZE,
+                                       coalesce_window=INGEST_COALESCE_WINDOW)
+            store_shards.start()
+        _started_pid = os.getpid()
+
 @app.route('/', methods = ['GET'])
 def home():
     """
@@ -862,10 +178,36 @@ def home():
     """
     return render_template('home_template.html')
 
+@app.route('/invalidate_product_catalog', methods=['POST'])
+def invalidate_product_catalog():
+    """
+    Drop the cached product catalog so it is reloaded on the next message.
+
+        Queue workers and the spool replayer share the catalog of the
+        server, every shard process has its own and is told to drop it.
+
+    Returns
+    -------
+    dict
+        Dictionary.
+
+    """
+    uploader.invalidate_catalog()
+    if store_shards is not None:
+        store_shards.broadcast("invalidate_catalog")
+    return jsonify({})
+
 @app.route('/constant_messages', methods=['GET', 'POST'])
 def constant_messages():    
     """
     Recieve constant messages.
+    
+        With INGEST_MODE set to "queue" the message is only decyphered,
+        checked and queued, and the response is sent with status 202 before
+        it reaches the database. With INGEST_MODE set to "spool" it is
+        appended to the spool instead, and the response waits until it is on
+        disk. With INGEST_MODE set to "shards" it is handed to the shard
+        process of its store, and the response waits until it is applied.
 
     Returns
     -------
@@ -874,13 +216,254 @@ def constant_messages():
 
     """
     content = request.json    
-    uploader.handle_constant_message(content)
-    print("========================================================")
-    print("printing data fetched on server:")
-    print(content)
-    print("")
+    if ingest_queue is not None:
+        message = uploader.decypher(content)
+        try:
+            uploader.validate_constant_message(message)
+        except ValueError as error:
+            return jsonify({"error": str(error)}), 400
+        try:
+            ingest_queue.submit(message["store_id"], message)
+            log_message(logger, "queued constant message", message, payloads=LOG_PAYLOADS)
+        except queue.Full:
+            return jsonify({"error": "ingest queue is full"}), 503
+        return jsonify({}), 202
+    if spool is not None:
+        message = uploader.decypher(content)
+        try:
+            uploader.validate_constant_message(message)
+        except ValueError as error:
+            return jsonify({"error": str(error)}), 400
+        try:
+            spool.append(message, timeout=INGEST_TIMEOUT)
+            log_message(logger, "spooled constant message", message, payloads=LOG_PAYLOADS)
+        except OSError:
+            logger.exception("could not spool constant message", extra={"store_id": message["store_id"]})
+            return jsonify({"error": "spool is not writable"}), 503
+        return jsonify({}), 202
+    if store_shards is not None:
+        message = uploader.decypher(content)
+        try:
+            uploader.validate_constant_message(message)
+        except ValueError as error:
+            return jsonify({"error": str(error)}), 400
+        try:
+            future = store_shards.submit(message["store_id"], message)
+        except queue.Full:
+            return jsonify({"error": "shard is full"}), 503
+        try:
+            error = future.result(INGEST_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            return jsonify({"error": "shard did not answer in time"}), 503
+        if error is not None:
+            return jsonify({"error": error}), 500
+        return jsonify({})
+    try:
+        uploader.handle_constant_message(content)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
     return jsonify({})
 
+@app.route('/batch_constant_messages', methods=['POST'])
+def batch_constant_messages():
+    """
+    Recieve a batch of constant messages.
+    
+        The body is a list of encrypted constant messages from one or many
+        stores, oldest first. Messages of each store are applied in order,
+        and the whole batch shares one connection, transaction and set of
+        bulk writes. In queue and spool mode the messages are queued or
+        spooled instead, and in shards mode every shard applies the messages
+        of its stores.
+
+    Returns
+    -------
+    dict
+        One result per message, in the same order.
+
+    """
+    content = request.json
+    if not isinstance(content, list):
+        return jsonify({"error": "body is not a list of messages"}), 400
+    if len(content) > BATCH_MAX_MESSAGES:
+        return jsonify({"error": "more than {n} messages".format(n=BATCH_MAX_MESSAGES)}), 413
+    results = [None] * len(content)
+    messages = []
+    positions = []
+    for i, message in enumerate(uploader.decypher_many(content)):
+        try:
+            if isinstance(message, Exception):
+                raise message
+            uploader.validate_constant_message(message)
+        except Exception as error:
+            results[i] = {"status": "error", "error": str(error)}
+            continue
+        messages.append(message)
+        positions.append(i)
+    if ingest_queue is not None:
+        for i, message in zip(positions, messages):
+            try:
+                ingest_queue.submit(message["store_id"], message)
+                results[i] = {"status": "queued"}
+            except queue.Full:
+                results[i] = {"status": "error", "error": "ingest queue is full"}
+        return jsonify({"results": results}), 202
+    if spool is not None:
+        try:
+            spool.append_many(messages, timeout=INGEST_TIMEOUT)
+            status = {"status": "queued"}
+        except OSError:
+            logger.exception("could not spool batch of constant messages", extra={"messages": len(messages)})
+            status = {"status": "error", "error": "spool is not writable"}
+        for i in positions:
+            results[i] = dict(status)
+        return jsonify({"results": results}), 202
+    if store_shards is not None:
+        futures = []
+        for i, message in zip(positions, messages):
+            try:
+                futures.append((i, store_shards.submit(message["store_id"], message)))
+            except queue.Full:
+                results[i] = {"status": "error", "error": "shard is full"}
+        deadline = time.monotonic() + INGEST_TIMEOUT
+        for i, future in futures:
+            try:
+                error = future.result(max(deadline - time.monotonic(), 0))
+            except concurrent.futures.TimeoutError:
+                error = "shard did not answer in time"
+            except Exception as error_raised:
+                error = str(error_raised)
+            results[i] = {"status": "ok"} if error is None else {"status": "error", "error": error}
+        return jsonify({"results": results})
+    errors = uploader.apply_constant_messages(messages) if messages else []
+    for i, error in zip(positions, errors):
+        results[i] = {"status": "ok"} if error is None else {"status": "error", "error": error}
+    return jsonify({"results": results})
+
+@app.route('/delta_messages', methods=['POST'])
+def delta_messages():
+    """
+    Recieve delta messages.
+    
+        Answers with the new version of the store, which the device sends back
+        as base_version with its next changes, or with status 409 when the
+        device has to send a full resync.
+
+    Returns
+    -------
+    dict
+        Dictionary.
+
+    """
+    message = uploader.decypher(request.json)
+    try:
+        uploader.validate_delta_message(message)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    if ingest_queue is not None:
+        # the worker that owns the store has its current state
+        try:
+            future = ingest_queue.run(message["store_id"], lambda worker_uploader: worker_uploader.apply_delta_message(message))
+        except queue.Full:
+            return jsonify({"error": "ingest queue is full"}), 503
+        try:
+            version = future.result(INGEST_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            return jsonify({"error": "ingest worker did not answer in time"}), 503
+    elif store_shards is not None:
+        try:
+            future = store_shards.run(message["store_id"], "apply_delta_message", message)
+        except queue.Full:
+            return jsonify({"error": "shard is full"}), 503
+        try:
+            version = future.result(INGEST_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            return jsonify({"error": "shard did not answer in time"}), 503
+    elif spool_replayer is not None:
+        # the spooled messages of the store are applied first
+        version = spool_replayer.run(lambda replay_uploader: replay_uploader.apply_delta_message(message))
+    else:
+        version = uploader.apply_delta_message(message)
+    if version is None:
+        return jsonify({"resync": True}), 409
+    return jsonify({"version": version})
+
+@app.route('/ingest_status', methods=['GET'])
+def ingest_status():
+    """
+    Report the state of the ingest queue, spool or shards.
+
+    Returns
+    -------
+    dict
+        Ingest mode and number of queued messages, plus the messages not
+        replayed yet and the bytes on disk in spool mode, or the number of
+        shards in shards mode.
+
+    """
+    queue_depth = ingest_queue.depth() if ingest_queue is not None else 0
+    if store_shards is not None:
+        queue_depth = store_shards.depth()
+    status = {"mode": INGEST_MODE, "queue_depth": queue_depth}
+    if store_shards is not None:
+        status["shards"] = store_shards.shards
+    if spool is not None:
+        status["spool_pending"] = spool_replayer.pending()
+        status["spool_bytes"] = spool.size()
+    return jsonify(status)
+
+@app.route('/ingest_shards', methods=['POST'])
+def ingest_shards():
+    """
+    Change the number of shard processes.
+    
+        The body holds the new number of shards in "workers". Only the stores
+        of the shards added or removed move.
+
+    Returns
+    -------
+    dict
+        Number of shards.
+
+    """
+    if store_shards is None:
+        return jsonify({"error": "INGEST_MODE is not shards"}), 400
+    workers = (request.json or {}).get("workers")
+    if not isinstance(workers, int) or isinstance(workers, bool) or workers < 1:
+        return jsonify({"error": "workers is not a positive integer"}), 400
+    try:
+        store_shards.resize(workers, timeout=INGEST_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        return jsonify({"error": "shards did not finish in time, not resized"}), 503
+    return jsonify({"shards": store_shards.shards})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Export the metrics of the handler.
+
+    Returns
+    -------
+    string
+        Metrics in the Prometheus text format.
+
+    """
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route('/recompute_statuses', methods=['POST'])
+def recompute_statuses():
+    """
+    Recompute the status of every store.
+
+    Returns
+    -------
+    dict
+        Number of stores whose status changed.
+
+    """
+    changed = recompute_fleet_statuses(uploader, STATUS_FULL_THRESHOLD, STATUS_EMPTY_THRESHOLD, band=STATUS_HYSTERESIS)
+    return jsonify({"changed": len(changed)})
+
 @app.route('/initaialization_messages', methods=['GET', 'POST'])
 def initialization_messages():
     """
@@ -894,10 +477,6 @@ def initialization_messages():
     """
     content = request.json    
     store_id = uploader.handle_initialization_message(content)
-    print("========================================================")
-    print("printing data fetched on server:")
-    print(content)
-    print("")
     return jsonify({"store_id":store_id})
 
 #____________________________________Main______________________________________
@@ -0,0 +1,257 @@
+"""
+Ingest queue.
+
+    Background processing of device messages, so the HTTP request of a device
+    does not wait for the database.
+
+Classes:
+    IngestQueue
+
+"""
+#_________________________________Libraries____________________________________
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+import zlib
+
+#__________________________________Variables___________________________________
+logger = logging.getLogger(__name__)
+
+#__________________________________Classes_____________________________________
+class IngestQueue():
+    """
+    Ingest queue.
+
+        Every worker thread owns a queue and a DbUploader. Messages of a store
+        always go to the same worker, so they are processed in the order they
+        arrived and the worker's cache holds the state of the store. Workers take the messages waiting on their queue
+        in micro-batches of up to ``batch_size`` messages, waiting up to
+        ``coalesce_window`` seconds after the first one for more to arrive,
+        so bursts of a store end up in the same batch.
+
+    Attributes
+    ----------
+    uploaders : list
+        One DbUploader per worker.
+
+    batch_size : int
+        Maximum number of messages handled together.
+
+    coalesce_window : float
+        Seconds a worker waits to fill a batch.
+
+    Methods
+    -------
+    start():
+        Start the worker threads.
+
+    submit(store_id, message):
+        Queue a message.
+
+    run(store_id, function):
+        Queue a function on the worker of a store.
+
+    depth():
+        Get the number of messages waiting.
+
+    stop(timeout):
+        Finish the queued messages and stop the workers.
+
+    """
+
+    def __init__(self, uploaders, batch_size=32, max_depth=10000, coalesce_window=0) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        uploaders : list
+            One DbUploader per worker.
+
+        batch_size : int, optional
+            Maximum number of messages handled together. The default is 32.
+
+        max_depth : int, optional
+            Maximum number of messages waiting on each worker. The default is
+            10000.
+
+        coalesce_window : float, optional
+            Seconds a worker waits to fill a batch. The default is 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.uploaders = uploaders
+        self.batch_size = batch_size
+        self.coalesce_window = coalesce_window
+        self._queues = [queue.Queue(maxsize=max_depth) for _ in uploaders]
+        self._threads = []
+
+    def start(self):
+        """
+        Start the worker threads.
+
+        Returns
+        -------
+        None.
+
+        """
+        for i, uploader in enumerate(self.uploaders):
+            thread = threading.Thread(target=self._work, args=(self._queues[i], uploader),
+                                      name="ingest-worker-{i}".format(i=i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def worker_for(self, store_id):
+        """
+        Get the worker that handles a store.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        int
+            Index of the worker.
+
+        """
+        return zlib.crc32(str(store_id).encode()) % len(self._queues)
+
+    def submit(self, store_id, message):
+        """
+        Queue a message.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of the store that sent the message.
+
+        message : dict
+            Decyphered message.
+
+        Raises
+        ------
+        queue.Full
+            If the worker of the store is too far behind.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._queues[self.worker_for(store_id)].put_nowait(message)
+
+    def run(self, store_id, function):
+        """
+        Queue a function on the worker of a store.
+        
+            The function runs after the messages of the store that are
+            already queued, and is given the DbUploader of the worker.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        function : callable
+            Takes a DbUploader.
+
+        Raises
+        ------
+        queue.Full
+            If the worker of the store is too far behind.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Result of the function.
+
+        """
+        future = Future()
+        self._queues[self.worker_for(store_id)].put_nowait((function, future))
+        return future
+
+    def depth(self):
+        """
+        Get the number of messages waiting.
+
+        Returns
+        -------
+        int
+            Messages queued on every worker.
+
+        """
+        return sum(q.qsize() for q in self._queues)
+
+    def stop(self, timeout=None):
+        """
+        Finish the queued messages and stop the workers.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for every worker.
+
+        Returns
+        -------
+        None.
+
+        """
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work(self, messages_queue, uploader):
+        """
+        Handle the messages of one worker until it is stopped.
+
+        Parameters
+        ----------
+        messages_queue : queue.Queue
+            Queue of the worker.
+
+        uploader : DbUploader
+            Uploader of the worker.
+
+        Returns
+        -------
+        None.
+
+        """
+        stopping = False
+        while not stopping:
+            items = [messages_queue.get()]
+            deadline = time.monotonic() + self.coalesce_window
+            while len(items) < self.batch_size and isinstance(items[-1], dict):
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        items.append(messages_queue.get(timeout=remaining))
+                    else:
+                        items.append(messages_queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [item for item in items if isinstance(item, dict)]
+            if len(batch) > 0:
+                try:
+                    uploader.apply_constant_messages(batch)
+                except Exception:
+                    logger.exception("could not handle batch of queued messages", extra={"messages": len(batch)})
+            last = items[-1]
+            if last is None:
+                stopping = True
+            elif isinstance(last, tuple):
+                function, future = last
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(uploader))
+                    except Exception as error:
+                        future.set_exception(error)
@@ -0,0 +1,641 @@
+"""
+Inventory state.
+
+    In-memory view of the inventory of a store, a bounded cache of those
+    views, a bounded cache of the store of each device and the locks that keep threads from changing the same store at
+    once.
+
+    A cached view is only trusted while it is as recent as the database:
+    every write of a store increments Store.revision only if it still holds
+    the revision of the view, so a view another process wrote past is
+    detected, dropped and read again.
+
+Classes:
+    StaleInventoryError
+
+    InventoryItem
+
+    StoreInventory
+
+    InventoryCache
+
+    DeviceCache
+
+    StoreLocks
+
+Functions:
+    item_fill(item) -> float
+
+    item_hash(ean, stock) -> int
+
+"""
+#_________________________________Libraries____________________________________
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import threading
+import zlib
+
+#_________________________________Functions____________________________________
+def item_fill(item):
+    """
+    Get the normalized fill of one product.
+
+    Parameters
+    ----------
+    item : InventoryItem
+        Stock levels of product.
+
+    Returns
+    -------
+    float
+        (stock - min_stock) / (max_stock - min_stock), None if the minimum
+        and maximum stock are equal.
+
+    """
+    span = item.max_stock - item.min_stock
+    if span == 0:
+        return None
+    return (item.stock - item.min_stock) / span
+
+def item_hash(ean, stock):
+    """
+    Hash the stock of one product.
+
+    Parameters
+    ----------
+    ean : string
+        Ean of product.
+
+    stock : int
+        Stock of product.
+
+    Returns
+    -------
+    int
+        64 bit hash.
+
+    """
+    digest = hashlib.blake2b("{e}:{s}".format(e=ean, s=stock).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+#__________________________________Classes_____________________________________
+class StaleInventoryError(Exception):
+    """
+    Stale inventory error.
+
+        Raised when the revision of a store in the database is not the one
+        of its cached inventory, because another process wrote the store.
+
+    Attributes
+    ----------
+    store_ids : list
+        Ids of the stores written, at least one of them stale.
+
+    """
+
+    def __init__(self, store_ids) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        store_ids : list
+            Ids of the stores written.
+
+        Returns
+        -------
+        None.
+
+        """
+        super().__init__("cached inventory of store {s} is stale".format(s=", ".join(str(store_id) for store_id in store_ids)))
+        self.store_ids = store_ids
+
+class InventoryItem():
+    """
+    Inventory item.
+
+        Stock levels of one product in one store.
+
+    Attributes
+    ----------
+    product_id : int
+        Id of product.
+
+    stock : int
+        Current stock.
+
+    min_stock : int
+        Minimum stock.
+
+    max_stock : int
+        Maximum stock.
+
+    """
+
+    __slots__ = ("product_id", "stock", "min_stock", "max_stock")
+
+    def __init__(self, product_id, stock, min_stock, max_stock) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        product_id : int
+            Id of product.
+
+        stock : int
+            Current stock.
+
+        min_stock : int
+            Minimum stock.
+
+        max_stock : int
+            Maximum stock.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.product_id = product_id
+        self.stock = stock
+        self.min_stock = min_stock
+        self.max_stock = max_stock
+
+class StoreInventory():
+    """
+    Store inventory.
+
+        Snapshot of the Inventory rows of a store, keyed by product ean. It is
+        loaded with a single query and then kept up to date in memory while a
+        message is handled.
+        
+        The version identifies the stocks of every product. It is the sum of
+        the item hashes modulo 2**64, so it is updated in constant time when
+        a single stock changes. The sum and count of the normalized fill of
+        the products are kept the same way, so the mean fill the status is
+        computed from costs nothing to read.
+
+    Attributes
+    ----------
+    store_id : int
+        Id of store.
+
+    items : dict
+        Product ean to InventoryItem.
+
+    status : int
+        Status of store, None if unknown.
+
+    status_since : float
+        Monotonic time the status was set at, None if unknown.
+
+    notified_status : int
+        Last status a notification was created for, None if unknown.
+
+    notified_at : float
+        Monotonic time of that notification, None if unknown.
+
+    sequence : int
+        Sequence number of the last delta message applied, None if unknown.
+
+    revision : int
+        Revision of the store in the database the snapshot matches, None if
+        the store has no row.
+
+    Methods
+    -------
+    add_item(ean, product_id, stock, min_stock, max_stock):
+        Add a product to the snapshot.
+
+    set_stock(ean, stock):
+        Change the stock of a product.
+
+    version():
+        Get the version of the stocks.
+
+    mean_fill():
+        Get the mean normalized fill of the products.
+
+    """
+
+    def __init__(self, store_id) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.store_id = store_id
+        self.items = {}
+        self.status = None
+        self.status_since = None
+        self.notified_status = None
+        self.notified_at = None
+        self.sequence = None
+        self.revision = None
+        self._version = 0
+        self._fill_sum = 0.0
+        self._fill_count = 0
+
+    def __contains__(self, ean):
+        return ean in self.items
+
+    def __getitem__(self, ean):
+        return self.items[ean]
+
+    def add_item(self, ean, product_id, stock, min_stock, max_stock):
+        """
+        Add a product to the snapshot.
+
+        Parameters
+        ----------
+        ean : string
+            Ean of product.
+
+        product_id : int
+            Id of product.
+
+        stock : int
+            Current stock.
+
+        min_stock : int
+            Minimum stock.
+
+        max_stock : int
+            Maximum stock.
+
+        Returns
+        -------
+        InventoryItem
+            Added item.
+
+        """
+        if ean in self.items:
+            self._version -= item_hash(ean, self.items[ean].stock)
+            self._remove_fill(self.items[ean])
+        item = InventoryItem(product_id, stock, min_stock, max_stock)
+        self.items[ean] = item
+        self._version = (self._version + item_hash(ean, stock)) % 2**64
+        self._add_fill(item)
+        return item
+
+    def set_stock(self, ean, stock):
+        """
+        Change the stock of a product.
+
+        Parameters
+        ----------
+        ean : string
+            Ean of product.
+
+        stock : int
+            New stock.
+
+        Returns
+        -------
+        None.
+
+        """
+        item = self.items[ean]
+        if item.stock != stock:
+            self._version = (self._version - item_hash(ean, item.stock) + item_hash(ean, stock)) % 2**64
+            self._remove_fill(item)
+            item.stock = stock
+            self._add_fill(item)
+
+    def version(self):
+        """
+        Get the version of the stocks.
+
+        Returns
+        -------
+        string
+            16 hexadecimal digits.
+
+        """
+        return "{v:016x}".format(v=self._version)
+
+    def mean_fill(self):
+        """
+        Get the mean normalized fill of the products.
+
+            Products whose minimum and maximum stock are equal are left out.
+
+        Returns
+        -------
+        float
+            Mean fill, 0 if no product counts.
+
+        """
+        if self._fill_count == 0:
+            return 0
+        return self._fill_sum / self._fill_count
+
+    def _add_fill(self, item):
+        fill = item_fill(item)
+        if fill is not None:
+            self._fill_sum += fill
+            self._fill_count += 1
+
+    def _remove_fill(self, item):
+        fill = item_fill(item)
+        if fill is not None:
+            self._fill_count -= 1
+            # start again from an exact zero instead of accumulating rounding
+            self._fill_sum = self._fill_sum - fill if self._fill_count > 0 else 0.0
+
+class InventoryCache():
+    """
+    Inventory cache.
+
+        Keeps the last known StoreInventory of the most recently used stores.
+        When more than ``max_stores`` stores are cached the least recently
+        used one is dropped. The cache can be used from many threads.
+
+    Attributes
+    ----------
+    max_stores : int
+        Maximum number of cached stores.
+
+    Methods
+    -------
+    get(store_id):
+        Get the cached inventory of a store.
+
+    put(inventory):
+        Cache the inventory of a store.
+
+    evict(store_id):
+        Drop the cached inventory of a store.
+
+    store_ids():
+        Get the ids of the cached stores.
+
+    clear():
+        Drop every cached inventory.
+
+    """
+
+    def __init__(self, max_stores=1024) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        max_stores : int, optional
+            Maximum number of cached stores. The default is 1024.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.max_stores = max_stores
+        self._inventories = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._inventories)
+
+    def get(self, store_id):
+        """
+        Get the cached inventory of a store.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+
+        Returns
+        -------
+        StoreInventory
+            Cached inventory, None on a miss.
+
+        """
+        with self._lock:
+            inventory = self._inventories.get(store_id)
+            if inventory is not None:
+                self._inventories.move_to_end(store_id)
+        return inventory
+
+    def put(self, inventory):
+        """
+        Cache the inventory of a store.
+
+        Parameters
+        ----------
+        inventory : StoreInventory
+            Inventory to cache.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            self._inventories[inventory.store_id] = inventory
+            self._inventories.move_to_end(inventory.store_id)
+            while len(self._inventories) > self.max_stores:
+                self._inventories.popitem(last=False)
+
+    def evict(self, store_id):
+        """
+        Drop the cached inventory of a store.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            self._inventories.pop(store_id, None)
+
+    def store_ids(self):
+        """
+        Get the ids of the cached stores.
+
+        Returns
+        -------
+        list
+            Ids of store, least recently used first.
+
+        """
+        with self._lock:
+            return list(self._inventories)
+
+    def clear(self):
+        """
+        Drop every cached inventory.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            self._inventories.clear()
+
+class DeviceCache():
+    """
+    Device cache.
+
+        Least recently used cache of the store registered by each device,
+        so retried initializations are answered without a query. Safe to
+        use from many threads.
+
+    Attributes
+    ----------
+    max_devices : int
+        Maximum number of cached devices.
+
+    Methods
+    -------
+    get(device_key):
+        Get the store registered by a device.
+
+    put(device_key, store_id):
+        Cache the store registered by a device.
+
+    """
+
+    def __init__(self, max_devices=4096) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        max_devices : int, optional
+            Maximum number of cached devices. The default is 4096.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.max_devices = max_devices
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._stores)
+
+    def get(self, device_key):
+        """
+        Get the store registered by a device.
+
+        Parameters
+        ----------
+        device_key : string
+            Stable key of the device.
+
+        Returns
+        -------
+        int
+            Id of store, None on a miss.
+
+        """
+        with self._lock:
+            store_id = self._stores.get(device_key)
+            if store_id is not None:
+                self._stores.move_to_end(device_key)
+        return store_id
+
+    def put(self, device_key, store_id):
+        """
+        Cache the store registered by a device.
+
+        Parameters
+        ----------
+        device_key : string
+            Stable key of the device.
+
+        store_id : int
+            Id of store.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            self._stores[device_key] = store_id
+            self._stores.move_to_end(device_key)
+            while len(self._stores) > self.max_devices:
+                self._stores.popitem(last=False)
+
+class StoreLocks():
+    """
+    Store locks.
+
+        Striped reentrant locks by store id. A thread holds the locks of the
+        stores it handles from reading their cached inventory until their
+        writes are committed, so two threads never diff messages of the same
+        store at once. Locks are always taken in stripe order, so threads
+        holding several stores do not deadlock.
+
+    Attributes
+    ----------
+    stripes : int
+        Number of locks stores are spread over.
+
+    Methods
+    -------
+    hold(store_ids):
+        Hold the locks of some stores for the enclosed block.
+
+    """
+
+    def __init__(self, stripes=64) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        stripes : int, optional
+            Number of locks stores are spread over. The default is 64.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.stripes = stripes
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    @contextmanager
+    def hold(self, store_ids):
+        """
+        Hold the locks of some stores for the enclosed block.
+
+        Parameters
+        ----------
+        store_ids : iterable
+            Ids of stores.
+
+        Yields
+        ------
+        None.
+
+        """
+        stripes = sorted(set(zlib.crc32(str(store_id).encode()) % self.stripes for store_id in store_ids))
+        for i in stripes:
+            self._locks[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(stripes):
+                self._locks[i].release()
@@ -0,0 +1,315 @@
+"""
+Local database.
+
+    SQLite stand-in of the MySQL database of the handler, for benchmarks and
+    local runs without a database server. It has the tables the handler uses
+    and connections that accept the calls the handler makes on MySQL
+    connections. The MySQL upserts of the handler, ON DUPLICATE KEY UPDATE,
+    are translated to SQLite ones.
+
+Classes:
+    LocalCursor
+
+    LocalConnection
+
+Functions:
+    statement_count() -> int
+
+    translate(sql) -> string
+
+    create_database(path, eans) -> None
+
+    connect(path) -> LocalConnection
+
+Variables:
+    SCHEMA
+
+"""
+#_________________________________Libraries____________________________________
+import functools
+import re
+import sqlite3
+import threading
+
+#__________________________________Variables___________________________________
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Store(
+    id_store INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT, status INTEGER, latitude REAL, longitude REAL,
+    state TEXT, municipality TEXT, zip_code TEXT, address TEXT,
+    revision INTEGER NOT NULL DEFAULT 0, notified_status INTEGER);
+CREATE TABLE IF NOT EXISTS StoreDevice(
+    device_key TEXT PRIMARY KEY,
+    id_store INTEGER);
+CREATE TABLE IF NOT EXISTS Product(
+    id_product INTEGER PRIMARY KEY AUTOINCREMENT,
+    ean TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS Inventory(
+    id_product INTEGER, id_store INTEGER,
+    stock INTEGER, min_stock INTEGER, max_stock INTEGER,
+    PRIMARY KEY(id_store, id_product));
+CREATE TABLE IF NOT EXISTS Sale(
+    id_sale INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_product INTEGER, id_store INTEGER, timestamp TEXT,
+    quantity INTEGER NOT NULL DEFAULT 1);
+CREATE TABLE IF NOT EXISTS SaleHourly(
+    id_store INTEGER, id_product INTEGER, sale_hour TEXT,
+    quantity INTEGER, sales INTEGER,
+    PRIMARY KEY(id_store, id_product, sale_hour));
+CREATE TABLE IF NOT EXISTS SaleDaily(
+    id_store INTEGER, sale_day TEXT,
+    quantity INTEGER, sales INTEGER,
+    PRIMARY KEY(id_store, sale_day));
+CREATE TABLE IF NOT EXISTS SpoolOffset(
+    spool_name TEXT PRIMARY KEY,
+    record_id INTEGER);
+CREATE TABLE IF NOT EXISTS Notification(
+    id_notification INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_store INTEGER, new_status INTEGER);
+"""
+
+# statements run through every LocalConnection of the process
+_statement_count = 0
+_statement_lock = threading.Lock()
+
+#_________________________________Functions____________________________________
+def statement_count():
+    """
+    Get the number of statements run on local connections.
+
+    Returns
+    -------
+    int
+        Statements run since the process started.
+
+    """
+    return _statement_count
+
+@functools.lru_cache(maxsize=256)
+def translate(sql):
+    """
+    Translate a statement of the handler to SQLite.
+
+    Parameters
+    ----------
+    sql : string
+        MySQL statement with %s placeholders.
+
+    Returns
+    -------
+    string
+        SQLite statement with ? placeholders.
+
+    """
+    sql = sql.replace("%s", "?")
+    insert, upsert, update = sql.partition("ON DUPLICATE KEY UPDATE")
+    if upsert:
+        sql = insert + "ON CONFLICT DO UPDATE SET" + re.sub(r"VALUES\((\w+)\)", r"excluded.\1", update)
+    return sql
+
+def _count_statement():
+    global _statement_count
+    with _statement_lock:
+        _statement_count += 1
+
+def create_database(path, eans=()):
+    """
+    Create the tables of the handler.
+
+    Parameters
+    ----------
+    path : string
+        File of the database.
+
+    eans : iterable, optional
+        Eans of the products registered in the Product table.
+
+    Returns
+    -------
+    None.
+
+    """
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connection.executemany("INSERT OR IGNORE INTO Product(ean) VALUES (?)", [(ean,) for ean in eans])
+    finally:
+        connection.close()
+
+def connect(path):
+    """
+    Open a connection to a local database.
+
+    Parameters
+    ----------
+    path : string
+        File of the database, created with create_database.
+
+    Returns
+    -------
+    LocalConnection
+        Connection.
+
+    """
+    return LocalConnection(path)
+
+#__________________________________Classes_____________________________________
+class LocalCursor():
+    """
+    Local cursor.
+
+        SQLite cursor that takes the statements of the handler.
+
+    Attributes
+    ----------
+    lastrowid : int
+        Id of the last inserted row.
+
+    rowcount : int
+        Rows changed by the last statement.
+
+    Methods
+    -------
+    execute(sql, params):
+        Run a statement.
+
+    fetchone():
+        Get the next row.
+
+    fetchmany(size):
+        Get the next rows.
+
+    fetchall():
+        Get the remaining rows.
+
+    close():
+        Close the cursor.
+
+    """
+
+    def __init__(self, cursor) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        cursor : sqlite3 Cursor
+            Cursor to wrap.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._cursor = cursor
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, sql, params=()):
+        """
+        Run a statement.
+
+        Parameters
+        ----------
+        sql : string
+            Statement with %s placeholders.
+
+        params : sequence, optional
+            Values bound to the placeholders.
+
+        Returns
+        -------
+        None.
+
+        """
+        _count_statement()
+        self._cursor.execute(translate(sql), tuple(params))
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+class LocalConnection():
+    """
+    Local connection.
+
+        SQLite connection in autocommit mode with the transaction calls of a
+        MySQL connection. Cursor options of MySQL, like prepared or buffered,
+        are accepted and ignored.
+
+    Methods
+    -------
+    cursor(**options):
+        Get a cursor.
+
+    start_transaction():
+        Begin a transaction.
+
+    commit():
+        Commit the transaction.
+
+    rollback():
+        Roll the transaction back.
+
+    ping(**options):
+        Check the connection.
+
+    close():
+        Close the connection.
+
+    """
+
+    def __init__(self, path) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        path : string
+            File of the database.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+
+    def cursor(self, **options):
+        return LocalCursor(self._connection.cursor())
+
+    def start_transaction(self):
+        _count_statement()
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        _count_statement()
+        self._connection.execute("COMMIT")
+
+    def rollback(self):
+        _count_statement()
+        self._connection.execute("ROLLBACK")
+
+    def ping(self, **options):
+        self._connection.execute("SELECT 1")
+
+    def close(self):
+        self._connection.close()
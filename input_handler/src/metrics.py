@@ -0,0 +1,389 @@
+"""
+Metrics.
+
+    Counters and latency histograms of the handler, exported in the
+    Prometheus text format. Updating a metric takes a lock and a few
+    additions, so they are cheap enough to stay on in production.
+
+Classes:
+    Counter
+
+    Histogram
+
+    MetricsRegistry
+
+Variables:
+    METRICS
+
+"""
+#_________________________________Libraries____________________________________
+import bisect
+from contextlib import contextmanager
+import threading
+import time
+
+#__________________________________Variables___________________________________
+# seconds, from sub-millisecond cache hits to requests stuck on the database
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# statements or rows per message
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+#_________________________________Functions____________________________________
+def _format_labels(labels, extra=None):
+    """
+    Format a label set.
+
+    Parameters
+    ----------
+    labels : tuple
+        (name, value) pairs.
+
+    extra : tuple, optional
+        (name, value) pair appended to the labels.
+
+    Returns
+    -------
+    string
+        Labels in braces, empty without labels.
+
+    """
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join('{n}="{v}"'.format(n=name, v=str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+def _format_value(value):
+    """
+    Format a sample value.
+
+    Parameters
+    ----------
+    value : float
+        Value.
+
+    Returns
+    -------
+    string
+        Integers without decimals, other values with repr.
+
+    """
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+#__________________________________Classes_____________________________________
+class Counter():
+    """
+    Counter.
+
+        Monotonic count, one per label set.
+
+    Attributes
+    ----------
+    name : string
+        Metric name.
+
+    help : string
+        Description of the metric.
+
+    Methods
+    -------
+    inc(amount, **labels):
+        Add to the count.
+
+    render():
+        Get the metric in the Prometheus text format.
+
+    """
+
+    def __init__(self, name, help) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        name : string
+            Metric name.
+
+        help : string
+            Description of the metric.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Add to the count.
+
+        Parameters
+        ----------
+        amount : float, optional
+            Amount added. The default is 1.
+
+        **labels : string
+            Labels of the count.
+
+        Returns
+        -------
+        None.
+
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        """
+        Get the metric in the Prometheus text format.
+
+        Returns
+        -------
+        list
+            Lines of the metric.
+
+        """
+        lines = ["# HELP {n} {h}".format(n=self.name, h=self.help), "# TYPE {n} counter".format(n=self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append("{n}{l} {v}".format(n=self.name, l=_format_labels(labels), v=_format_value(value)))
+        return lines
+
+class Histogram():
+    """
+    Histogram.
+
+        Distribution of observed values over fixed buckets, one per label
+        set.
+
+    Attributes
+    ----------
+    name : string
+        Metric name.
+
+    help : string
+        Description of the metric.
+
+    buckets : tuple
+        Upper bounds of the buckets, in increasing order.
+
+    Methods
+    -------
+    observe(value, **labels):
+        Count a value.
+
+    time(**labels):
+        Observe the seconds the enclosed block takes.
+
+    render():
+        Get the metric in the Prometheus text format.
+
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        name : string
+            Metric name.
+
+        help : string
+            Description of the metric.
+
+        buckets : tuple, optional
+            Upper bounds of the buckets. The default is LATENCY_BUCKETS.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Count a value.
+
+        Parameters
+        ----------
+        value : float
+            Observed value.
+
+        **labels : string
+            Labels of the value.
+
+        Returns
+        -------
+        None.
+
+        """
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds the enclosed block takes.
+
+            The block is observed whether it raises or not.
+
+        Parameters
+        ----------
+        **labels : string
+            Labels of the value.
+
+        Yields
+        ------
+        None.
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        """
+        Get the metric in the Prometheus text format.
+
+        Returns
+        -------
+        list
+            Lines of the metric.
+
+        """
+        lines = ["# HELP {n} {h}".format(n=self.name, h=self.help), "# TYPE {n} histogram".format(n=self.name)]
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("{n}_bucket{l} {v}".format(n=self.name, l=_format_labels(labels, ("le", _format_value(bound))),
+                                                        v=cumulative))
+            lines.append("{n}_bucket{l} {v}".format(n=self.name, l=_format_labels(labels, ("le", "+Inf")), v=count))
+            lines.append("{n}_sum{l} {v}".format(n=self.name, l=_format_labels(labels), v=repr(total)))
+            lines.append("{n}_count{l} {v}".format(n=self.name, l=_format_labels(labels), v=count))
+        return lines
+
+class MetricsRegistry():
+    """
+    Metrics registry.
+
+        Every metric of the process, created on first use by name.
+
+    Methods
+    -------
+    counter(name, help):
+        Get a counter.
+
+    histogram(name, help, buckets):
+        Get a histogram.
+
+    render():
+        Get every metric in the Prometheus text format.
+
+    """
+
+    def __init__(self) -> None:
+        """
+        Construct attributes of the class.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = factory()
+        return metric
+
+    def counter(self, name, help):
+        """
+        Get a counter, creating it on first use.
+
+        Parameters
+        ----------
+        name : string
+            Metric name.
+
+        help : string
+            Description of the metric.
+
+        Returns
+        -------
+        Counter
+            Counter.
+
+        """
+        return self._get(name, lambda: Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        """
+        Get a histogram, creating it on first use.
+
+        Parameters
+        ----------
+        name : string
+            Metric name.
+
+        help : string
+            Description of the metric.
+
+        buckets : tuple, optional
+            Upper bounds of the buckets. The default is LATENCY_BUCKETS.
+
+        Returns
+        -------
+        Histogram
+            Histogram.
+
+        """
+        return self._get(name, lambda: Histogram(name, help, buckets))
+
+    def render(self):
+        """
+        Get every metric in the Prometheus text format.
+
+        Returns
+        -------
+        string
+            Exposition text.
+
+        """
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+#__________________________________Variables___________________________________
+METRICS = MetricsRegistry()
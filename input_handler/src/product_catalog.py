@@ -0,0 +1,217 @@
+"""
+Product catalog.
+
+    Process-wide cache of the Product table, mapping product ean to product
+    id.
+
+Classes:
+    ProductCatalog
+
+"""
+#_________________________________Libraries____________________________________
+import threading
+import time
+
+#__________________________________Classes_____________________________________
+class ProductCatalog():
+    """
+    Catalog.
+
+        Keeps every ean to product id pair in memory. The whole table is
+        reloaded when the cache is older than ``ttl`` seconds or after an
+        explicit invalidation, and only eans the cache does not know are
+        looked up in the database. Lookups can run on many threads, only one
+        of them reloads an expired catalog. Callers that share the catalog
+        can pass their own loaders, so it is read on their connection.
+
+    Attributes
+    ----------
+    load_all : callable
+        Returns a dictionary with every ean to product id pair.
+
+    load_some : callable
+        Takes a list of eans and returns their ean to product id pairs.
+
+    ttl : float
+        Seconds the cache is trusted before it is reloaded.
+
+    Methods
+    -------
+    refresh(load_all):
+        Reload the whole catalog.
+
+    load(product_ids):
+        Replace the whole catalog.
+
+    add(product_ids):
+        Add pairs to the catalog.
+
+    missing(eans):
+        Get the eans the catalog does not know.
+
+    invalidate():
+        Force a reload on the next lookup.
+
+    lookup(eans, load_all, load_some):
+        Get the product ids of the given eans.
+
+    """
+
+    def __init__(self, load_all, load_some, ttl=3600) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        load_all : callable
+            Returns a dictionary with every ean to product id pair.
+
+        load_some : callable
+            Takes a list of eans and returns their ean to product id pairs.
+
+        ttl : float, optional
+            Seconds the cache is trusted. The default is 3600.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.load_all = load_all
+        self.load_some = load_some
+        self.ttl = ttl
+        self._product_ids = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def is_expired(self):
+        """
+        Check if the catalog has to be reloaded.
+
+        Returns
+        -------
+        bool
+            True if never loaded, invalidated or older than ttl.
+
+        """
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def refresh(self, load_all=None):
+        """
+        Reload the whole catalog.
+
+        Parameters
+        ----------
+        load_all : callable, optional
+            Loader to use instead of the one of the catalog.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.load((load_all or self.load_all)())
+
+    def load(self, product_ids):
+        """
+        Replace the whole catalog.
+
+            Used to fill the catalog from a source load_all can not reach,
+            like an async connection.
+
+        Parameters
+        ----------
+        product_ids : dict
+            Every ean to product id pair.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._product_ids = dict(product_ids)
+        self._loaded_at = time.monotonic()
+
+    def add(self, product_ids):
+        """
+        Add pairs to the catalog.
+
+        Parameters
+        ----------
+        product_ids : dict
+            Ean to product id pairs.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._product_ids.update(product_ids)
+
+    def missing(self, eans):
+        """
+        Get the eans the catalog does not know.
+
+        Parameters
+        ----------
+        eans : list
+            Eans of products.
+
+        Returns
+        -------
+        list
+            Eans not in the catalog.
+
+        """
+        product_ids = self._product_ids
+        return [ean for ean in eans if ean not in product_ids]
+
+    def invalidate(self):
+        """
+        Force a reload on the next lookup.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._loaded_at = None
+
+    def lookup(self, eans, load_all=None, load_some=None):
+        """
+        Get the product ids of the given eans.
+
+        Parameters
+        ----------
+        eans : list
+            Eans of products.
+
+        load_all : callable, optional
+            Loader of every pair to use instead of the one of the catalog.
+
+        load_some : callable, optional
+            Loader of some pairs to use instead of the one of the catalog.
+
+        Returns
+        -------
+        dict
+            Ean to product id, for every ean found.
+
+        """
+        if self.is_expired():
+            with self._lock:
+                if self.is_expired():
+                    self.refresh(load_all)
+        product_ids = self._product_ids
+        result = {}
+        missing = []
+        for ean in eans:
+            if ean in product_ids:
+                result[ean] = product_ids[ean]
+            else:
+                missing.append(ean)
+        if missing:
+            found = (load_some or self.load_some)(missing)
+            self.add(found)
+            result.update(found)
+        return result
@@ -0,0 +1,99 @@
+"""
+Row decoder.
+
+    Streams query results out of a cursor into plain Python containers or,
+    for large result sets, into NumPy columns.
+
+Functions:
+    iter_rows(cursor, batch_size) -> generator
+
+    decode_mapping(cursor) -> dict
+
+    decode_columns(cursor, columns, dtypes) -> dict
+
+"""
+#_________________________________Libraries____________________________________
+import numpy as np
+
+#__________________________________Variables___________________________________
+FETCH_BATCH_SIZE = 500
+
+#_________________________________Functions____________________________________
+def iter_rows(cursor, batch_size=FETCH_BATCH_SIZE):
+    """
+    Stream rows from a cursor.
+
+    Parameters
+    ----------
+    cursor : DB-API Cursor
+        Cursor holding the result of an executed query.
+
+    batch_size : int, optional
+        Rows fetched per round. The default is FETCH_BATCH_SIZE.
+
+    Yields
+    ------
+    tuple
+        One result row.
+
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def decode_mapping(cursor):
+    """
+    Decode a result keyed by its first column.
+
+        Two column results map the first column to the second one, wider
+        results map the first column to a tuple with the remaining columns.
+
+    Parameters
+    ----------
+    cursor : DB-API Cursor
+        Cursor holding the result of an executed query.
+
+    Returns
+    -------
+    dict
+        First column to remaining column(s).
+
+    """
+    result = {}
+    for row in iter_rows(cursor):
+        result[row[0]] = row[1] if len(row) == 2 else tuple(row[1:])
+    return result
+
+def decode_columns(cursor, columns, dtypes=None):
+    """
+    Decode a result into NumPy columns.
+
+        Meant for large result sets that are processed with vectorized
+        operations afterwards.
+
+    Parameters
+    ----------
+    cursor : DB-API Cursor
+        Cursor holding the result of an executed query.
+
+    columns : list
+        Names of the selected columns, in order.
+
+    dtypes : dict, optional
+        Column name to NumPy dtype. Columns left out are stored as objects.
+
+    Returns
+    -------
+    dict
+        Column name to one dimensional array.
+
+    """
+    dtypes = dtypes or {}
+    values = [[] for _ in columns]
+    for row in iter_rows(cursor):
+        for i in range(len(columns)):
+            values[i].append(row[i])
+    return {name: np.array(values[i], dtype=dtypes.get(name, object))
+            for i, name in enumerate(columns)}
@@ -0,0 +1,55 @@
+-- Schema changes the handler needs on top of the original database.
+-- Statements are in the order they were added; apply the ones a database
+-- does not have yet.
+
+-- Store registered by each device, so a device that retries its
+-- initialization message gets its store back instead of a duplicate.
+CREATE TABLE IF NOT EXISTS StoreDevice (
+    device_key VARCHAR(64) NOT NULL,
+    id_store INT NOT NULL,
+    PRIMARY KEY (device_key),
+    FOREIGN KEY (id_store) REFERENCES Store(id_store)
+);
+
+-- Units sold by each sale. Run once: MySQL has no IF NOT EXISTS for columns.
+ALTER TABLE Sale ADD COLUMN quantity INT NOT NULL DEFAULT 1;
+
+-- Sales rolled up per store, product and hour, and per store and day.
+-- They are updated in the transaction that registers the sales, so
+-- dashboards can read them instead of grouping the Sale table.
+CREATE TABLE IF NOT EXISTS SaleHourly (
+    id_store INT NOT NULL,
+    id_product INT NOT NULL,
+    sale_hour DATETIME NOT NULL,
+    quantity INT NOT NULL,
+    sales INT NOT NULL,
+    PRIMARY KEY (id_store, id_product, sale_hour)
+);
+
+CREATE TABLE IF NOT EXISTS SaleDaily (
+    id_store INT NOT NULL,
+    sale_day DATE NOT NULL,
+    quantity INT NOT NULL,
+    sales INT NOT NULL,
+    PRIMARY KEY (id_store, sale_day)
+);
+
+-- Id of the last spooled message applied from each spool, written in the
+-- transaction that applies the messages so none is applied twice.
+CREATE TABLE IF NOT EXISTS SpoolOffset (
+    spool_name VARCHAR(64) NOT NULL,
+    record_id BIGINT UNSIGNED NOT NULL,
+    PRIMARY KEY (spool_name)
+);
+
+-- Revision of every store, incremented by each write of its inventory or
+-- status. A handler only writes a store while it still has the revision of
+-- its cached inventory, so processes sharing the database never diff
+-- against stocks another one already changed. Run once.
+ALTER TABLE Store ADD COLUMN revision BIGINT UNSIGNED NOT NULL DEFAULT 0;
+
+-- Last status notified for every store, written with its notifications, so
+-- a change held back by NOTIFICATION_DEBOUNCE is still notified after the
+-- inventory of the store is read again. NULL means the stored status was
+-- notified. Run once.
+ALTER TABLE Store ADD COLUMN notified_status INT NULL;
@@ -0,0 +1,821 @@
+"""
+Spool.
+
+    Local write-ahead log of device messages. Decyphered messages are
+    appended to segment files on disk and acknowledged once they are synced,
+    before the database is touched, so devices keep being answered while the
+    database is down or slow. A replayer applies the spooled messages to the
+    database in bulk and stores the id of the last one it applied in the same
+    transaction as their writes, so every message is applied exactly once,
+    across restarts too.
+
+    Records are a header with the record id, the payload length and its CRC32
+    followed by the message as JSON. A segment is named after the id of its
+    first record and a new one is started once it reaches the segment size.
+    Segments whose records were all applied are deleted. Ids keep growing
+    across segments and restarts.
+
+Classes:
+    Spool
+
+    SpoolReplayer
+
+"""
+#_________________________________Libraries____________________________________
+import bisect
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from metrics import METRICS
+
+#__________________________________Variables___________________________________
+logger = logging.getLogger(__name__)
+
+# record id, payload length and payload CRC32
+_HEADER = struct.Struct(">QII")
+_SEGMENT_SUFFIX = ".spool"
+
+SPOOL_APPENDED = METRICS.counter("handler_spool_records_appended_total", "Messages appended to the spool.")
+SPOOL_SYNCS = METRICS.counter("handler_spool_syncs_total", "Times the spool was synced to disk.")
+SPOOL_REPLAYED = METRICS.counter("handler_spool_records_replayed_total", "Spooled messages applied to the database.")
+SPOOL_SKIPPED = METRICS.counter("handler_spool_records_skipped_total", "Spooled messages that could not be applied and were skipped.")
+
+#_________________________________Functions____________________________________
+def _segment_name(first_id):
+    return "{i:020d}{s}".format(i=first_id, s=_SEGMENT_SUFFIX)
+
+def _read_record(segment):
+    """
+    Read the next record of a segment.
+
+    Parameters
+    ----------
+    segment : file
+        Segment opened for binary reading.
+
+    Returns
+    -------
+    tuple
+        (record_id, payload, size), None at the end of the segment or at a
+        torn or corrupt record.
+
+    """
+    header = segment.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    record_id, length, checksum = _HEADER.unpack(header)
+    payload = segment.read(length)
+    if len(payload) < length or zlib.crc32(payload) != checksum:
+        return None
+    return record_id, payload, _HEADER.size + length
+
+#__________________________________Classes_____________________________________
+class Spool():
+    """
+    Spool.
+
+        Append-only log of messages split in segment files. Appends are
+        group committed: they are written right away and synced to disk by a
+        background thread, and every append waits for the sync that covers
+        it. Appends that arrive while a sync runs, or within
+        ``fsync_interval`` seconds of the previous one, share the next sync.
+        If that sync fails the appends fail too, and the next sync is tried
+        a second later. A write that fails is cut off the segment, so no torn
+        record is left before the next one. The directory is locked, so only
+        one process uses it.
+
+    Attributes
+    ----------
+    directory : string
+        Directory of the segments.
+
+    segment_size : int
+        Bytes after which a new segment is started.
+
+    fsync_interval : float
+        Minimum seconds between syncs.
+
+    synced_id : int
+        Id of the last record synced to disk.
+
+    Methods
+    -------
+    append(message, timeout):
+        Append a message and wait until it is on disk.
+
+    append_many(messages, timeout):
+        Append messages and wait until they are on disk.
+
+    read(after_id, limit):
+        Get synced records after an id.
+
+    wait(after_id, timeout):
+        Wait for records after an id.
+
+    truncate(applied_id):
+        Delete segments whose records were all applied.
+
+    pending(applied_id):
+        Get the number of synced records after an id.
+
+    size():
+        Get the bytes used by the segments.
+
+    close():
+        Sync and close the spool.
+
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync_interval=0) -> None:
+        """
+        Construct attributes of the class.
+
+            Opens the last segment, dropping a record torn by a crash at its
+            end, and starts the sync thread.
+
+        Parameters
+        ----------
+        directory : string
+            Directory of the segments, created if missing.
+
+        segment_size : int, optional
+            Bytes after which a new segment is started. The default is 64 MiB.
+
+        fsync_interval : float, optional
+            Minimum seconds between syncs. The default is 0, a sync starts
+            as soon as the previous one ends.
+
+        Raises
+        ------
+        RuntimeError
+            If another process uses the directory.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, "LOCK"), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError("spool directory {d} is used by another process".format(d=directory))
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._synced = threading.Condition(self._lock)
+        self._closed = False
+        self._reader = None
+        # id of the last record a failed sync should have covered
+        self._failed_id = 0
+        # a failed write could not be cut off the segment
+        self._torn = False
+        # full segments not synced yet, closed by the sync thread
+        self._retired = []
+        self._segments = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                if name.endswith(_SEGMENT_SUFFIX))
+        self._recover()
+        self._thread = threading.Thread(target=self._sync_loop, name="spool-sync", daemon=True)
+        self._thread.start()
+
+    def _path(self, first_id):
+        return os.path.join(self.directory, _segment_name(first_id))
+
+    def _recover(self):
+        """
+        Open the last segment for appending after a restart.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not self._segments:
+            # ids of a new spool start at the current time in microseconds,
+            # so they stay above the applied offset if the directory is lost
+            first_id = int(time.time() * 1000000)
+            self._open_segment(first_id)
+            self.synced_id = first_id - 1
+            return
+        first_id = self._segments[-1]
+        last_id = first_id - 1
+        end = 0
+        with open(self._path(first_id), "rb") as segment:
+            while True:
+                record = _read_record(segment)
+                if record is None:
+                    break
+                last_id = record[0]
+                end += record[2]
+        with open(self._path(first_id), "r+b") as segment:
+            if segment.seek(0, os.SEEK_END) != end:
+                logger.warning("dropping torn record at the end of the spool", extra={"segment": first_id, "offset": end})
+                segment.truncate(end)
+                os.fsync(segment.fileno())
+        self._segment = open(self._path(first_id), "ab", buffering=0)
+        self._segment_bytes = end
+        self._next_id = last_id + 1
+        self.synced_id = last_id
+
+    def _open_segment(self, first_id):
+        """
+        Start a new segment and sync its directory entry.
+
+        Parameters
+        ----------
+        first_id : int
+            Id of the first record of the segment.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._segment = open(self._path(first_id), "ab", buffering=0)
+        self._segment_bytes = 0
+        self._next_id = first_id
+        if not self._segments or self._segments[-1] != first_id:
+            self._segments.append(first_id)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def append(self, message, timeout=None):
+        """
+        Append a message and wait until it is on disk.
+
+        Parameters
+        ----------
+        message : dict
+            Decyphered message.
+
+        timeout : float, optional
+            Maximum seconds to wait for the sync. The default is None, no
+            limit.
+
+        Raises
+        ------
+        OSError
+            If the message could not be written or synced.
+
+        TimeoutError
+            If it was not synced within the timeout.
+
+        Returns
+        -------
+        int
+            Id of the record.
+
+        """
+        return self.append_many([message], timeout)[0]
+
+    def append_many(self, messages, timeout=None):
+        """
+        Append messages and wait until they are on disk.
+
+            The messages get consecutive ids and share one sync.
+
+        Parameters
+        ----------
+        messages : list
+            Decyphered messages.
+
+        timeout : float, optional
+            Maximum seconds to wait for the sync. The default is None, no
+            limit.
+
+        Raises
+        ------
+        OSError
+            If the messages could not be written or synced.
+
+        TimeoutError
+            If they were not synced within the timeout. They are kept and
+            may still be replayed.
+
+        Returns
+        -------
+        list
+            Id of the record of every message.
+
+        """
+        payloads = [json.dumps(message, separators=(",", ":")).encode() for message in messages]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            if self._closed:
+                raise OSError("spool is closed")
+            if self._torn:
+                raise OSError("spool has a torn record, it is dropped on restart")
+            if self._segment_bytes >= self.segment_size:
+                self._retired.append(self._segment)
+                self._open_segment(self._next_id)
+            first_id = self._next_id
+            last_id = first_id + len(payloads) - 1
+            records = b"".join(_HEADER.pack(first_id + i, len(payload), zlib.crc32(payload)) + payload
+                               for i, payload in enumerate(payloads))
+            self._write(records)
+            self._next_id += len(payloads)
+            self._segment_bytes += len(records)
+            self._written.notify()
+            # close() syncs whatever the sync thread left
+            while self.synced_id < last_id:
+                if self._failed_id >= last_id:
+                    raise OSError("spool could not be synced")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("spool was not synced in time")
+                self._synced.wait(remaining)
+        SPOOL_APPENDED.inc(len(payloads))
+        return list(range(first_id, first_id + len(payloads)))
+
+    def _write(self, records):
+        """
+        Write records at the end of the segment being appended to.
+
+            A write that fails is cut off again, so the records after it can
+            be read. Must be called with the lock held.
+
+        Parameters
+        ----------
+        records : bytes
+            Encoded records.
+
+        Raises
+        ------
+        OSError
+            If the records could not be written.
+
+        Returns
+        -------
+        None.
+
+        """
+        view = memoryview(records)
+        try:
+            while view:
+                view = view[self._segment.write(view):]
+        except OSError:
+            try:
+                os.ftruncate(self._segment.fileno(), self._segment_bytes)
+            except OSError:
+                logger.exception("could not drop a torn record from the spool")
+                self._torn = True
+            raise
+
+    def _sync_loop(self):
+        """
+        Sync appended records, at most once every fsync_interval seconds.
+
+            Appends keep being written while the segment is synced, they are
+            covered by the next sync. Appends waiting for a sync that failed
+            are woken up to fail.
+
+        Returns
+        -------
+        None.
+
+        """
+        last_sync = 0
+        while True:
+            with self._lock:
+                while self.synced_id == self._next_id - 1 and not self._closed:
+                    self._written.wait()
+                if self._closed:
+                    return
+            wait = last_sync + self.fsync_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            with self._lock:
+                target = self._next_id - 1
+                segments = self._retired + [self._segment]
+            try:
+                self._sync_segments(segments)
+            except OSError:
+                logger.exception("could not sync the spool")
+                with self._lock:
+                    self._failed_id = max(self._failed_id, target)
+                    self._synced.notify_all()
+                time.sleep(1)
+                continue
+            last_sync = time.monotonic()
+            with self._lock:
+                self.synced_id = max(self.synced_id, target)
+                self._synced.notify_all()
+
+    def _sync_segments(self, segments):
+        """
+        Sync segments to disk and close the full ones.
+
+        Parameters
+        ----------
+        segments : list
+            Retired segments followed by the segment being appended to.
+
+        Returns
+        -------
+        None.
+
+        """
+        for segment in segments:
+            os.fsync(segment.fileno())
+        SPOOL_SYNCS.inc()
+        with self._lock:
+            for segment in segments[:-1]:
+                self._retired.remove(segment)
+                segment.close()
+
+    def read(self, after_id, limit=500):
+        """
+        Get synced records after an id.
+
+            Consecutive reads continue where the previous one stopped without
+            scanning the segment again.
+
+        Parameters
+        ----------
+        after_id : int
+            Records up to this id are skipped.
+
+        limit : int, optional
+            Maximum number of records. The default is 500.
+
+        Returns
+        -------
+        list
+            (record_id, message) pairs, oldest first.
+
+        """
+        with self._lock:
+            synced_id = self.synced_id
+            segments = list(self._segments)
+        if after_id >= synced_id or not segments:
+            return []
+        i = max(bisect.bisect_right(segments, after_id + 1) - 1, 0)
+        offset = 0
+        if self._reader is not None and self._reader[0] == segments[i] and self._reader[2] == after_id:
+            offset = self._reader[1]
+        records = []
+        for first_id in segments[i:]:
+            if first_id > synced_id or len(records) >= limit:
+                break
+            with open(self._path(first_id), "rb") as segment:
+                segment.seek(offset)
+                while len(records) < limit:
+                    record = _read_record(segment)
+                    if record is None or record[0] > synced_id:
+                        break
+                    offset += record[2]
+                    if record[0] > after_id:
+                        records.append((record[0], json.loads(record[1])))
+                        self._reader = (first_id, offset, record[0])
+            offset = 0
+        return records
+
+    def wait(self, after_id, timeout=None):
+        """
+        Wait for records after an id to be synced.
+
+        Parameters
+        ----------
+        after_id : int
+            Id of the last record already seen.
+
+        timeout : float, optional
+            Maximum seconds to wait. The default is None, no limit.
+
+        Returns
+        -------
+        bool
+            True if there are synced records after the id.
+
+        """
+        with self._lock:
+            return self._synced.wait_for(lambda: self.synced_id > after_id or self._closed, timeout) and self.synced_id > after_id
+
+    def truncate(self, applied_id):
+        """
+        Delete segments whose records were all applied.
+
+            The segment being appended to is always kept.
+
+        Parameters
+        ----------
+        applied_id : int
+            Id of the last applied record.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            removable = []
+            while len(self._segments) > 1 and self._segments[1] <= applied_id + 1:
+                removable.append(self._segments.pop(0))
+        for first_id in removable:
+            os.remove(self._path(first_id))
+
+    def pending(self, applied_id):
+        """
+        Get the number of synced records after an id.
+
+        Parameters
+        ----------
+        applied_id : int
+            Id of the last applied record.
+
+        Returns
+        -------
+        int
+            Records.
+
+        """
+        with self._lock:
+            return max(self.synced_id - max(applied_id, self._segments[0] - 1), 0)
+
+    def size(self):
+        """
+        Get the bytes used by the segments.
+
+        Returns
+        -------
+        int
+            Bytes.
+
+        """
+        with self._lock:
+            segments = list(self._segments)
+        return sum(os.path.getsize(self._path(first_id)) for first_id in segments
+                   if os.path.exists(self._path(first_id)))
+
+    def close(self):
+        """
+        Sync and close the spool.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._written.notify_all()
+        self._thread.join()
+        with self._lock:
+            segments = self._retired + [self._segment]
+        self._sync_segments(segments)
+        with self._lock:
+            self.synced_id = self._next_id - 1
+            self._synced.notify_all()
+            self._segment.close()
+        self._lock_file.close()
+
+class SpoolReplayer():
+    """
+    Spool replayer.
+
+        Background thread that applies spooled messages to the database in
+        batches of up to ``batch_size``, each in one transaction together
+        with the id of its last message. A message that fails with one of
+        ``skip_errors``, raised by the message itself and never by the
+        database, is logged and skipped, so it does not hold up the spool.
+        Any other failure, like an unreachable database, a deadlock or a lock
+        wait timeout, keeps the message and is retried with a growing delay.
+
+    Attributes
+    ----------
+    spool : Spool
+        Spool replayed.
+
+    uploader : DbUploader
+        Uploader that applies the messages and owns their cached state.
+
+    name : string
+        Name the applied offset is stored under.
+
+    batch_size : int
+        Maximum number of messages applied together.
+
+    skip_errors : tuple
+        Exceptions that mean a message can never be applied.
+
+    applied_id : int
+        Id of the last applied record, None until it is read from the
+        database.
+
+    Methods
+    -------
+    start():
+        Start the replay thread.
+
+    run(function):
+        Run a function on the uploader after replaying the spool.
+
+    pending():
+        Get the number of records not applied yet.
+
+    stop(timeout):
+        Stop the replay thread.
+
+    """
+
+    def __init__(self, spool, uploader, name="spool", batch_size=500, retry_interval=1, max_retry_interval=30,
+                 skip_errors=(ValueError, KeyError, TypeError)) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        spool : Spool
+            Spool replayed.
+
+        uploader : DbUploader
+            Uploader that applies the messages.
+
+        name : string, optional
+            Name the applied offset is stored under. The default is "spool".
+
+        batch_size : int, optional
+            Maximum number of messages applied together. The default is 500.
+
+        retry_interval : float, optional
+            Seconds before the first retry while the database fails. The
+            default is 1.
+
+        max_retry_interval : float, optional
+            Maximum seconds between retries. The default is 30.
+
+        skip_errors : tuple, optional
+            Exceptions that mean a message can never be applied, so it is
+            skipped. The default is (ValueError, KeyError, TypeError).
+
+        Returns
+        -------
+        None.
+
+        """
+        self.spool = spool
+        self.uploader = uploader
+        self.name = name
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.skip_errors = skip_errors
+        self.applied_id = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the replay thread.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._thread = threading.Thread(target=self._work, name="spool-replayer", daemon=True)
+        self._thread.start()
+
+    def run(self, function):
+        """
+        Run a function on the uploader after replaying the spool.
+
+            Everything spooled before the call is applied first, so the
+            function sees the state those messages left.
+
+        Parameters
+        ----------
+        function : callable
+            Called with the uploader.
+
+        Returns
+        -------
+        object
+            Value returned by the function.
+
+        """
+        with self._lock:
+            self._replay()
+            return function(self.uploader)
+
+    def pending(self):
+        """
+        Get the number of records not applied yet.
+
+        Returns
+        -------
+        int
+            Records, None until the applied offset was read.
+
+        """
+        if self.applied_id is None:
+            return None
+        return self.spool.pending(self.applied_id)
+
+    def stop(self, timeout=None):
+        """
+        Stop the replay thread after the batch it is applying.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum seconds to wait for the thread.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _work(self):
+        delay = self.retry_interval
+        while not self._stopping.is_set():
+            try:
+                with self._lock:
+                    self._replay()
+                delay = self.retry_interval
+            except Exception:
+                logger.warning("could not replay the spool, retrying in {s} seconds".format(s=delay), exc_info=True)
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+                continue
+            self.spool.wait(self.applied_id, timeout=1)
+
+    def _replay(self):
+        """
+        Apply every synced record, holding the lock.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.applied_id is None:
+            self.applied_id = self.uploader.fetch_spool_offset(self.name)
+        while not self._stopping.is_set():
+            records = self.spool.read(self.applied_id, self.batch_size)
+            if not records:
+                break
+            self._apply(records)
+            self.spool.truncate(self.applied_id)
+
+    def _apply(self, records):
+        """
+        Apply records to the database, splitting the batch if it fails.
+
+        Parameters
+        ----------
+        records : list
+            (record_id, message) pairs, oldest first.
+
+        Raises
+        ------
+        Exception
+            If a message failed with an error not in skip_errors, the message
+            and those after it are kept.
+
+        Returns
+        -------
+        None.
+
+        """
+        try:
+            self.uploader.apply_spooled_messages([message for _, message in records], self.name, records[-1][0])
+            self.applied_id = records[-1][0]
+            SPOOL_REPLAYED.inc(len(records))
+            return
+        except Exception as error:
+            if len(records) > 1:
+                logger.warning("could not replay batch of spooled messages, retrying one by one",
+                               extra={"messages": len(records)}, exc_info=True)
+                for record in records:
+                    self._apply([record])
+                return
+            if not isinstance(error, self.skip_errors):
+                raise
+            failure = error
+        record_id, message = records[0]
+        logger.error("skipping spooled message that could not be applied",
+                     extra={"store_id": message.get("store_id"), "record_id": record_id}, exc_info=failure)
+        self.uploader.skip_spooled_message(self.name, record_id)
+        self.applied_id = record_id
+        SPOOL_SKIPPED.inc()
@@ -0,0 +1,343 @@
+"""
+Statements.
+
+    Registry of every SQL statement the handler runs and a per-connection
+    cache of the server-side prepared statements built from them.
+
+Classes:
+    Statement
+
+    StatementCache
+
+Variables:
+    MAX_PLACEHOLDERS
+
+    MAX_STATEMENT_ROWS
+
+    EXACT_STATEMENT_ROWS
+
+    STATEMENTS
+
+"""
+#_________________________________Libraries____________________________________
+from collections import OrderedDict
+import string
+
+#__________________________________Classes_____________________________________
+class Statement():
+    """
+    Statement.
+
+        Parameterized SQL statement. Statements that take a variable number
+        of values, like multi-row inserts, declare groups that are repeated
+        once per value when the statement is rendered.
+
+        Such statements are run in chunks whose number of values is a power
+        of two or at most EXACT_STATEMENT_ROWS, so a connection only ever
+        prepares a few versions of them, and at most ``max_rows``, so they
+        stay under the placeholder limit of MySQL. Statements whose values may be repeated without changing
+        what they do, like IN lists, are padded with their last value up to
+        the next power of two instead, and most of them run as one chunk.
+
+    Attributes
+    ----------
+    sql : string
+        SQL with %s placeholders and a {name} field for every group.
+
+    groups : dict
+        Group name to (placeholder text, separator).
+
+    pad : bool
+        Values may be repeated, so the last chunk is padded.
+
+    max_rows : int
+        Maximum number of values of one chunk.
+
+    Methods
+    -------
+    render(count):
+        Get the SQL for the given number of values.
+
+    chunks(params, count):
+        Split a statement with repeated groups into chunks.
+
+    """
+
+    def __init__(self, sql, groups=None, pad=False) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        sql : string
+            SQL with %s placeholders and a {name} field for every group.
+
+        groups : dict, optional
+            Group name to (placeholder text, separator).
+
+        pad : bool, optional
+            Values may be repeated without changing what the statement does.
+            The default is False.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sql = " ".join(sql.split())
+        self.groups = groups or {}
+        self.pad = pad
+        self._rendered = {}
+        # (fixed placeholders, group) in the order they appear in the SQL
+        self._layout = [(literal.count("%s"), name)
+                        for literal, name, _, _ in string.Formatter().parse(self.sql)]
+        fixed = sum(placeholders for placeholders, _ in self._layout)
+        width = sum(text.count("%s") for text, _ in self.groups.values())
+        max_rows = min(MAX_STATEMENT_ROWS, (MAX_PLACEHOLDERS - fixed) // max(width, 1))
+        self.max_rows = 1 << (max_rows.bit_length() - 1)
+
+    def render(self, count=1):
+        """
+        Get the SQL for the given number of values.
+
+        Parameters
+        ----------
+        count : int, optional
+            Times every group is repeated. The default is 1.
+
+        Returns
+        -------
+        string
+            SQL ready to be prepared.
+
+        """
+        if not self.groups:
+            return self.sql
+        sql = self._rendered.get(count)
+        if sql is None:
+            sql = self.sql.format(**{name: separator.join([text] * count)
+                                     for name, (text, separator) in self.groups.items()})
+            self._rendered[count] = sql
+        return sql
+
+    def chunks(self, params=(), count=1):
+        """
+        Split a statement with repeated groups into chunks.
+
+            Values are taken in chunks of ``max_rows``, and the rest in
+            decreasing powers of two, or padded up to the next one, until at
+            most EXACT_STATEMENT_ROWS are left for the last chunk.
+
+        Parameters
+        ----------
+        params : sequence, optional
+            Values bound to the placeholders, for ``count`` values.
+
+        count : int, optional
+            Times every group is repeated. The default is 1.
+
+        Returns
+        -------
+        list
+            (sql, params) of every chunk, in order.
+
+        """
+        if not self.groups or count <= EXACT_STATEMENT_ROWS or (count <= self.max_rows and count & (count - 1) == 0):
+            return [(self.render(count), tuple(params))]
+        parts = []
+        position = 0
+        for placeholders, name in self._layout:
+            parts.append((False, params[position:position + placeholders]))
+            position += placeholders
+            if name is not None:
+                width = self.groups[name][0].count("%s")
+                parts.append((True, [params[position + row * width:position + (row + 1) * width]
+                                     for row in range(count)]))
+                position += width * count
+        chunks = []
+        start = 0
+        while start < count:
+            left = count - start
+            if left >= self.max_rows:
+                size = self.max_rows
+            elif left <= EXACT_STATEMENT_ROWS:
+                size = left
+            elif self.pad:
+                size = 1 << (left - 1).bit_length()
+            else:
+                size = 1 << (left.bit_length() - 1)
+            taken = min(size, left)
+            chunk = []
+            for repeated, values in parts:
+                if not repeated:
+                    chunk.extend(values)
+                    continue
+                rows = values[start:start + taken]
+                for row in rows + rows[-1:] * (size - taken):
+                    chunk.extend(row)
+            chunks.append((self.render(size), tuple(chunk)))
+            start += taken
+        return chunks
+
+class StatementCache():
+    """
+    Statement cache.
+
+        Prepared cursors of one connection, keyed by their SQL. A prepared
+        cursor keeps its statement prepared on the server, so executing the
+        same SQL again only sends the parameters. The least recently used
+        cursors are closed when more than ``max_statements`` are cached.
+
+    Attributes
+    ----------
+    connection : DB-API Connection
+        Connection the statements are prepared on.
+
+    max_statements : int
+        Maximum number of prepared statements kept.
+
+    Methods
+    -------
+    cursor(sql):
+        Get the prepared cursor for a statement.
+
+    close():
+        Close every prepared cursor.
+
+    """
+
+    def __init__(self, connection, max_statements=64) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        connection : DB-API Connection
+            Connection the statements are prepared on.
+
+        max_statements : int, optional
+            Maximum number of prepared statements kept. The default is 64.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.connection = connection
+        self.max_statements = max_statements
+        self._cursors = OrderedDict()
+
+    def cursor(self, sql):
+        """
+        Get the prepared cursor for a statement.
+
+        Parameters
+        ----------
+        sql : string
+            Rendered statement.
+
+        Returns
+        -------
+        DB-API Cursor
+            Prepared cursor.
+
+        """
+        cursor = self._cursors.get(sql)
+        if cursor is not None:
+            self._cursors.move_to_end(sql)
+            return cursor
+        cursor = self.connection.cursor(prepared=True)
+        self._cursors[sql] = cursor
+        while len(self._cursors) > self.max_statements:
+            self._cursors.popitem(last=False)[1].close()
+        return cursor
+
+    def close(self):
+        """
+        Close every prepared cursor.
+
+        Returns
+        -------
+        None.
+
+        """
+        while self._cursors:
+            self._cursors.popitem(last=False)[1].close()
+
+#__________________________________Variables___________________________________
+# placeholders MySQL takes in one prepared statement
+MAX_PLACEHOLDERS = 65535
+# values of one chunk of a statement with repeated groups
+MAX_STATEMENT_ROWS = 512
+# values a chunk takes as they are, below that a power of two is not needed
+EXACT_STATEMENT_ROWS = 8
+
+STATEMENTS = {
+    "fetch_all_product_ids": Statement(
+        "SELECT Product.ean, Product.id_product FROM Product"),
+    "fetch_product_ids": Statement(
+        "SELECT Product.ean, Product.id_product FROM Product WHERE Product.ean IN ({values})",
+        {"values": ("%s", ", ")}, pad=True),
+    "fetch_inventory_snapshot": Statement(
+        """SELECT Product.ean, Inventory.id_product, Inventory.stock, Inventory.min_stock, Inventory.max_stock
+        FROM Inventory
+        INNER JOIN Product ON Inventory.id_product = Product.id_product
+        WHERE Inventory.id_store = %s"""),
+    "fetch_device_store": Statement(
+        "SELECT StoreDevice.device_key, StoreDevice.id_store FROM StoreDevice WHERE StoreDevice.device_key = %s"),
+    "fetch_spool_offset": Statement(
+        "SELECT SpoolOffset.spool_name, SpoolOffset.record_id FROM SpoolOffset WHERE SpoolOffset.spool_name = %s"),
+    "fetch_store_state": Statement(
+        "SELECT Store.id_store, Store.status, Store.revision, Store.notified_status FROM Store WHERE Store.id_store = %s"),
+    "fetch_store_statuses": Statement(
+        "SELECT Store.id_store, Store.status FROM Store"),
+    "fetch_fleet_inventory": Statement(
+        "SELECT Inventory.id_store, Inventory.stock, Inventory.min_stock, Inventory.max_stock FROM Inventory"),
+    "register_new_store": Statement(
+        """INSERT INTO Store(name, status, latitude, longitude, state, municipality, zip_code, address)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""),
+    "register_store_device": Statement(
+        "INSERT INTO StoreDevice(device_key, id_store) VALUES (%s, %s)"),
+    "register_new_inventories": Statement(
+        "INSERT INTO Inventory(id_product, id_store, stock, min_stock, max_stock) VALUES {rows}",
+        {"rows": ("(%s, %s, %s, %s, %s)", ", ")}),
+    "register_new_sales": Statement(
+        "INSERT INTO Sale(id_product, id_store, timestamp, quantity) VALUES {rows}",
+        {"rows": ("(%s, %s, %s, %s)", ", ")}),
+    "add_hourly_sales": Statement(
+        """INSERT INTO SaleHourly(id_store, id_product, sale_hour, quantity, sales) VALUES {rows}
+        ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity), sales = sales + VALUES(sales)""",
+        {"rows": ("(%s, %s, %s, %s, %s)", ", ")}),
+    "add_daily_sales": Statement(
+        """INSERT INTO SaleDaily(id_store, sale_day, quantity, sales) VALUES {rows}
+        ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity), sales = sales + VALUES(sales)""",
+        {"rows": ("(%s, %s, %s, %s)", ", ")}),
+    "set_spool_offset": Statement(
+        """INSERT INTO SpoolOffset(spool_name, record_id) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE record_id = VALUES(record_id)"""),
+    "create_notifications": Statement(
+        "INSERT INTO Notification(id_store, new_status) VALUES {rows}",
+        {"rows": ("(%s, %s)", ", ")}),
+    "set_notified_statuses": Statement(
+        """UPDATE Store SET notified_status = CASE id_store {cases} ELSE notified_status END
+        WHERE id_store IN ({values})""",
+        {"cases": ("WHEN %s THEN %s", " "), "values": ("%s", ", ")}, pad=True),
+    "update_inventories": Statement(
+        """UPDATE Inventory SET stock = CASE id_product {cases} ELSE stock END
+        WHERE id_store = %s AND id_product IN ({values})""",
+        {"cases": ("WHEN %s THEN %s", " "), "values": ("%s", ", ")}, pad=True),
+    "check_store_revisions": Statement(
+        "SELECT Store.id_store, Store.revision FROM Store WHERE {stores}",
+        {"stores": ("(id_store = %s AND revision = %s)", " OR ")}, pad=True),
+    "guard_store_revisions": Statement(
+        "UPDATE Store SET revision = revision + 1 WHERE {stores}",
+        {"stores": ("(id_store = %s AND revision = %s)", " OR ")}, pad=True),
+    "set_store_statuses": Statement(
+        """UPDATE Store SET status = CASE id_store {cases} ELSE status END, revision = revision + 1
+        WHERE id_store IN ({values})""",
+        {"cases": ("WHEN %s THEN %s", " "), "values": ("%s", ", ")}, pad=True),
+    "update_store_statuses": Statement(
+        """UPDATE Store SET status = CASE id_store {cases} ELSE status END
+        WHERE id_store IN ({values})""",
+        {"cases": ("WHEN %s THEN %s", " "), "values": ("%s", ", ")}, pad=True),
+}
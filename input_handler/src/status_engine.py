@@ -0,0 +1,262 @@
+"""
+Status engine.
+
+    Computes store statuses from how full their inventories are, for a
+    single store while a message is handled or for the whole fleet at once.
+
+    A store is full (status 1) when the mean normalized fill of its products,
+    (stock - min_stock) / (max_stock - min_stock), is above the full threshold,
+    empty (status 3) when it is at or below the empty threshold and half full
+    (status 2) otherwise. Products whose minimum and maximum stock are equal
+    are left out of the mean.
+
+    With a hysteresis band a store only changes status once its fill is past
+    the threshold by the width of the band, so a store sitting right on a
+    threshold does not flip on every message.
+
+    Run this module to recompute the status of every store:
+        python status_engine.py [--full 0.75] [--empty 0.25] [--band 0.05] [--dry-run]
+
+Functions:
+    status_from_fill(mean, full_threshold, empty_threshold) -> int
+
+    status_with_hysteresis(mean, current_status, full_threshold, empty_threshold, band) -> int
+
+    compute_store_statuses(store_ids, stocks, mins_stock, maxs_stock, full_threshold, empty_threshold, current_statuses, band) -> tuple
+
+    recompute_fleet_statuses(uploader, full_threshold, empty_threshold, dry_run, band) -> dict
+
+    main() -> None
+
+"""
+#_________________________________Libraries____________________________________
+import argparse
+
+import numpy as np
+
+#__________________________________Variables___________________________________
+FULL_THRESHOLD = 0.75
+EMPTY_THRESHOLD = 0.25
+HYSTERESIS_BAND = 0.05
+
+#_________________________________Functions____________________________________
+def status_from_fill(mean, full_threshold=FULL_THRESHOLD, empty_threshold=EMPTY_THRESHOLD):
+    """
+    Get the status of a store from its mean normalized fill.
+
+    Parameters
+    ----------
+    mean : float
+        Mean normalized fill of the products of the store.
+
+    full_threshold : float, optional
+        Fill above which the store is full. The default is FULL_THRESHOLD.
+
+    empty_threshold : float, optional
+        Fill at or below which the store is empty. The default is
+        EMPTY_THRESHOLD.
+
+    Returns
+    -------
+    int
+        1 full, 2 half full or 3 empty.
+
+    """
+    if mean > full_threshold:
+        return 1
+    elif mean > empty_threshold:
+        return 2
+    return 3
+
+def status_with_hysteresis(mean, current_status, full_threshold=FULL_THRESHOLD,
+                           empty_threshold=EMPTY_THRESHOLD, band=HYSTERESIS_BAND):
+    """
+    Get the status of a store from its mean fill and its current status.
+
+        Moving to a fuller status takes a fill above the thresholds plus the
+        band, moving to an emptier one a fill at or below the thresholds
+        minus the band. Otherwise the current status is kept.
+
+    Parameters
+    ----------
+    mean : float
+        Mean normalized fill of the products of the store.
+
+    current_status : int
+        Current status, None if unknown.
+
+    full_threshold : float, optional
+        Fill above which the store is full. The default is FULL_THRESHOLD.
+
+    empty_threshold : float, optional
+        Fill at or below which the store is empty. The default is
+        EMPTY_THRESHOLD.
+
+    band : float, optional
+        Width of the hysteresis band. The default is HYSTERESIS_BAND.
+
+    Returns
+    -------
+    int
+        1 full, 2 half full or 3 empty.
+
+    """
+    new_status = status_from_fill(mean, full_threshold, empty_threshold)
+    if current_status is None or band <= 0 or new_status == current_status:
+        return new_status
+    if new_status < current_status:
+        return min(status_from_fill(mean, full_threshold + band, empty_threshold + band), current_status)
+    return max(status_from_fill(mean, full_threshold - band, empty_threshold - band), current_status)
+
+def _statuses_from_fill(means, full_threshold, empty_threshold):
+    return np.where(means > full_threshold, 1, np.where(means > empty_threshold, 2, 3))
+
+def compute_store_statuses(store_ids, stocks, mins_stock, maxs_stock,
+                           full_threshold=FULL_THRESHOLD, empty_threshold=EMPTY_THRESHOLD,
+                           current_statuses=None, band=0):
+    """
+    Compute the status of many stores at once.
+
+        Takes one entry per Inventory row and reduces them per store.
+
+    Parameters
+    ----------
+    store_ids : numpy array
+        Id of the store of every row.
+
+    stocks : numpy array
+        Stock of every row.
+
+    mins_stock : numpy array
+        Minimum stock of every row.
+
+    maxs_stock : numpy array
+        Maximum stock of every row.
+
+    full_threshold : float, optional
+        Fill above which a store is full. The default is FULL_THRESHOLD.
+
+    empty_threshold : float, optional
+        Fill at or below which a store is empty. The default is
+        EMPTY_THRESHOLD.
+
+    current_statuses : dict, optional
+        Store id to current status, for the hysteresis band.
+
+    band : float, optional
+        Width of the hysteresis band. The default is 0, no hysteresis.
+
+    Returns
+    -------
+    stores : numpy array
+        Id of every store, once.
+
+    statuses : numpy array
+        Status of every store in ``stores``.
+
+    """
+    stocks = np.asarray(stocks, dtype=np.float64)
+    mins_stock = np.asarray(mins_stock, dtype=np.float64)
+    maxs_stock = np.asarray(maxs_stock, dtype=np.float64)
+    stores, rows_store = np.unique(np.asarray(store_ids), return_inverse=True)
+    spans = maxs_stock - mins_stock
+    valid = (spans != 0) & ~np.isnan(spans) & ~np.isnan(stocks)
+    fill = np.zeros(len(stocks))
+    np.divide(stocks - mins_stock, spans, out=fill, where=valid)
+    sums = np.bincount(rows_store, weights=fill, minlength=len(stores))
+    counts = np.bincount(rows_store, weights=valid, minlength=len(stores))
+    means = np.zeros(len(stores))
+    np.divide(sums, counts, out=means, where=counts > 0)
+    statuses = _statuses_from_fill(means, full_threshold, empty_threshold)
+    if current_statuses and band > 0:
+        current = np.array([current_statuses.get(store_id) or 0 for store_id in stores.tolist()])
+        fuller = np.minimum(_statuses_from_fill(means, full_threshold + band, empty_threshold + band), current)
+        emptier = np.maximum(_statuses_from_fill(means, full_threshold - band, empty_threshold - band), current)
+        moved = np.where(statuses < current, fuller, emptier)
+        statuses = np.where((current == 0) | (statuses == current), statuses, moved)
+    return stores, statuses
+
+def recompute_fleet_statuses(uploader, full_threshold=FULL_THRESHOLD, empty_threshold=EMPTY_THRESHOLD, dry_run=False, band=0):
+    """
+    Recompute the status of every store with inventory.
+
+        The whole Inventory table is read into NumPy columns, statuses are
+        computed with grouped reductions, and only the stores whose status
+        changed are written, with one bulk update and one bulk notification
+        insert in a single transaction.
+
+    Parameters
+    ----------
+    uploader : DbUploader
+        Uploader used to read and write the database.
+
+    full_threshold : float, optional
+        Fill above which a store is full. The default is FULL_THRESHOLD.
+
+    empty_threshold : float, optional
+        Fill at or below which a store is empty. The default is
+        EMPTY_THRESHOLD.
+
+    dry_run : bool, optional
+        Only compute the changes without writing them. The default is False.
+
+    band : float, optional
+        Width of the hysteresis band. The default is 0, no hysteresis.
+
+    Returns
+    -------
+    changed : dict
+        Store id to new status, for every store whose status changed.
+
+    """
+    with uploader.transaction():
+        inventory = uploader.fetch_fleet_inventory()
+        current_statuses = uploader.fetch_store_statuses()
+        stores, statuses = compute_store_statuses(inventory["store_id"], inventory["stock"],
+                                                  inventory["min_stock"], inventory["max_stock"],
+                                                  full_threshold, empty_threshold,
+                                                  current_statuses, band)
+        changed = {}
+        for store_id, status in zip(stores.tolist(), statuses.tolist()):
+            if current_statuses.get(store_id) != status:
+                changed[store_id] = status
+        if not dry_run and changed:
+            uploader.update_store_statuses(changed)
+            uploader.create_notifications(list(changed.items()))
+    if not dry_run and changed:
+        uploader.evict_stores(changed)
+    return changed
+
+def main():
+    """
+    Recompute the status of every store from the command line.
+
+    Returns
+    -------
+    None.
+
+    """
+    parser = argparse.ArgumentParser(description="Recompute the status of every store.")
+    parser.add_argument("--full", type=float, default=None,
+                        help="fill above which a store is full (default STATUS_FULL_THRESHOLD)")
+    parser.add_argument("--empty", type=float, default=None,
+                        help="fill at or below which a store is empty (default STATUS_EMPTY_THRESHOLD)")
+    parser.add_argument("--band", type=float, default=None,
+                        help="width of the hysteresis band (default STATUS_HYSTERESIS)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the changes without writing them")
+    args = parser.parse_args()
+
+    # not hardware_coms, importing it starts the server
+    import db_uploader
+    full_threshold = db_uploader.STATUS_FULL_THRESHOLD if args.full is None else args.full
+    empty_threshold = db_uploader.STATUS_EMPTY_THRESHOLD if args.empty is None else args.empty
+    band = db_uploader.STATUS_HYSTERESIS if args.band is None else args.band
+    changed = recompute_fleet_statuses(db_uploader.DbUploader(), full_threshold, empty_threshold, args.dry_run, band)
+    for store_id, status in sorted(changed.items()):
+        print("store {s}: status {t}".format(s=store_id, t=status))
+    print("{n} stores {v}".format(n=len(changed), v="would change" if args.dry_run else "changed"))
+
+#____________________________________Main______________________________________
+if __name__ == '__main__':
+    main()
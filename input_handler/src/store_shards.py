@@ -0,0 +1,595 @@
+"""
+Store shards.
+
+    Store-affinity processing of device messages on worker processes. Every
+    store is owned by one shard process, picked by rendezvous hashing of its
+    id, so its messages are applied one after the other, in the order they
+    were dispatched, by the process whose caches hold its state. Shards share
+    nothing but the database, so they take no lock from each other and
+    decryption aside the handler scales with the number of cores.
+
+    Rendezvous hashing keeps most stores in place when the number of shards
+    changes: adding a shard only moves the stores the new shard wins, and
+    removing one only moves the stores it owned.
+
+Classes:
+    StoreShards
+
+Functions:
+    shard_for(store_id, shards) -> int
+
+"""
+#_________________________________Libraries____________________________________
+import concurrent.futures
+from concurrent.futures import Future
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+
+from metrics import METRICS
+
+#__________________________________Variables___________________________________
+logger = logging.getLogger(__name__)
+
+SHARD_DISPATCHED = METRICS.counter("handler_shard_dispatched_total", "Messages and calls dispatched, by shard.")
+SHARD_RESTARTS = METRICS.counter("handler_shard_restarts_total", "Shard processes restarted after they died.")
+
+# name of the items that carry a constant message
+MESSAGE = "message"
+# seconds between checks of the shard processes
+CHECK_INTERVAL = 1
+
+#_________________________________Functions____________________________________
+def shard_for(store_id, shards):
+    """
+    Get the shard that owns a store.
+
+        The store goes to the shard with the highest hash of the pair of shard
+        and store.
+
+    Parameters
+    ----------
+    store_id : string
+        Id of store.
+
+    shards : int
+        Number of shards.
+
+    Returns
+    -------
+    int
+        Index of the shard.
+
+    """
+    key = str(store_id).encode()
+    scores = [hashlib.blake2b(b"%d:%s" % (shard, key), digest_size=8).digest() for shard in range(shards)]
+    return scores.index(max(scores))
+
+def _picklable(error):
+    """
+    Get an exception that can be sent back to the dispatcher.
+
+    Parameters
+    ----------
+    error : Exception
+        Exception raised in the shard.
+
+    Returns
+    -------
+    Exception
+        Same exception, or a RuntimeError with its message.
+
+    """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(str(error))
+
+def _call(uploader, index, name, args):
+    """
+    Run a call on the uploader of a shard.
+
+    Parameters
+    ----------
+    uploader : DbUploader
+        Uploader of the shard.
+
+    index : int
+        Index of the shard.
+
+    name : string
+        Method of the uploader, or "rebalance" with the new number of shards
+        to drop the cached stores the shard no longer owns.
+
+    args : tuple
+        Arguments.
+
+    Returns
+    -------
+    object
+        Value returned by the method.
+
+    """
+    if name == "rebalance":
+        for store_id in uploader.inventory_cache.store_ids():
+            if shard_for(store_id, args[0]) != index:
+                uploader.inventory_cache.evict(store_id)
+        return None
+    return getattr(uploader, name)(*args)
+
+def _work(index, inbox, outbox, settings, make_uploader, batch_size, coalesce_window):
+    """
+    Handle the messages of one shard until it is stopped.
+
+        Runs in the shard process. Constant messages are applied in
+        micro-batches like in the ingest queue, anything else is a call on
+        the uploader.
+
+    Parameters
+    ----------
+    index : int
+        Index of the shard.
+
+    inbox : multiprocessing.Queue
+        Queue of the shard.
+
+    outbox : multiprocessing.Queue
+        Queue of results, shared by every shard.
+
+    settings : dict
+        handler_keys values to use.
+
+    make_uploader : bytes
+        Pickled callable that returns the uploader of the shard, loaded once
+        the settings are in place.
+
+    batch_size : int
+        Maximum number of messages handled together.
+
+    coalesce_window : float
+        Seconds to wait to fill a batch.
+
+    Returns
+    -------
+    None.
+
+    """
+    import handler_keys
+    for name, value in settings.items():
+        setattr(handler_keys, name, value)
+    uploader = pickle.loads(make_uploader)()
+    stopping = False
+    while not stopping:
+        items = [inbox.get()]
+        deadline = time.monotonic() + coalesce_window
+        while len(items) < batch_size and items[-1] is not None and items[-1][1] == MESSAGE:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    items.append(inbox.get(timeout=remaining))
+                else:
+                    items.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+        messages = [item for item in items if item is not None and item[1] == MESSAGE]
+        if len(messages) > 0:
+            try:
+                errors = uploader.apply_constant_messages([args[0] for _, _, args in messages])
+            except Exception as error:
+                logger.exception("could not handle batch of sharded messages", extra={"shard": index, "messages": len(messages)})
+                errors = [str(error)] * len(messages)
+            for (ticket, _, _), error in zip(messages, errors):
+                outbox.put((ticket, True, error))
+        last = items[-1]
+        if last is None:
+            stopping = True
+        elif last[1] != MESSAGE:
+            ticket, name, args = last
+            try:
+                outbox.put((ticket, True, _call(uploader, index, name, args)))
+            except Exception as error:
+                outbox.put((ticket, False, _picklable(error)))
+
+#__________________________________Classes_____________________________________
+class StoreShards():
+    """
+    Store shards.
+
+        Dispatches decyphered messages and calls to the shard process that
+        owns their store. Every shard process builds its own uploader, so
+        each has its own connections and caches, and a shard process that
+        dies is started again with empty caches, failing what was dispatched
+        to it. Results come back as futures.
+
+    Attributes
+    ----------
+    make_uploader : callable
+        Picklable callable that returns the uploader of a shard process.
+
+    shards : int
+        Number of shards.
+
+    settings : dict
+        handler_keys values the shard processes use.
+
+    batch_size : int
+        Maximum number of messages a shard handles together.
+
+    max_depth : int
+        Maximum number of items waiting on each shard.
+
+    coalesce_window : float
+        Seconds a shard waits to fill a batch.
+
+    Methods
+    -------
+    start():
+        Start the shard processes.
+
+    shard_of(store_id):
+        Get the shard that owns a store.
+
+    submit(store_id, message):
+        Dispatch a constant message.
+
+    run(store_id, name, *args):
+        Dispatch a call on the uploader of the shard of a store.
+
+    broadcast(name, *args):
+        Dispatch a call on the uploader of every shard.
+
+    resize(shards):
+        Change the number of shards.
+
+    depth():
+        Get the number of dispatched items without result.
+
+    stop(timeout):
+        Finish the dispatched items and stop the shards.
+
+    """
+
+    def __init__(self, make_uploader, shards, settings=None, batch_size=32, max_depth=10000, coalesce_window=0) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        make_uploader : callable
+            Picklable callable that returns the uploader of a shard process.
+
+        shards : int
+            Number of shards.
+
+        settings : dict, optional
+            handler_keys values the shard processes use, so settings changed
+            at run time reach them too. The default is None.
+
+        batch_size : int, optional
+            Maximum number of messages handled together. The default is 32.
+
+        max_depth : int, optional
+            Maximum number of items waiting on each shard. The default is
+            10000.
+
+        coalesce_window : float, optional
+            Seconds a shard waits to fill a batch. The default is 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.make_uploader = make_uploader
+        self.shards = shards
+        self.settings = settings or {}
+        self.batch_size = batch_size
+        self.max_depth = max_depth
+        self.coalesce_window = coalesce_window
+        # spawned, so no lock or connection of this process is inherited
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        # (process, queue) of every shard
+        self._workers = []
+        # ticket to (shard, future) of every item without result
+        self._pending = {}
+        self._tickets = itertools.count()
+        # guards the shards and pending items
+        self._lock = threading.Lock()
+        # held while dispatching, and by resize to hold dispatching back
+        self._dispatch_lock = threading.Lock()
+        self._collector = None
+        self._stopping = False
+        self._stopped = False
+
+    def _start_worker(self, index):
+        inbox = self._context.Queue(maxsize=self.max_depth)
+        process = self._context.Process(target=_work,
+                                        args=(index, inbox, self._outbox, self.settings,
+                                              pickle.dumps(self.make_uploader),
+                                              self.batch_size, self.coalesce_window),
+                                        name="store-shard-{i}".format(i=index), daemon=True)
+        process.start()
+        return process, inbox
+
+    def start(self):
+        """
+        Start the shard processes.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._workers = [self._start_worker(i) for i in range(self.shards)]
+        self._collector = threading.Thread(target=self._collect, name="shard-collector", daemon=True)
+        self._collector.start()
+
+    def shard_of(self, store_id):
+        """
+        Get the shard that owns a store.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        Returns
+        -------
+        int
+            Index of the shard.
+
+        """
+        return shard_for(store_id, self.shards)
+
+    def _send(self, shard, name, args):
+        future = Future()
+        with self._lock:
+            ticket = next(self._tickets)
+            self._pending[ticket] = (shard, future)
+            try:
+                self._workers[shard][1].put_nowait((ticket, name, args))
+            except queue.Full:
+                del self._pending[ticket]
+                raise
+        SHARD_DISPATCHED.inc(shard=str(shard))
+        return future
+
+    def _dispatch(self, store_id, name, args):
+        with self._dispatch_lock:
+            return self._send(shard_for(store_id, self.shards), name, args)
+
+    def submit(self, store_id, message):
+        """
+        Dispatch a constant message.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of the store that sent the message.
+
+        message : dict
+            Decyphered message.
+
+        Raises
+        ------
+        queue.Full
+            If the shard of the store is too far behind.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            None once the message is applied, otherwise the error.
+
+        """
+        return self._dispatch(store_id, MESSAGE, (message,))
+
+    def run(self, store_id, name, *args):
+        """
+        Dispatch a call on the uploader of the shard of a store.
+
+            The call runs after the items of the store that were already
+            dispatched.
+
+        Parameters
+        ----------
+        store_id : string
+            Id of store.
+
+        name : string
+            Method of the uploader.
+
+        *args : object
+            Picklable arguments of the method.
+
+        Raises
+        ------
+        queue.Full
+            If the shard of the store is too far behind.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Value returned by the method.
+
+        """
+        return self._dispatch(store_id, name, args)
+
+    def broadcast(self, name, *args):
+        """
+        Dispatch a call on the uploader of every shard.
+
+            Shards too far behind to take the call are logged and skipped.
+
+        Parameters
+        ----------
+        name : string
+            Method of the uploader.
+
+        *args : object
+            Picklable arguments of the method.
+
+        Returns
+        -------
+        list
+            concurrent.futures.Future of the value returned by every shard
+            that took the call.
+
+        """
+        futures = []
+        with self._dispatch_lock:
+            for shard in range(self.shards):
+                try:
+                    futures.append(self._send(shard, name, args))
+                except queue.Full:
+                    logger.warning("shard is full, call not broadcast to it", extra={"shard": shard, "call": name})
+        return futures
+
+    def resize(self, shards, timeout=None):
+        """
+        Change the number of shards.
+
+            Dispatching waits while every shard finishes what it was given
+            and drops the cached stores it will no longer own, so a store
+            that moves is read back from the database by its new shard and
+            its messages stay in order. Shards are then started or stopped.
+
+        Parameters
+        ----------
+        shards : int
+            New number of shards.
+
+        timeout : float, optional
+            Seconds to wait for each shard.
+
+        Raises
+        ------
+        ValueError
+            If the number of shards is below one.
+
+        concurrent.futures.TimeoutError
+            If a shard did not finish in time, then the shards are not
+            changed.
+
+        Returns
+        -------
+        None.
+
+        """
+        if shards < 1:
+            raise ValueError("at least one shard is needed")
+        with self._dispatch_lock:
+            barriers = [self._send(i, "rebalance", (shards,)) for i in range(self.shards)]
+            for i, barrier in enumerate(barriers):
+                try:
+                    barrier.result(timeout)
+                except concurrent.futures.TimeoutError:
+                    raise
+                except Exception:
+                    # a restarted shard has nothing cached
+                    logger.warning("shard did not rebalance", extra={"shard": i}, exc_info=True)
+            with self._lock:
+                removed = self._workers[shards:]
+                self._workers = self._workers[:shards] + [self._start_worker(i) for i in range(self.shards, shards)]
+                self.shards = shards
+            for process, inbox in removed:
+                inbox.put(None)
+            for process, inbox in removed:
+                process.join(timeout)
+        logger.info("resized shards", extra={"shards": shards})
+
+    def depth(self):
+        """
+        Get the number of dispatched items without result.
+
+        Returns
+        -------
+        int
+            Items waiting on or being handled by every shard.
+
+        """
+        return len(self._pending)
+
+    def stop(self, timeout=None):
+        """
+        Finish the dispatched items and stop the shards.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for every shard.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._dispatch_lock:
+            self._stopping = True
+            for process, inbox in self._workers:
+                inbox.put(None)
+            for process, inbox in self._workers:
+                process.join(timeout)
+            self._stopped = True
+        if self._collector is not None:
+            self._collector.join(timeout)
+        self._workers = []
+
+    def _check_workers(self):
+        """
+        Start again the shard processes that died.
+
+        Returns
+        -------
+        None.
+
+        """
+        failed = []
+        with self._lock:
+            for index, (process, inbox) in enumerate(self._workers):
+                if self._stopping or process.is_alive():
+                    continue
+                logger.error("shard process died, starting it again", extra={"shard": index, "exitcode": process.exitcode})
+                for ticket in [ticket for ticket, (shard, _) in self._pending.items() if shard == index]:
+                    failed.append(self._pending.pop(ticket)[1])
+                # what was left on its queue is failed too
+                inbox.cancel_join_thread()
+                inbox.close()
+                self._workers[index] = self._start_worker(index)
+                SHARD_RESTARTS.inc()
+        for future in failed:
+            future.set_exception(RuntimeError("shard process died"))
+
+    def _collect(self):
+        """
+        Hand the results of the shards to their futures until stopped.
+
+        Returns
+        -------
+        None.
+
+        """
+        checked_at = time.monotonic()
+        while not self._stopped or self._pending:
+            try:
+                ticket, ok, result = self._outbox.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                if self._stopped:
+                    return
+            else:
+                with self._lock:
+                    entry = self._pending.pop(ticket, None)
+                if entry is not None:
+                    if ok:
+                        entry[1].set_result(result)
+                    else:
+                        entry[1].set_exception(result)
+            if time.monotonic() - checked_at >= CHECK_INTERVAL:
+                self._check_workers()
+                checked_at = time.monotonic()
@@ -0,0 +1,318 @@
+"""
+Structured log.
+
+    Logging of the handler as one JSON object per line. Records are put on a
+    queue by the thread that logs them and written by a background listener,
+    so a request never waits on log output. Every process starts its own
+    listener with its first record, so workers forked by a server such as
+    uWSGI log like the process that set logging up.
+
+Classes:
+    JsonFormatter
+
+    StoreSampler
+
+Functions:
+    summarize_message(message) -> dict
+
+    log_message(logger, text, message, payloads, level) -> None
+
+    setup_logging(level, sample_every, stream) -> QueueHandler
+
+"""
+#_________________________________Libraries____________________________________
+import atexit
+from collections import OrderedDict
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+#__________________________________Variables___________________________________
+# attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+#__________________________________Classes_____________________________________
+class JsonFormatter(logging.Formatter):
+    """
+    JSON formatter.
+
+        Formats a record as a JSON object with its time, level, logger and
+        message, plus every field given with ``extra``.
+
+    Methods
+    -------
+    format(record):
+        Get the JSON line of a record.
+
+    """
+
+    def format(self, record):
+        """
+        Get the JSON line of a record.
+
+        Parameters
+        ----------
+        record : logging.LogRecord
+            Record to format.
+
+        Returns
+        -------
+        string
+            JSON object.
+
+        """
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class StoreSampler(logging.Filter):
+    """
+    Store sampler.
+
+        Keeps one in ``sample_every`` records of each store below WARNING.
+        Records without a store_id and warnings or errors always pass. Counts
+        are kept for the ``max_stores`` stores logged most recently, a store
+        logged again after it was dropped starts with a kept record.
+
+    Attributes
+    ----------
+    sample_every : int
+        Records of a store kept, one in this many.
+
+    max_stores : int
+        Maximum number of stores counted.
+
+    Methods
+    -------
+    filter(record):
+        Check whether a record is kept.
+
+    """
+
+    def __init__(self, sample_every=1, max_stores=4096) -> None:
+        """
+        Construct attributes of the class.
+
+        Parameters
+        ----------
+        sample_every : int, optional
+            Records of a store kept, one in this many. The default is 1,
+            which keeps every record.
+
+        max_stores : int, optional
+            Maximum number of stores counted. The default is 4096.
+
+        Returns
+        -------
+        None.
+
+        """
+        super().__init__()
+        self.sample_every = sample_every
+        self.max_stores = max_stores
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        """
+        Check whether a record is kept.
+
+        Parameters
+        ----------
+        record : logging.LogRecord
+            Record to check.
+
+        Returns
+        -------
+        bool
+            True to keep the record.
+
+        """
+        store_id = getattr(record, "store_id", None)
+        if self.sample_every <= 1 or store_id is None or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            count = self._counts.get(store_id, 0)
+            self._counts[store_id] = (count + 1) % self.sample_every
+            self._counts.move_to_end(store_id)
+            while len(self._counts) > self.max_stores:
+                self._counts.popitem(last=False)
+        return count % self.sample_every == 0
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that keeps exceptions apart from the message.
+
+        The standard handler folds the traceback into the message before the
+        record crosses the queue, here it is kept in an ``exception`` field.
+        The listener writing the queue to ``output`` is started by the first
+        record of each process. A forked process does not have the listener
+        thread of its parent, so it gets a queue and a listener of its own.
+
+    """
+
+    def __init__(self, output):
+        super().__init__(queue.SimpleQueue())
+        self.output = output
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start_listener()
+        super().enqueue(record)
+
+    def _start_listener(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # records a parent queued before the fork are written by the parent
+            self.queue = queue.SimpleQueue()
+            self._listener = logging.handlers.QueueListener(self.queue, self.output)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop_listener(self):
+        """
+        Write what is left on the queue and stop the listener of this
+        process.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._start_lock:
+            if self._pid == os.getpid():
+                self._listener.stop()
+                self._pid = None
+
+    def prepare(self, record):
+        exception = self.formatter.formatException(record.exc_info) if record.exc_info else None
+        record = super().prepare(record)
+        if exception is not None:
+            record.exception = exception
+        return record
+
+class _MessageFormatter(logging.Formatter):
+    """
+    Formatter of the bare message, without the traceback.
+
+    """
+
+    def format(self, record):
+        return record.getMessage()
+
+#_________________________________Functions____________________________________
+def summarize_message(message):
+    """
+    Summarize a device message for the log.
+
+        Counts are left out, only their number is kept.
+
+    Parameters
+    ----------
+    message : dict
+        Decyphered message.
+
+    Returns
+    -------
+    dict
+        Store id, timestamp, sequence and number of products of the message.
+
+    """
+    if not isinstance(message, dict):
+        return {"type": type(message).__name__}
+    summary = {key: message[key] for key in ("store_id", "timestamp", "sequence") if key in message}
+    for key in ("content_count", "changes", "store_curr_stock"):
+        if isinstance(message.get(key), dict):
+            summary["products"] = len(message[key])
+    return summary
+
+def log_message(logger, text, message, payloads=False, level=logging.INFO):
+    """
+    Log a device message.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        Logger to log with.
+
+    text : string
+        Log message.
+
+    message : dict
+        Decyphered message.
+
+    payloads : bool, optional
+        Add the whole message to the record instead of only its summary. The
+        default is False.
+
+    level : int, optional
+        Level of the record. The default is logging.INFO.
+
+    Returns
+    -------
+    None.
+
+    """
+    if not logger.isEnabledFor(level):
+        return
+    extra = summarize_message(message)
+    if payloads:
+        extra["payload"] = message
+    logger.log(level, text, extra=extra)
+
+def setup_logging(level="INFO", sample_every=1, stream=None):
+    """
+    Send the log of the handler through a queue to a JSON stream.
+
+        Replaces the handlers of the root logger. The listener thread is
+        started by the first record of each process and stopped, flushing
+        what is left on the queue, when the interpreter exits.
+
+    Parameters
+    ----------
+    level : string, optional
+        Lowest level logged. The default is "INFO".
+
+    sample_every : int, optional
+        Records of each store kept below WARNING, one in this many. The
+        default is 1.
+
+    stream : file, optional
+        Stream written to. The default is stderr.
+
+    Returns
+    -------
+    logging.handlers.QueueHandler
+        Handler added to the root logger.
+
+    """
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+    handler = _RecordQueueHandler(output)
+    handler.setFormatter(_MessageFormatter())
+    handler.addFilter(StoreSampler(sample_every))
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(handler.stop_listener)
+    return handler
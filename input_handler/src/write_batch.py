@@ -0,0 +1,402 @@
+"""
+Write batch.
+
+    Collects the database writes produced while handling messages so they can
+    be flushed with one statement per table.
+
+Classes:
+    WriteBatch
+
+Functions:
+    sale_buckets(timestamp) -> tuple
+
+"""
+#_________________________________Libraries____________________________________
+import datetime
+import functools
+
+#_________________________________Functions____________________________________
+@functools.lru_cache(maxsize=4096)
+def sale_buckets(timestamp):
+    """
+    Get the hour and day a sale is rolled up into.
+
+        Numeric timestamps are seconds since the epoch, or milliseconds when
+        they are too large to be seconds. Strings may also hold an ISO date
+        and time. Buckets are in UTC. Messages have one timestamp for all
+        their sales, so the result is cached.
+
+    Parameters
+    ----------
+    timestamp : long or string
+        Timestamp of the sale.
+
+    Raises
+    ------
+    ValueError
+        If the timestamp can not be read.
+
+    Returns
+    -------
+    sale_hour : string
+        Start of the hour, "YYYY-MM-DD HH:00:00".
+
+    sale_day : string
+        Day, "YYYY-MM-DD".
+
+    """
+    try:
+        seconds = float(timestamp)
+    except (TypeError, ValueError):
+        moment = datetime.datetime.fromisoformat(str(timestamp))
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    else:
+        if seconds > 1e11:
+            seconds /= 1000
+        moment = datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).replace(tzinfo=None)
+    return moment.strftime("%Y-%m-%d %H:00:00"), moment.strftime("%Y-%m-%d")
+
+#__________________________________Classes_____________________________________
+class WriteBatch():
+    """
+    Write batch.
+
+        Pending writes of one or more messages. Later stock or status changes
+        of the same store and product replace earlier ones, so only the final
+        value is written.
+
+    Attributes
+    ----------
+    new_inventories : list
+        (product_id, store_id, stock, min_stock, max_stock) rows to insert.
+
+    stock_updates : dict
+        Store id to a dictionary of product id to new stock.
+
+    sales : list
+        (product_id, store_id, timestamp, quantity) rows to insert.
+
+    hourly_sales : dict
+        (store_id, product_id, sale_hour) to [quantity, sales] to add to the
+        hourly rollup.
+
+    daily_sales : dict
+        (store_id, sale_day) to [quantity, sales] to add to the daily rollup.
+
+    statuses : dict
+        Store id to new status.
+
+    notifications : list
+        (store_id, new_status) rows to insert.
+
+    revisions : dict
+        Store id to (revision, inventory), the revision the store must still
+        have in the database for the batch to be written and its cached
+        inventory.
+
+    Methods
+    -------
+    add_inventory(product_id, store_id, stock, min_stock, max_stock):
+        Queue a new inventory register.
+
+    set_stock(store_id, product_id, stock):
+        Queue a stock update.
+
+    add_sale(product_id, store_id, timestamp, quantity):
+        Queue a new sale and its rollups.
+
+    set_status(store_id, status):
+        Queue a status update.
+
+    add_notification(store_id, status):
+        Queue a notification of a new status.
+
+    guard_revision(inventory):
+        Make the batch conditional on the revision of a cached inventory.
+
+    revision_guard():
+        Get the parameters of the revision guard.
+
+    guarded_inventories():
+        Get the cached inventories the batch is conditional on.
+
+    is_empty():
+        Check if there is anything to write.
+
+    stores():
+        Get the stores whose inventory or status is written.
+
+    statements():
+        Get the statements that write the batch.
+
+    """
+
+    def __init__(self) -> None:
+        """
+        Construct attributes of the class.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.new_inventories = []
+        self.stock_updates = {}
+        self.sales = []
+        self.hourly_sales = {}
+        self.daily_sales = {}
+        self.statuses = {}
+        self.notifications = []
+        self.revisions = {}
+
+    def add_inventory(self, product_id, store_id, stock, min_stock, max_stock):
+        """
+        Queue a new inventory register.
+
+        Parameters
+        ----------
+        product_id : int
+            Id of product.
+
+        store_id : int
+            Id of store.
+
+        stock : int
+            Actual stock of product.
+
+        min_stock : int
+            Minimum stock of product.
+
+        max_stock : int
+            Maximum stock of product.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.new_inventories.append((product_id, store_id, stock, min_stock, max_stock))
+
+    def set_stock(self, store_id, product_id, stock):
+        """
+        Queue a stock update.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+
+        product_id : int
+            Id of product.
+
+        stock : int
+            New stock.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.stock_updates.setdefault(store_id, {})[product_id] = stock
+
+    def add_sale(self, product_id, store_id, timestamp, quantity=1):
+        """
+        Queue a new sale and its rollups.
+        
+            Sales of the same store, product and hour are added up in the
+            hourly rollup, and those of the same store and day in the daily
+            one, so each bucket is written once.
+
+        Parameters
+        ----------
+        product_id : int
+            Id of product.
+
+        store_id : int
+            Id of store.
+
+        timestamp : long
+            Timestamp.
+
+        quantity : int, optional
+            Units sold. The default is 1.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sales.append((product_id, store_id, timestamp, quantity))
+        sale_hour, sale_day = sale_buckets(timestamp)
+        for totals in (self.hourly_sales.setdefault((store_id, product_id, sale_hour), [0, 0]),
+                       self.daily_sales.setdefault((store_id, sale_day), [0, 0])):
+            totals[0] += quantity
+            totals[1] += 1
+
+    def set_status(self, store_id, status):
+        """
+        Queue a status update.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+
+        status : int
+            New status.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.statuses[store_id] = status
+
+    def add_notification(self, store_id, status):
+        """
+        Queue a notification of a new status.
+
+        Parameters
+        ----------
+        store_id : int
+            Id of store.
+
+        status : int
+            New status.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.notifications.append((store_id, status))
+
+    def guard_revision(self, inventory):
+        """
+        Make the batch conditional on the revision of a cached inventory.
+
+        Parameters
+        ----------
+        inventory : StoreInventory
+            Cached inventory of store the batch was diffed against, with the
+            revision it was read at.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.revisions.setdefault(inventory.store_id, (inventory.revision, inventory))
+
+    def revision_guard(self):
+        """
+        Get the parameters of the revision guard.
+
+            The guard increments the revision of every guarded store that
+            still has its expected one, and is run before any other write.
+            The batch may only be written if it changed ``count`` rows. A
+            batch with nothing to write checks the same pairs with
+            check_store_revisions instead, which must find ``count`` rows.
+
+        Returns
+        -------
+        tuple
+            (params, count) of the guard_store_revisions statement, None if
+            no store is guarded.
+
+        """
+        if not self.revisions:
+            return None
+        params = []
+        for store_id, (revision, _) in self.revisions.items():
+            params.extend((store_id, revision))
+        return params, len(self.revisions)
+
+    def guarded_inventories(self):
+        """
+        Get the cached inventories the batch is conditional on.
+
+        Returns
+        -------
+        list
+            (inventory, revision) of every guarded store, with the revision
+            it was read at.
+
+        """
+        return [(inventory, revision) for revision, inventory in self.revisions.values()]
+
+    def is_empty(self):
+        """
+        Check if there is anything to write.
+        
+            The revision guard alone is not a write.
+
+        Returns
+        -------
+        bool
+            True if no write is pending.
+
+        """
+        return not (self.new_inventories or self.stock_updates or self.sales
+                    or self.statuses or self.notifications)
+
+    def stores(self):
+        """
+        Get the stores whose inventory, status or revision is written.
+
+        Returns
+        -------
+        set
+            Ids of stores.
+
+        """
+        return (set(row[1] for row in self.new_inventories) | set(self.stock_updates)
+                | set(self.statuses) | set(self.revisions))
+
+    def statements(self):
+        """
+        Get the statements that write the batch.
+
+            Each table is written with a single statement, except stock
+            updates which take one per store. The revision guard is not
+            included, see revision_guard.
+
+        Returns
+        -------
+        list
+            (statement name, params, count, table) for every statement, in
+            the order they have to run. ``count`` is also the number of rows
+            written.
+
+        """
+        statements = []
+        if self.new_inventories:
+            statements.append(("register_new_inventories", [value for row in self.new_inventories for value in row],
+                               len(self.new_inventories), "Inventory"))
+        for store_id, new_stocks in self.stock_updates.items():
+            params = [value for item in new_stocks.items() for value in item]
+            params.append(store_id)
+            params.extend(new_stocks.keys())
+            statements.append(("update_inventories", params, len(new_stocks), "Inventory"))
+        if self.sales:
+            statements.append(("register_new_sales", [value for row in self.sales for value in row],
+                               len(self.sales), "Sale"))
+        if self.hourly_sales:
+            statements.append(("add_hourly_sales", [value for key, totals in self.hourly_sales.items() for value in key + tuple(totals)],
+                               len(self.hourly_sales), "SaleHourly"))
+        if self.daily_sales:
+            statements.append(("add_daily_sales", [value for key, totals in self.daily_sales.items() for value in key + tuple(totals)],
+                               len(self.daily_sales), "SaleDaily"))
+        if self.statuses:
+            params = [value for item in self.statuses.items() for value in item]
+            params.extend(self.statuses.keys())
+            statements.append(("update_store_statuses", params, len(self.statuses), "Store"))
+        if self.notifications:
+            statements.append(("create_notifications", [value for row in self.notifications for value in row],
+                               len(self.notifications), "Notification"))
+            notified = dict(self.notifications)
+            params = [value for item in notified.items() for value in item]
+            params.extend(notified.keys())
+            statements.append(("set_notified_statuses", params, len(notified), "Store"))
+        return statements